@@ -4,16 +4,27 @@
 import json
 import os
 import sys
-from typing import Any, Dict, List, Literal, Optional, Union
+import time
+from typing import TYPE_CHECKING, Any, Dict, List, Literal, Optional, Union
 from annotated_types import Ge, Le, MaxLen, MinLen, Annotated
 from pydantic import BaseModel, Field, ValidationError
-import httpx
-from openai import OpenAI
 
-from sap_tools import run_sap_sql_query, are_tables_present, get_table_fields, get_domain_texts
+from sap_tools import run_sap_sql_query, are_tables_present, recover_sap_session
 from db_logger import DBLogger
+from candidate_sql import candidate_count, generate_candidates, select_candidate
+from deadlines import DeadlineExceeded, DialogBudget, call_with_deadline
+from llm_client import get_client, iter_chat_deltas_hedged, ollama_extra_body
+from join_graph import get_join_graph
+from prefetch import get_prefetcher
+from paged_fetch import fetch_to_file, max_rows, page_size
+from probe_batcher import run_probes
+from result_store import LOCAL_SQL_DIALECT, ResultStore, persist_query_result
+from sql_validator import get_ddic_cache, validate_sql, validation_error
 from utils import extract_json_object
 
+if TYPE_CHECKING:
+    from openai import OpenAI
+
 # ===== СХЕМЫ =====
 class Tool_GetTableFields(BaseModel):
     tool: Literal["gettablefields"]
@@ -23,11 +34,20 @@ class Tool_GetDomainTexts(BaseModel):
     tool: Literal["get_domain_texts"]
     domain_name: Annotated[str, MinLen(1), MaxLen(40)]
 
+class Tool_FindJoinPath(BaseModel):
+    tool: Literal["find_join_path"]
+    tables: Annotated[List[Annotated[str, MinLen(1), MaxLen(40)]], MinLen(2)]
+
 class Tool_RunSapSqlQuery(BaseModel):
     tool: Literal["runsapsql_query"]
     query: Annotated[str, MinLen(10)]
     name: Optional[Annotated[str, MinLen(2), MaxLen(40)]] = None
 
+class Tool_QueryLocalResult(BaseModel):
+    tool: Literal["query_local_result"]
+    result_id: int
+    query: Annotated[str, MinLen(10)]
+
 class FinalAnswer(BaseModel):
     intent_summary: Annotated[str, MinLen(8), MaxLen(400)]
     sql_used: Annotated[str, MinLen(10)]
@@ -42,7 +62,7 @@ class Step_SelectTables(BaseModel):
 class Step_ExploreAndProbe(BaseModel):
     kind: Literal["explore_and_probe"]
     thought: Annotated[str, MinLen(10)]
-    actions: Annotated[List[Union[Tool_GetTableFields, Tool_RunSapSqlQuery, Tool_GetDomainTexts]], MinLen(1)]
+    actions: Annotated[List[Union[Tool_GetTableFields, Tool_RunSapSqlQuery, Tool_GetDomainTexts, Tool_FindJoinPath, Tool_QueryLocalResult]], MinLen(1)]
 
 class Step_ExecuteFinalQuery(BaseModel):
     kind: Literal["execute_final_query"]
@@ -68,17 +88,22 @@ SYSTEM_PROMPT = f"""
 - get_table_fields
 - run_sap_sql_query
 - get_domain_texts
+- find_join_path
+- query_local_result
 
 ПРАВИЛА РАБОТЫ:
 - CDS/HANA views не использовать. Z* не предлагать.
 - При сомнениях существования таблиц — вызывай select_tables, для анализа полей таблиц — gettablefields, поиска идентификаторов доменных значений по тексту - get_domain_texts.
 - Разрешены пробные запуски в процессе размышления run_sap_sql_query. Для пробных запусков — всегда использовать ORDER BY для детерминированности и LIMIT для безопасности!!
 - Финальный SQL - выполняется отдельно , без ограничений.
+- SQL сначала проверяется локально по уже полученным метаданным (имена таблиц и полей, длина NUMC, формат дат). Ошибка validation_failed означает, что запрос в SAP не выполнялся — исправь указанные места; validation_warnings (поле не найдено среди полученных) — только подсказка, запрос выполнен.
+- Результаты с result_id сохранены локально. Для уточняющих вопросов (фильтр, группировка, сортировка уже полученных данных) используй query_local_result: SQL (диалект {LOCAL_SQL_DIALECT}) к таблице RESULT, без обращения к SAP.
 
 ВСПОМОГАТЕЛЬНАЯ ИНФОРМАЦИЯ ДЛЯ ПОИСКА ОТВЕТА:
 - У многих объектов в системе есть основная запись(header), и позиции, подпозиции, статусы итп. При поиске и связях не забываем группировать по основному номеру, если это требуется.
 - Для SAP полей типа NUMC используй полную длину с ведущими нулями
 - Если ставишь проверки по доменным идентификаторам, то сначала уточни их значение
+- Для связей между несколькими таблицами вызывай find_join_path со всеми нужными таблицами сразу — он вернёт цепочку соединений и поля для ON (если on пуст, on_hint — лишь предположение, проверь его).
 - При анализе полей таблиц обращай внимание на DOMNAME - это домен, и на CHECKTABLE - проверочные таблицы для поля. ENTITYTAB - там может быть таблица значений домена.
 
 ВОЗВРАЩАЙ ТОЛЬКО JSON ПО СХЕМЕ.
@@ -124,49 +149,62 @@ def print_final_answer(answer: Dict[str, Any]):
     print(f"🎯 Уверенность: {answer['confidence']*100:.1f}%\n")
 
 # ===== КЛИЕНТ OPENAI =====
-def create_openai_client(base_url: str, api_key: Optional[str] = None) -> OpenAI:
-    """Создание OpenAI клиента для Ollama/совместимого API"""
-    if not api_key:
-        api_key = "ollama"
-
-    # Создаём http клиент с отключённой проверкой SSL
-    http_client = httpx.Client(verify=False)
-
-    return OpenAI(
-        base_url=base_url.rstrip("/") + "/v1",
-        api_key=api_key,
-        http_client=http_client
-    )
-
-def stream_chat_completion(client: OpenAI, model: str, messages: List[Dict[str, str]], timeout: int = 180) -> str:
-    """Выполняет streaming запрос и возвращает полный ответ"""
+def create_openai_client(base_url: str, api_key: Optional[str] = None) -> "OpenAI":
+    """Клиент для Ollama/совместимого API (общий пул соединений на процесс)"""
+    return get_client(base_url, api_key)
+
+def stream_chat_completion(
+    client: "OpenAI",
+    model: str,
+    messages: List[Dict[str, str]],
+    timeout: int = 180,
+    stats: Optional[Dict[str, Any]] = None,
+    deadline: Optional[float] = None,
+) -> str:
+    """
+    Выполняет streaming запрос и возвращает полный ответ. В stats пишется время до первого токена
+    и ожидание слота LLM (queue_ms, в ttft_ms/total_ms не входит).
+    deadline — общий срок ответа в секундах; медленный первый токен страхуется повторным запросом (LLM_HEDGE_AFTER).
+    """
     try:
-        stream = client.chat.completions.create(
-            model=model,
-            messages=messages,
-            stream=True,
-            timeout=timeout
-        )
-
+        started = time.perf_counter()
+        extra_body = ollama_extra_body(model, messages)
         full_response = ""
-        for chunk in stream:
-            if chunk.choices and len(chunk.choices) > 0:
-                delta = chunk.choices[0].delta
-                if delta.content is not None:
-                    full_response += delta.content
-
+        first_token_at = None
+        timing: Dict[str, Any] = {}
+        for delta in iter_chat_deltas_hedged(client, model, messages, timeout=timeout,
+                                             extra_body=extra_body, deadline=deadline, stats=timing):
+            if first_token_at is None:
+                first_token_at = time.perf_counter()
+            full_response += delta
+
+        if stats is not None:
+            queue_ms = timing.get("queue_ms", 0)
+            stats["queue_ms"] = queue_ms
+            stats["ttft_ms"] = round((first_token_at - started) * 1000) - queue_ms if first_token_at else None
+            stats["total_ms"] = round((time.perf_counter() - started) * 1000) - queue_ms
+            stats["num_ctx"] = extra_body.get("options", {}).get("num_ctx")
         return full_response
 
+    except DeadlineExceeded:
+        raise
     except Exception as e:
         raise RuntimeError(f"Ошибка при запросе к API: {str(e)}")
 
 # ===== АГЕНТ =====
+def run_tool(tool: str, fn, *args, budget: DialogBudget, sap: bool = True):
+    """Вызов инструмента в пределах его бюджета времени; при зависании SAP — попытка восстановить сессию."""
+    return call_with_deadline(tool, fn, *args, dialog=budget, on_timeout=recover_sap_session if sap else None)
+
 def run_sgr_agent_adaptive(
     nl_query: str,
     max_steps: int = 20,
     base_url: str = os.getenv("OLLAMA_BASE_URL"),
     api_key: str = os.getenv("OLLAMA_API_KEY"),
     model: str = os.getenv("OLLAMA_MODEL"),
+    interactive: bool = True,
+    db: Optional[DBLogger] = None,
+    follow_up_of: Optional[int] = None,
 ):
     """
     Запускает агент для преобразования NL запроса в SQL через OpenAI-совместимый API
@@ -177,25 +215,45 @@ def run_sgr_agent_adaptive(
         base_url: URL Ollama/OpenAI-совместимого API
         api_key: API ключ (опционально для Ollama)
         model: Имя модели (по умолчанию "ChatAI GPT-4.1 mini")
+        interactive: Очищать консоль и печатать ход работы (False — для демона и пакетного режима)
+        db: Открытый логгер, который нужно переиспользовать (не закрывается по окончании)
+        follow_up_of: id диалога, уточнением которого является вопрос: его сохранённые результаты
+            добавляются в задачу (без него вопрос не зависит от предыдущих диалогов)
     """
 
     # Очистка консоли и вывод запроса в начале
-    clear_console()
-    print_query(nl_query)
+    if interactive:
+        clear_console()
+        print_query(nl_query)
 
     # Создание клиентов
     client = create_openai_client(base_url, api_key)
-    db = DBLogger()
-    db.connect()
+    own_db = db is None
+    if own_db:
+        db = DBLogger()
+        db.connect()
+    db.begin_dialog()
+    prefetcher = get_prefetcher()
+    prefetch_counters = prefetcher.dialog_counters()
+    store = ResultStore()
+    budget = DialogBudget()
+    llm_deadline = float(os.getenv("LLM_DEADLINE", "300"))
+    budget_notice_sent = False
+
+    # Результаты уточняемого диалога — чтобы уточняющий вопрос решался локально
+    task = f"Задача: {nl_query}"
+    recent = db.recent_final_results(follow_up_of) if follow_up_of is not None else []
+    if recent:
+        task += "\n\nСохранённые результаты предыдущих запросов (query_local_result):\n" + json.dumps(recent, ensure_ascii=False, indent=2)
 
     # Инициализация истории сообщений
     messages: List[Dict[str, str]] = [
         {"role": "system", "content": SYSTEM_PROMPT},
-        {"role": "user", "content": f"Задача: {nl_query}"},
+        {"role": "user", "content": task},
     ]
 
     db.log_message(turn_index=0, role="system", content=SYSTEM_PROMPT, meta={"kind": "system_prompt"})
-    db.log_message(turn_index=1, role="user", content=f"Задача: {nl_query}")
+    db.log_message(turn_index=1, role="user", content=task)
 
     bad_json_streak = 0
     final_dialog_id: Optional[int] = None
@@ -203,15 +261,34 @@ def run_sgr_agent_adaptive(
 
     try:
         for iteration in range(1, max_steps + 1):
+            # После исчерпания бюджета диалога модели даётся ровно один ход на финальный ответ
+            if budget.expired():
+                if budget_notice_sent:
+                    raise TimeoutError("Бюджет времени диалога исчерпан без финального ответа.")
+                notice = ("Бюджет времени диалога исчерпан. Инструменты больше не выполняются — "
+                          "сразу верни provide_final_answer по уже полученным данным.")
+                messages.append({"role": "user", "content": notice})
+                db.log_message(
+                    turn_index=len(messages) - 1,
+                    role="user",
+                    content=notice,
+                    meta={"reason": "dialog_deadline", "elapsed_s": round(budget.elapsed(), 1)},
+                    dialog_id=final_dialog_id
+                )
+                budget_notice_sent = True
             # Отправка полной истории сообщений в API
-            resp_text = stream_chat_completion(client, model, messages, timeout=180)
+            llm_stats: Dict[str, Any] = {}
+            resp_text = stream_chat_completion(client, model, messages, timeout=180, stats=llm_stats,
+                                               deadline=llm_deadline)
+            # Ожидание свободного слота LLM (пакетный режим) не расходует бюджет диалога
+            budget.exclude(llm_stats.get("queue_ms", 0) / 1000)
 
             messages.append({"role": "assistant", "content": resp_text})
             db.log_message(
                 turn_index=len(messages) - 1, 
                 role="assistant", 
                 content=resp_text, 
-                meta={"raw_stream": True, "iteration": iteration}, 
+                meta={"raw_stream": True, "iteration": iteration, **llm_stats}, 
                 dialog_id=final_dialog_id
             )
 
@@ -296,46 +373,146 @@ def run_sgr_agent_adaptive(
 
             # Вывод текущего шага
             step_counter += 1
-            print_step_header(step_counter)
+            if interactive:
+                print_step_header(step_counter)
 
             tool_results: List[Dict[str, Any]] = []
 
             if isinstance(step, Step_SelectTables):
-                print_thought(step.thought)
+                if interactive:
+                    print_thought(step.thought)
                 names = list(dict.fromkeys([t.upper() for t in step.tables_to_verify]))
-                print_tool_call("are_tables_present", {"tables": names})
-                result = are_tables_present(names)
+                if interactive:
+                    print_tool_call("are_tables_present", {"tables": names})
+                result = run_tool("aretablespresent", are_tables_present, names, budget=budget)
+                # Следующим шагом почти всегда идёт gettablefields — грузим поля, пока модель думает.
+                # Ошибка SAP или бюджета ({"status": False, ...}) в кэш не пишется: наличие неизвестно
+                if "status" not in result:
+                    get_ddic_cache().ingest_presence(result)
+                    prefetcher.schedule_tables([t for t, present in result.items() if present], prefetch_counters)
                 tool_results.append({"tool": "aretablespresent", "input": names, "result": result})
 
             elif isinstance(step, Step_ExploreAndProbe):
-                print_thought(step.thought)
+                if interactive:
+                    print_thought(step.thought)
+                # Пробы сначала проверяются локально: ошибки в именах и литералах не доходят до SAP,
+                # прошедшие проверку получают ORDER BY и LIMIT
+                probe_checks = [validate_sql(a.query, probe=True) for a in step.actions if isinstance(a, Tool_RunSapSqlQuery)]
+                # Несколько проб одного шага выполняются в SAP одним запросом (SAP_PROBE_BATCHING=0 — выключить)
+                probe_queries = [c["sql"] for c in probe_checks if c["ok"]]
+                probe_results = []
+                if len(probe_queries) > 1 and os.getenv("SAP_PROBE_BATCHING", "1") != "0":
+                    probe_results = run_probes(
+                        probe_queries,
+                        lambda sql: run_tool("runsapsql_query", run_sap_sql_query, sql, budget=budget)
+                    )
                 for action in step.actions:
                     if isinstance(action, Tool_GetTableFields):
-                        print_tool_call("get_table_fields", {"table_name": action.table_name})
-                        result = get_table_fields(action.table_name)
+                        if interactive:
+                            print_tool_call("get_table_fields", {"table_name": action.table_name})
+                        result = run_tool("gettablefields", prefetcher.get_table_fields, action.table_name, prefetch_counters, budget=budget)
+                        if isinstance(result, str):
+                            get_join_graph().ingest_table_fields(action.table_name, result)
+                            get_ddic_cache().ingest_table_fields(action.table_name, result)
                         tool_results.append({"tool": "gettablefields", "table": action.table_name, "result": result})
                     elif isinstance(action, Tool_GetDomainTexts):
-                        print_tool_call("get_domain_texts", {"domain_name": action.domain_name})
-                        result = get_domain_texts(action.domain_name)
+                        if interactive:
+                            print_tool_call("get_domain_texts", {"domain_name": action.domain_name})
+                        result = run_tool("get_domain_texts", prefetcher.get_domain_texts, action.domain_name, prefetch_counters, budget=budget)
                         tool_results.append({"tool": "get_domain_texts", "domain": action.domain_name, "result": result})
+                    elif isinstance(action, Tool_FindJoinPath):
+                        if interactive:
+                            print_tool_call("find_join_path", {"tables": action.tables})
+                        result = run_tool("find_join_path", get_join_graph().find_join_path, action.tables, budget=budget)
+                        tool_results.append({"tool": "find_join_path", "tables": action.tables, "result": result})
+                    elif isinstance(action, Tool_QueryLocalResult):
+                        if interactive:
+                            print_tool_call("query_local_result", {"result_id": action.result_id, "query": action.query})
+                        stored = db.get_result(action.result_id)
+                        if stored is None:
+                            result = {"status": False, "message": f"Результат {action.result_id} не найден", "result": "Ошибка выполнения"}
+                        else:
+                            result = run_tool("query_local_result", store.query, stored["path"], stored["format"],
+                                              stored["columns"], action.query, budget=budget, sap=False)
+                        tool_results.append({
+                            "tool": "query_local_result",
+                            "result_id": action.result_id,
+                            "sql": action.query,
+                            "result": result
+                        })
                     elif isinstance(action, Tool_RunSapSqlQuery):
                         params = {"query": action.query}
                         if action.name:
                             params["name"] = action.name
-                        print_tool_call("run_sap_sql_query", params)
-                        result = run_sap_sql_query(action.query)
+                        if interactive:
+                            print_tool_call("run_sap_sql_query", params)
+                        batched = False
+                        check = probe_checks.pop(0)
+                        if not check["ok"]:
+                            result = validation_error(check["errors"])
+                        elif probe_results:
+                            result, batched = probe_results.pop(0)
+                        else:
+                            result = run_tool("runsapsql_query", run_sap_sql_query, check["sql"], budget=budget)
                         tool_results.append({
                             "tool": "runsapsql_query", 
                             "name": action.name, 
-                            "sql": action.query, 
-                            "result": result
+                            "sql": check["sql"], 
+                            "result": result,
+                            "batched": batched,
+                            "result_id": persist_query_result(db, "probe", check["sql"], result, store),
+                            "validation_warnings": check["warnings"]
                         })
 
             elif isinstance(step, Step_ExecuteFinalQuery):
-                print_thought(step.thought)
-                print_tool_call("final_sql_execution", {"sql": step.final_sql})
-                result = run_sap_sql_query(step.final_sql)
-                tool_results.append({"tool": "final_sql_execution", "sql": step.final_sql, "result": result})
+                if interactive:
+                    print_thought(step.thought)
+                check = validate_sql(step.final_sql)
+                final_sql, result = check["sql"], None
+                if not check["ok"]:
+                    result = validation_error(check["errors"])
+                # Несколько вариантов SQL параллельно (SAP_FINAL_CANDIDATES > 1): в модель уходит только победитель
+                n_candidates = candidate_count()
+                if result is None and n_candidates > 1 and not budget.expired():
+                    extra = generate_candidates(client, model, messages, n_candidates - 1, deadline=llm_deadline)
+                    extra = [c["sql"] for c in map(validate_sql, extra) if c["ok"]]
+                    if extra:
+                        choice = select_candidate(
+                            [final_sql, *extra],
+                            lambda sql: run_tool("runsapsql_query", run_sap_sql_query, sql, budget=budget)
+                        )
+                        final_sql = choice["sql"]
+                        if choice["complete"]:
+                            result = choice["result"]
+                        db.log_message(
+                            turn_index=len(messages),
+                            role="tool",
+                            content=json.dumps(choice["report"], ensure_ascii=False),
+                            meta={"kind": "final_candidates", "selected": choice["index"]},
+                            dialog_id=final_dialog_id
+                        )
+                if interactive:
+                    print_tool_call("final_sql_execution", {"sql": final_sql})
+                # Большие результаты выгружаются страницами прямо в файл (SAP_FINAL_PAGE_SIZE > 0)
+                if result is None and page_size():
+                    result = fetch_to_file(
+                        db, final_sql,
+                        lambda sql: run_tool("final_sql_execution", run_sap_sql_query, sql, budget=budget),
+                        store, page_size(), max_rows(),
+                        progress=(lambda pages, rows: print(f"   ⏬ Страница {pages}: всего {rows} строк")) if interactive else None
+                    )
+                    result_id = result.pop("result_id")
+                else:
+                    if result is None:
+                        result = run_tool("final_sql_execution", run_sap_sql_query, final_sql, budget=budget)
+                    result_id = persist_query_result(db, "final", final_sql, result, store)
+                tool_results.append({
+                    "tool": "final_sql_execution",
+                    "sql": final_sql,
+                    "result": result,
+                    "result_id": result_id,
+                    "validation_warnings": check["warnings"]
+                })
 
             elif isinstance(step, Step_ProvideFinalAnswer):
                 final_dialog_id = db.log_final_answer(nl_query, step.answer.model_dump())
@@ -351,9 +528,10 @@ def run_sgr_agent_adaptive(
                 )
 
                 # Вывод финального ответа
-                print_final_answer(step.answer.model_dump())
+                if interactive:
+                    print_final_answer(step.answer.model_dump())
 
-                return {"final_answer": step.answer.model_dump(), "history": messages}
+                return {"final_answer": step.answer.model_dump(), "history": messages, "dialog_id": final_dialog_id}
 
             # Отправка результатов инструментов обратно в модель
             if tool_results:
@@ -370,7 +548,15 @@ def run_sgr_agent_adaptive(
         raise TimeoutError("Лимит шагов исчерпан без финального ответа.")
 
     finally:
-        db.close()
+        db.log_message(
+            turn_index=len(messages),
+            role="tool",
+            content=json.dumps(prefetcher.stats(prefetch_counters), ensure_ascii=False),
+            meta={"kind": "prefetch_stats"},
+            dialog_id=final_dialog_id
+        )
+        if own_db:
+            db.close()
 
 if __name__ == "__main__":
     query = os.getenv("QUERY", "Сколько есть авиарейсов из Нью-Йорка?")
@@ -0,0 +1,67 @@
+# agent_client.py
+# Тонкий клиент резидентного агента (agent_daemon.py): только стандартная библиотека, старт за миллисекунды.
+# Использование: python agent_client.py "Покажи 10 входящих ошибочных IDOC"
+#                python agent_client.py --follow-up 42 "А сколько из них за вчера?"
+import json
+import os
+import sys
+import urllib.error
+import urllib.request
+from typing import Optional
+
+DEFAULT_URL = "http://127.0.0.1:8765"
+
+
+def ask(query: str, url: str = DEFAULT_URL, timeout: float = 3600, follow_up_of: Optional[int] = None) -> dict:
+    """
+    Отправляет вопрос демону и возвращает ответ {"final_answer", "dialog_id", "elapsed_s"}.
+    follow_up_of — id диалога, который уточняет вопрос: агенту передаются его сохранённые результаты.
+    """
+    payload = {"query": query}
+    if follow_up_of is not None:
+        payload["follow_up_of"] = follow_up_of
+    req = urllib.request.Request(
+        url.rstrip("/") + "/ask",
+        data=json.dumps(payload, ensure_ascii=False).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+        method="POST",
+    )
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            return json.loads(resp.read())
+    except urllib.error.HTTPError as e:
+        return json.loads(e.read() or b"{}") or {"error": str(e)}
+
+
+def main() -> int:
+    url = os.getenv("AGENT_DAEMON_URL", DEFAULT_URL)
+    args = sys.argv[1:]
+    follow_up_of = None
+    if args[:1] == ["--follow-up"] and len(args) > 1 and args[1].isdigit():
+        follow_up_of, args = int(args[1]), args[2:]
+    query = " ".join(args) or os.getenv("QUERY", "")
+    if not query:
+        print("Использование: python agent_client.py [--follow-up <dialog_id>] <вопрос>")
+        return 2
+    try:
+        out = ask(query, url, follow_up_of=follow_up_of)
+    except urllib.error.URLError as e:
+        print(f"\n❌ Демон агента недоступен ({url}): {e.reason}. Запустите: python agent_daemon.py\n")
+        return 1
+    if "error" in out:
+        print(f"\n❌ ОШИБКА: {out['error']}\n")
+        return 1
+    answer = out["final_answer"]
+    print(f"\n✨ ФИНАЛЬНЫЙ ОТВЕТ\n")
+    print(f"📋 Суть запроса: {answer['intent_summary']}\n")
+    print(f"💾 Использованный SQL: {answer['sql_used']}\n")
+    print(f"📊 Результат: {answer['result_summary']}\n")
+    print(f"🎯 Уверенность: {answer['confidence']*100:.1f}%\n")
+    print(f"⏱ {out['elapsed_s']} с")
+    if out.get("dialog_id"):
+        print(f"🧾 Диалог {out['dialog_id']} — уточняющий вопрос: --follow-up {out['dialog_id']}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
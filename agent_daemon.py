@@ -0,0 +1,147 @@
+# agent_daemon.py
+# Резидентный процесс агента: LLM-клиент, сессия SAP, кэши метаданных и логгер остаются «тёплыми»
+# между вопросами. Вопросы принимаются по HTTP на локальном адресе (см. agent_client.py).
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Optional
+
+from utils import load_agent_module
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+
+
+class AgentDaemon:
+    """Держит прогретые ресурсы и выполняет вопросы по одному (SAP GUI — одна сессия)."""
+
+    def __init__(self):
+        self.agent = None
+        self.db = None
+        self.started_at = time.time()
+        self.answered = 0
+        self._run_lock = threading.Lock()
+
+    def warm_up(self) -> Dict[str, Any]:
+        """Импортирует агента (схема NextStep и SYSTEM_PROMPT строятся один раз) и прогревает ресурсы."""
+        from db_logger import DBLogger
+        from deadlines import call_with_deadline, is_deadline_error
+        from join_graph import get_join_graph
+        from llm_client import warm_up
+        from prefetch import get_prefetcher
+        from sap_tools import attach_sap_window, serialized_gui_call
+
+        report: Dict[str, Any] = {}
+        t0 = time.perf_counter()
+        self.agent = load_agent_module()
+        report["agent_import_s"] = round(time.perf_counter() - t0, 2)
+
+        self.db = DBLogger()
+        self.db.connect()
+        get_join_graph()
+        get_prefetcher()
+
+        base_url, model = os.getenv("OLLAMA_BASE_URL"), os.getenv("OLLAMA_MODEL")
+        if base_url and model:
+            t0 = time.perf_counter()
+            report["llm_warm"] = warm_up(base_url, model, self.agent.SYSTEM_PROMPT, os.getenv("OLLAMA_API_KEY"))
+            report["llm_warm_s"] = round(time.perf_counter() - t0, 2)
+
+        # Подключение к SAP кэшируется в потоке инструментов — прогреваем его там же
+        try:
+            attached = call_with_deadline("attach_sap", serialized_gui_call(attach_sap_window), budget=30)
+            report["sap_attached"] = not is_deadline_error(attached)
+        except Exception as e:
+            report["sap_attached"] = False
+            report["sap_error"] = str(e)
+        return report
+
+    def ask(self, query: str, max_steps: int = 20, follow_up_of: Optional[int] = None) -> Dict[str, Any]:
+        with self._run_lock:
+            started = time.perf_counter()
+            out = self.agent.run_sgr_agent_adaptive(query, max_steps=max_steps, interactive=False, db=self.db,
+                                                    follow_up_of=follow_up_of)
+            self.answered += 1
+            return {
+                "final_answer": out["final_answer"],
+                "dialog_id": out.get("dialog_id"),
+                "elapsed_s": round(time.perf_counter() - started, 2),
+            }
+
+    def status(self) -> Dict[str, Any]:
+        from prefetch import get_prefetcher
+
+        return {
+            "status": "ok",
+            "busy": self._run_lock.locked(),
+            "answered": self.answered,
+            "uptime_s": round(time.time() - self.started_at),
+            "prefetch": get_prefetcher().stats(),
+        }
+
+
+def make_handler(daemon: AgentDaemon):
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, code: int, payload: Dict[str, Any]):
+            body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path == "/health":
+                self._send(200, daemon.status())
+            else:
+                self._send(404, {"error": "not found"})
+
+        def do_POST(self):
+            if self.path != "/ask":
+                self._send(404, {"error": "not found"})
+                return
+            try:
+                length = int(self.headers.get("Content-Length", "0"))
+                payload = json.loads(self.rfile.read(length) or b"{}")
+                query = str(payload.get("query", "")).strip()
+                follow_up_of = int(payload["follow_up_of"]) if payload.get("follow_up_of") is not None else None
+            except (ValueError, TypeError, json.JSONDecodeError):
+                self._send(400, {"error": "ожидается JSON {\"query\": ..., \"follow_up_of\": <dialog_id>}"})
+                return
+            if not query:
+                self._send(400, {"error": "пустой запрос"})
+                return
+            try:
+                self._send(200, daemon.ask(query, int(payload.get("max_steps", 20)), follow_up_of))
+            except Exception as e:
+                self._send(500, {"error": str(e)})
+
+    return Handler
+
+
+def serve(host: str = DEFAULT_HOST, port: int = DEFAULT_PORT):
+    daemon = AgentDaemon()
+    report = daemon.warm_up()
+    print(f"Прогрев: {json.dumps(report, ensure_ascii=False)}")
+    server = ThreadingHTTPServer((host, port), make_handler(daemon))
+    print(f"Агент слушает http://{host}:{port} (POST /ask, GET /health)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if daemon.db is not None:
+            daemon.db.close()
+
+
+if __name__ == "__main__":
+    host = os.getenv("AGENT_DAEMON_HOST", DEFAULT_HOST)
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else int(os.getenv("AGENT_DAEMON_PORT", DEFAULT_PORT))
+    serve(host, port)
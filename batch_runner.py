@@ -0,0 +1,141 @@
+# batch_runner.py
+# Пакетный прогон вопросов из JSONL: несколько вопросов одновременно в пределах лимитов LLM и сессий SAP,
+# ответы и время по каждому вопросу дописываются в JSONL, повторный запуск пропускает уже отвеченные.
+# Использование: python batch_runner.py questions.jsonl -o answers.jsonl --workers 3 --llm-concurrency 2
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Dict, List, Optional, Set
+
+from utils import load_agent_module
+
+
+def read_questions(path: str) -> List[Dict[str, Any]]:
+    """Вопросы из JSONL: {"id": ..., "query": ...} (или "question"); без id — номер строки."""
+    questions = []
+    with open(path, encoding="utf-8") as f:
+        for lineno, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            item = json.loads(line)
+            query = item.get("query") or item.get("question")
+            if not query:
+                raise ValueError(f"{path}:{lineno}: нет поля query")
+            questions.append({"id": str(item.get("id", lineno)), "query": query})
+    return questions
+
+
+def done_ids(path: str, retry_errors: bool = False) -> Set[str]:
+    """Id вопросов, уже записанных в файл ответов (с retry_errors — только успешных)."""
+    ids: Set[str] = set()
+    if not os.path.exists(path):
+        return ids
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                item = json.loads(line)
+            except json.JSONDecodeError:
+                # Строка, оборванная при аварийной остановке
+                continue
+            if not retry_errors or item.get("status") == "ok":
+                ids.add(str(item.get("id")))
+    return ids
+
+
+class BatchRunner:
+    """Выполняет вопросы в пуле потоков; кэши метаданных, LLM-клиент и сессии SAP общие для всех вопросов."""
+
+    def __init__(self, out_path: str, workers: int, max_steps: int = 20):
+        self.out_path = out_path
+        self.workers = workers
+        self.max_steps = max_steps
+        self.agent = load_agent_module()
+        self._write_lock = threading.Lock()
+
+    def _write(self, record: Dict[str, Any]):
+        # Запись сразу на диск: после прерывания прогон продолжается с того же места
+        with self._write_lock, open(self.out_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            f.flush()
+
+    def run_one(self, question: Dict[str, Any]) -> Dict[str, Any]:
+        from db_logger import DBLogger
+
+        record: Dict[str, Any] = {"id": question["id"], "query": question["query"],
+                                  "started_at": time.strftime("%Y-%m-%d %H:%M:%S")}
+        started = time.perf_counter()
+        # Свой логгер на вопрос: незавершённые записи диалога отслеживаются в экземпляре DBLogger
+        db = DBLogger()
+        db.connect()
+        try:
+            out = self.agent.run_sgr_agent_adaptive(question["query"], max_steps=self.max_steps,
+                                                    interactive=False, db=db)
+            record.update(status="ok", final_answer=out["final_answer"], dialog_id=out.get("dialog_id"))
+        except Exception as e:
+            record.update(status="error", error=f"{type(e).__name__}: {e}")
+        finally:
+            db.close()
+        record["elapsed_s"] = round(time.perf_counter() - started, 2)
+        self._write(record)
+        return record
+
+    def run(self, questions: List[Dict[str, Any]]) -> Dict[str, Any]:
+        started = time.perf_counter()
+        counts = {"ok": 0, "error": 0}
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="batch-question") as pool:
+            futures = [pool.submit(self.run_one, q) for q in questions]
+            for n, future in enumerate(as_completed(futures), start=1):
+                record = future.result()
+                counts[record["status"]] += 1
+                mark = "✅" if record["status"] == "ok" else "❌"
+                print(f"[{n}/{len(questions)}] {mark} {record['id']}: {record['elapsed_s']} с"
+                      + (f" — {record['error']}" if record["status"] == "error" else ""))
+        return {**counts, "elapsed_s": round(time.perf_counter() - started, 2)}
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    from llm_client import set_concurrency, warm_up
+    from sap_tools import SAP_SESSION_INDEXES
+
+    parser = argparse.ArgumentParser(description="Пакетный прогон вопросов к агенту")
+    parser.add_argument("questions", help="JSONL с вопросами")
+    parser.add_argument("-o", "--output", default="answers.jsonl", help="JSONL с ответами (дописывается)")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="вопросов одновременно (по умолчанию — по числу сессий SAP + 1)")
+    parser.add_argument("--llm-concurrency", type=int, default=None,
+                        help="одновременных запросов к LLM (по умолчанию LLM_MAX_CONCURRENCY, иначе без ограничения)")
+    parser.add_argument("--max-steps", type=int, default=20)
+    parser.add_argument("--retry-errors", action="store_true", help="повторить вопросы, завершившиеся ошибкой")
+    args = parser.parse_args(argv)
+
+    questions = read_questions(args.questions)
+    skip = done_ids(args.output, args.retry_errors)
+    pending = [q for q in questions if q["id"] not in skip]
+    if not pending:
+        print(f"Все {len(questions)} вопросов уже есть в {args.output}")
+        return 0
+
+    if args.llm_concurrency is not None:
+        set_concurrency(args.llm_concurrency)
+    # Пока одни вопросы ждут LLM, другие занимают сессии SAP — поэтому вопросов на один больше, чем сессий
+    workers = args.workers or len(SAP_SESSION_INDEXES) + 1
+    runner = BatchRunner(args.output, workers, args.max_steps)
+
+    base_url, model = os.getenv("OLLAMA_BASE_URL"), os.getenv("OLLAMA_MODEL")
+    if base_url and model:
+        warm_up(base_url, model, runner.agent.SYSTEM_PROMPT, os.getenv("OLLAMA_API_KEY"))
+
+    print(f"Вопросов: {len(pending)} (пропущено {len(questions) - len(pending)}), "
+          f"одновременно: {workers}, сессии SAP: {SAP_SESSION_INDEXES}")
+    summary = runner.run(pending)
+    print(f"Готово: {summary['ok']} успешно, {summary['error']} с ошибкой за {summary['elapsed_s']} с")
+    return 0 if summary["error"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
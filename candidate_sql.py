@@ -0,0 +1,157 @@
+# candidate_sql.py
+# Несколько вариантов финального SQL за один ход: варианты запрашиваются у LLM параллельно,
+# выполняются в SAP с ограничением строк, в модель возвращается только победитель
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional
+
+from llm_client import iter_chat_deltas_hedged, ollama_extra_body
+from probe_batcher import prepare_probe
+from sql_validator import strip_comments, tokenize, top_level_words
+from utils import extract_json_object, parse_clipboard_table
+
+if TYPE_CHECKING:
+    from openai import OpenAI
+
+CANDIDATE_PROMPT = (
+    "Перед выполнением перепроверь финальный SQL независимо: таблицы, условия соединения, фильтры, "
+    "ключи с ведущими нулями, агрегаты. Верни строго один JSON {\"final_sql\": \"...\"} с SQL, "
+    "который считаешь правильным (можно тот же)."
+)
+
+
+def candidate_count() -> int:
+    """Сколько всего вариантов финального SQL рассматривать (SAP_FINAL_CANDIDATES, 1 — режим выключен)."""
+    return max(1, int(os.getenv("SAP_FINAL_CANDIDATES", "1")))
+
+
+def probe_rows() -> int:
+    """Ограничение строк при пробном выполнении вариантов (SAP_CANDIDATE_PROBE_ROWS)."""
+    return max(1, int(os.getenv("SAP_CANDIDATE_PROBE_ROWS", "200")))
+
+
+def _normalize(sql: str) -> str:
+    return re.sub(r"\s+", " ", sql.strip().rstrip(";")).strip().upper()
+
+
+def generate_candidates(
+    client: "OpenAI",
+    model: str,
+    messages: List[Dict[str, str]],
+    n: int,
+    deadline: Optional[float] = None,
+) -> List[str]:
+    """
+    Запрашивает n дополнительных вариантов одновременно (отдельные запросы с разным seed).
+    Неудачные ответы (ошибка, просрочка, невалидный JSON) просто отбрасываются.
+    """
+    prompt = messages + [{"role": "user", "content": CANDIDATE_PROMPT}]
+
+    def one(seed: int) -> Optional[str]:
+        extra_body = ollama_extra_body(model, prompt)
+        if extra_body:
+            extra_body["options"] = {**extra_body["options"], "temperature": 0.7, "seed": seed}
+        try:
+            text = "".join(iter_chat_deltas_hedged(client, model, prompt, extra_body=extra_body,
+                                                   deadline=deadline, hedge_after=0))
+        except Exception:
+            return None
+        job = extract_json_object(text) or {}
+        sql = job.get("final_sql") or (job.get("next_step") or {}).get("final_sql")
+        return sql.strip() if isinstance(sql, str) and sql.strip() else None
+
+    with ThreadPoolExecutor(max_workers=n, thread_name_prefix="llm-candidate") as pool:
+        return [sql for sql in pool.map(one, range(1, n + 1)) if sql]
+
+
+def limit_sql(sql: str, rows: int) -> str:
+    """
+    Вариант как производная таблица с ограничением строк — пробное выполнение дёшево при любом объёме.
+    Если число колонок известно, строки сортируются по всем колонкам: тогда усечённые результаты
+    равносильных запросов совпадают и их можно сравнивать по содержимому.
+    """
+    text = strip_comments(sql).rstrip(";").strip()
+    prepared = prepare_probe(text, 0)
+    order = ""
+    if prepared is not None:
+        order = " ORDER BY " + ", ".join(str(i) for i in range(1, len(prepared[1]) + 1))
+    return f"SELECT * FROM (\n{text}\n) AS Q{order} LIMIT {rows}"
+
+
+def has_order_by(sql: str) -> bool:
+    """Есть ли у запроса собственный ORDER BY верхнего уровня."""
+    try:
+        return "ORDER" in top_level_words(tokenize(strip_comments(sql)))
+    except ValueError:
+        return False
+
+
+def _fingerprint(columns: List[str], rows: List[List[str]], complete: bool):
+    """
+    Отпечаток результата для голосования: имена колонок и строки без учёта порядка.
+    Усечённый лимитом результат помечается отдельно — он совпадает с другим только при той же выборке строк.
+    """
+    return tuple(columns), "complete" if complete else "limit", tuple(sorted(tuple(r) for r in rows))
+
+
+def select_candidate(
+    candidates: List[str],
+    execute: Callable[[str], Dict[str, Any]],
+    limit: Optional[int] = None,
+) -> Dict[str, Any]:
+    """
+    Выполняет уникальные варианты с ограничением строк и выбирает победителя:
+    сначала непустой результат, затем число согласных с ним вариантов (включая повторы SQL),
+    при равенстве — исходный вариант модели (candidates[0]).
+    Возвращает {"sql", "index", "result", "complete", "report"}; complete — лимит не достигнут
+    и у победителя нет своего ORDER BY, т.е. пробный результат уже полный и в нужном порядке
+    (порядок внутри производной таблицы не сохраняется) — повторно выполнять запрос не нужно.
+    """
+    limit = limit or probe_rows()
+    unique: Dict[str, int] = {}
+    for i, sql in enumerate(candidates):
+        unique.setdefault(_normalize(sql), i)
+
+    outcomes: Dict[int, Dict[str, Any]] = {}
+    for i in unique.values():
+        res = execute(limit_sql(candidates[i], limit))
+        columns, rows = parse_clipboard_table(res.get("result", "")) if res.get("status") else ([], [])
+        complete = len(rows) < limit
+        outcomes[i] = {
+            "result": res,
+            "rows": len(rows),
+            "complete": complete,
+            "fingerprint": _fingerprint(columns, rows, complete) if rows else None,
+        }
+
+    votes: Dict[Any, int] = {}
+    for sql in candidates:
+        fp = outcomes[unique[_normalize(sql)]]["fingerprint"]
+        if fp is not None:
+            votes[fp] = votes.get(fp, 0) + 1
+
+    def rank(i: int):
+        fp = outcomes[i]["fingerprint"]
+        return (fp is not None, votes.get(fp, 0), i == 0)
+
+    best = max(outcomes, key=rank)
+    report = [
+        {
+            "index": i,
+            "sql": candidates[i],
+            "status": bool(o["result"].get("status")),
+            "rows": o["rows"],
+            "votes": votes.get(o["fingerprint"], 0),
+            "selected": i == best,
+        }
+        for i, o in sorted(outcomes.items())
+    ]
+    return {
+        "sql": candidates[best],
+        "index": best,
+        "result": outcomes[best]["result"],
+        "complete": (outcomes[best]["complete"] and bool(outcomes[best]["result"].get("status"))
+                     and not has_order_by(candidates[best])),
+        "report": report,
+    }
@@ -0,0 +1,30 @@
+# conftest.py
+# Общие фикстуры тестов: SQLite вместо SAP для кода, который выполняет SQL через run_sap_sql_query
+import sqlite3
+
+import pytest
+
+from utils import format_clipboard_table
+
+
+@pytest.fixture
+def sqlite_sap():
+    """
+    Выполняет SQL в SQLite и отвечает в формате run_sap_sql_query (пустой результат — «Данные не найдены»).
+    Таблицы создаются тестом через sqlite_sap.con, выполненные запросы копятся в sqlite_sap.calls.
+    """
+    con = sqlite3.connect(":memory:", check_same_thread=False)
+    calls = []
+
+    def execute(sql):
+        calls.append(sql)
+        cur = con.execute(sql)
+        rows = cur.fetchall()
+        if not rows:
+            return {"status": False, "message": "Данные не найдены", "result": ""}
+        return {"status": True, "message": "", "result": format_clipboard_table([d[0] for d in cur.description], rows)}
+
+    execute.con = con
+    execute.calls = calls
+    yield execute
+    con.close()
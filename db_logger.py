@@ -2,17 +2,21 @@
 import json
 import sqlite3
 import time
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List
 
 class DBLogger:
     def __init__(self, db_path: str = "sgr_logs.sqlite3"):
         self.db_path = db_path
         self.conn: Optional[sqlite3.Connection] = None
+        # Строки текущего диалога без dialog_id — их проставит backfill_dialog_id
+        self._pending_messages: List[int] = []
+        self._pending_results: List[int] = []
 
     def connect(self):
         if self.conn:
             return
-        self.conn = sqlite3.connect(self.db_path)
+        # Соединение может использоваться из разных потоков демона (обращения сериализуются вызывающей стороной)
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
         self.conn.execute("PRAGMA foreign_keys = ON")  # [web:48]
         self._ensure_schema()
 
@@ -50,6 +54,21 @@ class DBLogger:
                 FOREIGN KEY (dialog_id) REFERENCES dialog_log(id) ON DELETE CASCADE
             );
         """)  # [web:2][web:48]
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS dialog_result (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                timestamp TEXT NOT NULL,
+                dialog_id INTEGER,
+                kind TEXT NOT NULL CHECK(kind IN ('final','probe')),
+                sql TEXT NOT NULL,
+                path TEXT NOT NULL,
+                format TEXT NOT NULL,
+                row_count INTEGER NOT NULL,
+                columns TEXT NOT NULL,
+                FOREIGN KEY (dialog_id) REFERENCES dialog_log(id) ON DELETE CASCADE
+            );
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS ix_dialog_result_dialog_id ON dialog_result(dialog_id);")
         self.conn.execute("CREATE INDEX IF NOT EXISTS ix_dialog_message_dialog_id ON dialog_message(dialog_id);")  # [web:2]
         self.conn.execute("CREATE INDEX IF NOT EXISTS ix_dialog_message_turn ON dialog_message(turn_index);")  # [web:2]
         self.conn.commit()
@@ -61,11 +80,13 @@ class DBLogger:
     def log_message(self, turn_index: int, role: str, content: str, meta: Optional[Dict[str, Any]] = None, dialog_id: Optional[int] = None):
         assert self.conn is not None
         meta_json = json.dumps(meta, ensure_ascii=False) if meta is not None else None
-        self.conn.execute("""
+        cur = self.conn.execute("""
             INSERT INTO dialog_message (timestamp, dialog_id, turn_index, role, content, meta)
             VALUES (?, ?, ?, ?, ?, ?)
         """, (self._now(), dialog_id, turn_index, role, content, meta_json))  # [web:2]
         self.conn.commit()  # [web:2]
+        if dialog_id is None:
+            self._pending_messages.append(cur.lastrowid)
 
     def log_final_answer(self, nl_query: str, answer: Dict[str, Any]) -> int:
         assert self.conn is not None
@@ -81,10 +102,20 @@ class DBLogger:
         self.conn.commit()
         return cur.lastrowid  # [web:2]
 
+    def begin_dialog(self):
+        """Начало нового диалога на переиспользуемом логгере: строки прошлого (незавершённого) не привязываются."""
+        self._pending_messages = []
+        self._pending_results = []
+
     def backfill_dialog_id(self, dialog_id: int):
+        """Проставляет dialog_id строкам, записанным этим логгером в текущем диалоге."""
         assert self.conn is not None
-        self.conn.execute("UPDATE dialog_message SET dialog_id = ? WHERE dialog_id IS NULL", (dialog_id,))  # [web:2]
+        self.conn.executemany("UPDATE dialog_message SET dialog_id = ? WHERE id = ? AND dialog_id IS NULL",
+                              [(dialog_id, i) for i in self._pending_messages])  # [web:2]
+        self.conn.executemany("UPDATE dialog_result SET dialog_id = ? WHERE id = ? AND dialog_id IS NULL",
+                              [(dialog_id, i) for i in self._pending_results])
         self.conn.commit()  # [web:2]
+        self.begin_dialog()
         
     def reserve_dialog(self, nl_query: str) -> int:
         """
@@ -133,4 +164,54 @@ class DBLogger:
             found,
             dialog_id
         ))
-        self.conn.commit()                      # фиксируем UPDATE [web:2]
\ No newline at end of file
+        self.conn.commit()                      # фиксируем UPDATE [web:2]
+
+    def get_dialog_sql(self, dialog_id: int) -> Optional[str]:
+        """SQL, на котором основан финальный ответ диалога (dialog_log.sql_used)."""
+        assert self.conn is not None
+        row = self.conn.execute("SELECT sql_used FROM dialog_log WHERE id = ?", (dialog_id,)).fetchone()
+        return row[0] if row else None
+
+    def log_result(self, kind: str, sql: str, path: str, fmt: str, row_count: int,
+                   columns: List[str], dialog_id: Optional[int] = None) -> int:
+        """Регистрирует сохранённый на диске результат запроса и возвращает его id."""
+        assert self.conn is not None
+        cur = self.conn.cursor()
+        cur.execute("""
+            INSERT INTO dialog_result (timestamp, dialog_id, kind, sql, path, format, row_count, columns)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, (self._now(), dialog_id, kind, sql, path, fmt, row_count, json.dumps(columns, ensure_ascii=False)))
+        self.conn.commit()
+        if dialog_id is None:
+            self._pending_results.append(cur.lastrowid)
+        return cur.lastrowid
+
+    def get_result(self, result_id: int) -> Optional[Dict[str, Any]]:
+        """Описание сохранённого результата по id."""
+        assert self.conn is not None
+        row = self.conn.execute("""
+            SELECT id, timestamp, dialog_id, kind, sql, path, format, row_count, columns
+              FROM dialog_result WHERE id = ?
+        """, (result_id,)).fetchone()
+        if row is None:
+            return None
+        keys = ("id", "timestamp", "dialog_id", "kind", "sql", "path", "format", "row_count", "columns")
+        item = dict(zip(keys, row))
+        item["columns"] = json.loads(item["columns"])
+        return item
+
+    def recent_final_results(self, dialog_id: int, limit: int = 5) -> List[Dict[str, Any]]:
+        """Последние финальные результаты диалога dialog_id вместе с его вопросом — для follow-up вопроса к нему."""
+        assert self.conn is not None
+        rows = self.conn.execute("""
+            SELECT r.id, l.nl_query, r.sql, r.row_count, r.columns
+              FROM dialog_result AS r
+              JOIN dialog_log AS l ON l.id = r.dialog_id
+             WHERE r.kind = 'final' AND r.dialog_id = ?
+             ORDER BY r.id DESC
+             LIMIT ?
+        """, (dialog_id, limit)).fetchall()
+        return [
+            {"result_id": rid, "nl_query": q, "sql": sql, "row_count": cnt, "columns": json.loads(cols)}
+            for rid, q, sql, cnt, cols in rows
+        ]
@@ -0,0 +1,276 @@
+# deadlines.py
+# Бюджеты времени на инструменты и диалог, отмена зависших вызовов
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, Optional
+
+# Сколько ждать восстановления сессии после превышения бюджета
+RECOVERY_TIMEOUT = 15.0
+# Сколько вызов может ждать сессию SAP GUI, занятую живыми вызовами других диалогов
+# (это время не входит в бюджеты; ожидание не дольше остатка бюджета диалога)
+QUEUE_TIMEOUT = float(os.getenv("SAP_QUEUE_TIMEOUT", "120"))
+
+# Бюджет по умолчанию (секунды) для каждого инструмента; переопределяется SAP_DEADLINE_<ИНСТРУМЕНТ>
+DEFAULT_TOOL_BUDGETS: Dict[str, float] = {
+    "aretablespresent": 60,
+    "gettablefields": 60,
+    "get_domain_texts": 60,
+    "find_join_path": 120,
+    "runsapsql_query": 120,
+    "final_sql_execution": 600,
+    "query_local_result": 60,
+}
+
+
+class DeadlineExceeded(TimeoutError):
+    """Вызов не уложился в отведённый бюджет времени."""
+
+
+class CallCancelled(RuntimeError):
+    """Вызов отменён: вызывающая сторона больше не ждёт результата."""
+
+
+_local = threading.local()
+# Потоки инструментов переиспользуются между вызовами: в них живут подключения к SAP GUI
+# (sap_tools.attach_sap_window). Потоки-демоны, чтобы зависший вызов не мешал завершению процесса.
+_tasks: "queue.Queue[Callable[[], None]]" = queue.Queue()
+_idle_workers = 0
+_workers_lock = threading.Lock()
+
+def _worker_loop():
+    global _idle_workers
+    while True:
+        task = _tasks.get()
+        try:
+            task()
+        finally:
+            with _workers_lock:
+                _idle_workers += 1
+
+def _submit(task: Callable[[], None]):
+    """
+    Ставит задачу в очередь, заранее занимая под неё свободный поток; если свободных нет (например,
+    все зависли), создаётся новый. Резерв под блокировкой: одновременные вызовы не встанут
+    в очередь за одним потоком.
+    """
+    global _idle_workers
+    with _workers_lock:
+        if _idle_workers > 0:
+            _idle_workers -= 1
+        else:
+            threading.Thread(target=_worker_loop, name="tool-worker", daemon=True).start()
+    _tasks.put(task)
+
+def current_cancel_event() -> Optional[threading.Event]:
+    """Событие отмены вызова, выполняемого в текущем потоке через call_with_deadline."""
+    return getattr(_local, "cancel", None)
+
+
+class _CallClock:
+    """
+    Время вызова без ожидания общих ресурсов, занятых живыми вызовами (сессии SAP GUI):
+    бюджет расходуется только на работу и на ожидание за брошенными вызовами.
+    """
+
+    def __init__(self, queue_limit: float = QUEUE_TIMEOUT):
+        self.queue_limit = queue_limit
+        self.started = time.monotonic()
+        self.waited = 0.0
+        self.waiting_since: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def begin_wait(self):
+        with self._lock:
+            self.waiting_since = time.monotonic()
+
+    def end_wait(self):
+        with self._lock:
+            if self.waiting_since is not None:
+                self.waited += time.monotonic() - self.waiting_since
+                self.waiting_since = None
+
+    def waiting(self) -> bool:
+        """Вызов сейчас ждёт ресурс, занятый живым вызовом."""
+        with self._lock:
+            return self.waiting_since is not None
+
+    def total_waited(self) -> float:
+        with self._lock:
+            current = 0.0 if self.waiting_since is None else time.monotonic() - self.waiting_since
+            return self.waited + current
+
+    def active(self) -> float:
+        return time.monotonic() - self.started - self.total_waited()
+
+
+@contextmanager
+def waiting_for_resource() -> Iterator[Callable[[bool], None]]:
+    """
+    Отмечает ожидание общего ресурса внутри call_with_deadline. Отдаёт функцию exempt(flag):
+    пока flag истинен (ресурс занят живым вызовом другого диалога), бюджеты вызова и диалога не расходуются,
+    а ожидание ограничено SAP_QUEUE_TIMEOUT и остатком бюджета диалога. Если ресурс держит брошенный
+    (отменённый) вызов, ожидание засчитывается как работа. Вне call_with_deadline ничего не делает.
+    """
+    clock: Optional[_CallClock] = getattr(_local, "clock", None)
+    if clock is None:
+        yield lambda flag: None
+        return
+
+    def exempt(flag: bool):
+        if flag and not clock.waiting():
+            clock.begin_wait()
+        elif not flag:
+            clock.end_wait()
+
+    try:
+        yield exempt
+    finally:
+        clock.end_wait()
+
+
+def tool_budget(tool: str) -> float:
+    """Бюджет инструмента в секундах."""
+    env = os.getenv(f"SAP_DEADLINE_{tool.upper()}")
+    return float(env) if env else float(DEFAULT_TOOL_BUDGETS.get(tool, 120))
+
+
+class DialogBudget:
+    """Общий бюджет времени на диалог (SAP_DIALOG_DEADLINE, по умолчанию 15 минут)."""
+
+    def __init__(self, seconds: Optional[float] = None):
+        self.seconds = float(seconds if seconds is not None else os.getenv("SAP_DIALOG_DEADLINE", "900"))
+        self.started = time.monotonic()
+        self.excluded = 0.0
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started - self.excluded
+
+    def exclude(self, seconds: float):
+        """Не засчитывать время ожидания в очереди (свободной сессии SAP, слота LLM)."""
+        self.excluded += max(0.0, seconds)
+
+    def remaining(self) -> float:
+        return self.seconds - self.elapsed()
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def clamp(self, seconds: float) -> float:
+        """Бюджет вызова, урезанный до остатка бюджета диалога."""
+        return max(0.0, min(seconds, self.remaining()))
+
+
+def deadline_error(tool: str, budget: float, elapsed: float, message: str,
+                   recovery: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Структурированная ошибка превышения бюджета — возвращается модели вместо результата инструмента."""
+    err = {
+        "status": False,
+        "error": "deadline_exceeded",
+        "tool": tool,
+        "budget_s": round(budget, 1),
+        "elapsed_s": round(elapsed, 1),
+        "message": message,
+        "result": "Ошибка выполнения",
+    }
+    if recovery is not None:
+        err["recovery"] = recovery
+    return err
+
+
+def is_deadline_error(result: Any) -> bool:
+    """Результат инструмента — это ошибка превышения бюджета."""
+    return isinstance(result, dict) and result.get("error") == "deadline_exceeded"
+
+
+def call_with_deadline(
+    tool: str,
+    fn: Callable[..., Any],
+    *args,
+    budget: Optional[float] = None,
+    dialog: Optional[DialogBudget] = None,
+    on_timeout: Optional[Callable[[], Dict[str, Any]]] = None,
+    **kwargs,
+) -> Any:
+    """
+    Выполняет fn в отдельном потоке и ждёт не дольше бюджета инструмента (и остатка бюджета диалога).
+    Ожидание сессии, занятой живым вызовом другого диалога (waiting_for_resource), в бюджет не входит
+    и вычитается из бюджета диалога; ожидание за брошенным вызовом расходует оба бюджета.
+    При превышении вызывает on_timeout (восстановление сессии SAP) и возвращает deadline_error.
+    Зависший поток не убить, но ему выставляется событие отмены (current_cancel_event).
+    """
+    limit = budget if budget is not None else tool_budget(tool)
+    if dialog is not None:
+        if dialog.expired():
+            return deadline_error(tool, 0.0, 0.0,
+                                  "Бюджет времени диалога исчерпан — инструмент не выполнялся. Сформируй финальный ответ.")
+        limit = dialog.clamp(limit)
+
+    cancel = threading.Event()
+    clock = _CallClock(min(QUEUE_TIMEOUT, dialog.remaining()) if dialog is not None else QUEUE_TIMEOUT)
+    done, outcome = _run_in_thread(fn, args, kwargs, limit, cancel, clock)
+    if dialog is not None:
+        dialog.exclude(clock.total_waited())
+    if not done:
+        cancel.set()
+        if clock.waiting():
+            return deadline_error(
+                tool, limit, clock.active(),
+                f"Инструмент {tool} не выполнялся: все сессии SAP GUI заняты дольше {clock.queue_limit:.0f} с.",
+            )
+        recovery = None
+        if on_timeout is not None:
+            # Восстановление тоже может зависнуть на занятой сессии — ограничиваем и его
+            rec_done, rec = _run_in_thread(on_timeout, (), {}, RECOVERY_TIMEOUT, None)
+            if not rec_done:
+                recovery = {"error": "восстановление сессии не завершилось вовремя"}
+            elif "error" in rec:
+                recovery = {"error": str(rec["error"])}
+            else:
+                recovery = rec.get("value")
+        return deadline_error(
+            tool, limit, clock.active(),
+            f"Инструмент {tool} не уложился в {limit:.1f} с и был прерван. "
+            "Упрости запрос (фильтры, LIMIT) или выбери другой путь.",
+            recovery,
+        )
+    if "error" in outcome:
+        raise outcome["error"]
+    return outcome.get("value")
+
+
+def _run_in_thread(fn: Callable[..., Any], args, kwargs, timeout: float,
+                   cancel: Optional[threading.Event], clock: Optional[_CallClock] = None):
+    """
+    Выполняет fn в пуле потоков инструментов; возвращает (успел ли завершиться, {"value"|"error": ...}).
+    С clock срок отсчитывается по времени работы: ожидание ресурса ограничено clock.queue_limit.
+    """
+    outcome: Dict[str, Any] = {}
+    finished = threading.Event()
+
+    def runner():
+        _local.cancel = cancel
+        _local.clock = clock
+        try:
+            outcome["value"] = fn(*args, **kwargs)
+        except BaseException as e:
+            outcome["error"] = e
+        finally:
+            _local.cancel = None
+            _local.clock = None
+            finished.set()
+
+    _submit(runner)
+    if clock is None:
+        return finished.wait(timeout), outcome
+    while True:
+        if clock.waiting():
+            left = clock.queue_limit - clock.total_waited()
+        else:
+            left = timeout - clock.active()
+        if left <= 0:
+            return finished.is_set(), outcome
+        if finished.wait(min(left, 0.25)):
+            return True, outcome
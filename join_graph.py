@@ -0,0 +1,354 @@
+# join_graph.py
+# Граф связей таблиц SAP по внешним ключам (DD08L/DD05S + CHECKTABLE из DD03M)
+import heapq
+import json
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from utils import clipboard_records
+
+# Связи документопотока, которых нет в DDIC как внешних ключей (ссылки VGBEL/VGPOS, AUBEL/AUPOS)
+DOCUMENT_FLOW_EDGES: List[Tuple[str, str, List[Tuple[str, str]]]] = [
+    ("LIPS", "VBAP", [("VGBEL", "VBELN"), ("VGPOS", "POSNR")]),
+    ("VBRP", "LIPS", [("VGBEL", "VBELN"), ("VGPOS", "POSNR")]),
+    ("VBRP", "VBAP", [("AUBEL", "VBELN"), ("AUPOS", "POSNR")]),
+    ("LIPS", "LIKP", [("VBELN", "VBELN")]),
+    ("VBRP", "VBRK", [("VBELN", "VBELN")]),
+    ("VBAP", "VBAK", [("VBELN", "VBELN")]),
+    ("EKPO", "EKKO", [("EBELN", "EBELN")]),
+    ("EKBE", "EKPO", [("EBELN", "EBELN"), ("EBELP", "EBELP")]),
+]
+
+# Вес ребра: полные связи из DD05S дешевле, чем CHECKTABLE без пар полей
+EDGE_WEIGHTS = {"dd05s": 1.0, "builtin": 1.0, "dd03m": 2.0}
+
+# Ограничения на расширение графа из SAP
+MAX_FRONTIER = 40
+MAX_FK_ROWS = 5000
+# Сколько страниц по MAX_FK_ROWS догружать для одной таблицы (обратные связи MARA, T001 — тысячи строк)
+MAX_FK_PAGES = 5
+
+
+class JoinGraph:
+    """
+    Граф внешних ключей, сохраняемый в локальной SQLite.
+    Рёбра догружаются из SAP только для таблиц, которые ещё не были расширены.
+    """
+
+    def __init__(self, db_path: str = "sap_join_graph.sqlite3"):
+        self.db_path = db_path
+        self.conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.RLock()
+
+    def connect(self):
+        if self.conn:
+            return
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._ensure_schema()
+
+    def close(self):
+        if self.conn:
+            try:
+                self.conn.close()
+            finally:
+                self.conn = None
+
+    def _ensure_schema(self):
+        assert self.conn is not None
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS fk_edge (
+                tabname TEXT NOT NULL,
+                fieldname TEXT NOT NULL,
+                checktable TEXT NOT NULL,
+                pairs TEXT NOT NULL,
+                card TEXT,
+                source TEXT NOT NULL CHECK(source IN ('dd05s','dd03m','builtin')),
+                updated_at TEXT NOT NULL,
+                PRIMARY KEY (tabname, fieldname, checktable)
+            );
+        """)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS fk_expanded (
+                tabname TEXT PRIMARY KEY,
+                direction TEXT NOT NULL CHECK(direction IN ('forward','both')),
+                expanded_at TEXT NOT NULL
+            );
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS ix_fk_edge_checktable ON fk_edge(checktable);")
+        for tab, check, pairs in DOCUMENT_FLOW_EDGES:
+            self._put_edge(tab, pairs[0][0], check, pairs, None, "builtin", replace=False)
+        self.conn.commit()
+
+    @staticmethod
+    def _now() -> str:
+        return time.strftime("%Y-%m-%d %H:%M:%S")
+
+    def _put_edge(self, tab: str, field: str, check: str, pairs: List[Tuple[str, Optional[str]]],
+                  card: Optional[str], source: str, replace: bool):
+        assert self.conn is not None
+        verb = "INSERT OR REPLACE" if replace else "INSERT OR IGNORE"
+        self.conn.execute(f"""
+            {verb} INTO fk_edge (tabname, fieldname, checktable, pairs, card, source, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, (tab, field, check, json.dumps(pairs), card, source, self._now()))
+
+    # ===== НАПОЛНЕНИЕ =====
+    def ingest_table_fields(self, table_name: str, clipboard_data: str) -> int:
+        """
+        Добавляет рёбра по CHECKTABLE из результата get_table_fields (DD03M).
+        Пары полей неизвестны, поэтому такие рёбра не перезаписывают связи из DD05S.
+        """
+        tab = table_name.strip().upper()
+        added = 0
+        with self._lock:
+            self.connect()
+            for rec in clipboard_records(clipboard_data):
+                field, check = rec.get("FIELDNAME", ""), rec.get("CHECKTABLE", "").upper()
+                if not field or not check or check == "*" or check == tab:
+                    continue
+                self._put_edge(tab, field, check, [(field, None)], None, "dd03m", replace=False)
+                added += 1
+            self.conn.commit()
+        return added
+
+    @staticmethod
+    def _group_foreign_keys(clipboard_data: str, grouped: Dict[Tuple[str, str, str], Dict[str, Any]]):
+        """
+        Добавляет строки выгрузки DD05S/DD08L (одна строка на пару полей) к связям grouped.
+        Пары ключуются по PRIMPOS: связь, разрезанная границей страницы или повторённая
+        в соседней выгрузке, собирается целиком и без повторов.
+        """
+        for rec in clipboard_records(clipboard_data):
+            tab, field = rec.get("TABNAME", "").upper(), rec.get("FIELDNAME", "")
+            check, fortable = rec.get("CHECKTABLE", "").upper(), rec.get("FORTABLE", "").upper()
+            # Константы и обобщённые ('*') ссылки для соединений не годятся
+            if not tab or not check or fortable != tab:
+                continue
+            item = grouped.setdefault((tab, field, check), {"pairs": {}, "card": None})
+            item["card"] = item["card"] or rec.get("CARD") or None
+            pos = rec.get("PRIMPOS") or str(len(item["pairs"]))
+            item["pairs"][pos] = (rec.get("FORKEY", ""), rec.get("CHECKFIELD", ""))
+
+    def _save_foreign_keys(self, grouped: Dict[Tuple[str, str, str], Dict[str, Any]]):
+        with self._lock:
+            self.connect()
+            for (tab, field, check), item in grouped.items():
+                pairs = [item["pairs"][pos] for pos in sorted(item["pairs"])]
+                self._put_edge(tab, field, check, pairs, item["card"], "dd05s", replace=True)
+            self.conn.commit()
+
+    def ingest_foreign_keys(self, clipboard_data: str) -> int:
+        """Сохраняет связи из выгрузки DD05S/DD08L (одна строка на пару полей)."""
+        grouped: Dict[Tuple[str, str, str], Dict[str, Any]] = {}
+        self._group_foreign_keys(clipboard_data, grouped)
+        self._save_foreign_keys(grouped)
+        return len(grouped)
+
+    def _unexpanded(self, tables: Iterable[str], reverse: bool) -> List[str]:
+        assert self.conn is not None
+        sql = "SELECT tabname FROM fk_expanded"
+        if reverse:
+            sql += " WHERE direction = 'both'"
+        done = {r[0] for r in self.conn.execute(sql)}
+        return sorted({t for t in tables if t not in done})
+
+    def _load_foreign_keys(self, tables: List[str], reverse: bool, grouped: Dict[Tuple[str, str, str], Dict[str, Any]],
+                           offset: int = 0) -> Optional[bool]:
+        """
+        Одна выгрузка DD05S/DD08L (до MAX_FK_ROWS строк, начиная с offset), связи добавляются к grouped.
+        True — выгружено всё, False — упёрлись в MAX_FK_ROWS, None — запрос не выполнился.
+        """
+        from sap_tools import run_sap_sql_query
+
+        in_list = ",".join("'" + t.replace("'", "''") + "'" for t in tables)
+        where = f"S.TABNAME IN ({in_list})"
+        if reverse:
+            where = f"({where} OR S.CHECKTABLE IN ({in_list}))"
+        sql = f"""
+        SELECT S.TABNAME, S.FIELDNAME, S.CHECKTABLE, S.FORTABLE, S.FORKEY, S.CHECKFIELD, S.PRIMPOS, L.CARD
+        FROM DD05S AS S
+        LEFT JOIN DD08L AS L
+          ON L.TABNAME = S.TABNAME AND L.FIELDNAME = S.FIELDNAME
+         AND L.AS4LOCAL = S.AS4LOCAL AND L.AS4VERS = S.AS4VERS
+        WHERE S.AS4LOCAL = 'A' AND {where}
+        ORDER BY S.TABNAME, S.FIELDNAME, S.AS4VERS, S.PRIMPOS
+        LIMIT {MAX_FK_ROWS} OFFSET {offset}
+        """
+        exec_res = run_sap_sql_query(sql)
+        if not exec_res.get("status"):
+            # Пустая страница после полной — значит, выгружено всё
+            return True if offset and exec_res.get("message") == "Данные не найдены" else None
+        result = exec_res.get("result", "")
+        self._group_foreign_keys(result, grouped)
+        return len(clipboard_records(result)) < MAX_FK_ROWS
+
+    def _expand_batch(self, tables: List[str], reverse: bool,
+                      grouped: Dict[Tuple[str, str, str], Dict[str, Any]]) -> Tuple[List[str], List[str]]:
+        """
+        (таблицы, связи которых загружены хотя бы частично; таблицы, загруженные полностью).
+        Усечённая выгрузка делится пополам, одна таблица догружается страницами (до MAX_FK_PAGES).
+        Связи всех выгрузок копятся в grouped и сохраняются вызывающим одним разом.
+        """
+        loaded = self._load_foreign_keys(tables, reverse, grouped)
+        if loaded is None:
+            return [], []
+        if loaded:
+            return tables, tables
+        if len(tables) > 1:
+            half = len(tables) // 2
+            left = self._expand_batch(tables[:half], reverse, grouped)
+            right = self._expand_batch(tables[half:], reverse, grouped)
+            return tables, left[1] + right[1]
+        for page in range(1, MAX_FK_PAGES):
+            loaded = self._load_foreign_keys(tables, reverse, grouped, offset=page * MAX_FK_ROWS)
+            if loaded is None:
+                break
+            if loaded:
+                return tables, tables
+        return tables, []
+
+    def expand(self, tables: Iterable[str], reverse: bool = True) -> List[str]:
+        """
+        Догружает внешние ключи для таблиц SQL-запросами к DD05S/DD08L (обычно одним).
+        reverse=True — также связи, где таблица является проверочной.
+        Расширенными помечаются только таблицы, выгруженные без усечения по MAX_FK_ROWS:
+        остальные будут догружаться снова. Возвращает список таблиц, по которым связи получены.
+        Запросы к SAP идут без блокировки графа: пока они выполняются, другие потоки читают и пополняют граф.
+        """
+        with self._lock:
+            self.connect()
+            todo = self._unexpanded((t.upper() for t in tables), reverse)[:MAX_FRONTIER]
+        if not todo:
+            return []
+        grouped: Dict[Tuple[str, str, str], Dict[str, Any]] = {}
+        loaded, complete = self._expand_batch(todo, reverse, grouped)
+        with self._lock:
+            self._save_foreign_keys(grouped)
+            direction = "both" if reverse else "forward"
+            # Параллельное расширение могло уже пометить таблицу как 'both' — 'forward' его не заменяет
+            verb = "INSERT OR REPLACE" if reverse else "INSERT OR IGNORE"
+            self.conn.executemany(
+                f"{verb} INTO fk_expanded (tabname, direction, expanded_at) VALUES (?, ?, ?)",
+                [(t, direction, self._now()) for t in complete],
+            )
+            self.conn.commit()
+            return loaded
+
+    # ===== ПОИСК ПУТИ =====
+    def _adjacency(self) -> Dict[str, List[Tuple[str, float, Dict[str, Any]]]]:
+        assert self.conn is not None
+        adj: Dict[str, List[Tuple[str, float, Dict[str, Any]]]] = {}
+        for tab, field, check, pairs, card, source in self.conn.execute(
+            "SELECT tabname, fieldname, checktable, pairs, card, source FROM fk_edge"
+        ):
+            edge = {"table": tab, "field": field, "checktable": check,
+                    "pairs": json.loads(pairs), "card": card, "source": source}
+            weight = EDGE_WEIGHTS.get(source, 2.0)
+            adj.setdefault(tab, []).append((check, weight, edge))
+            adj.setdefault(check, []).append((tab, weight, edge))
+        return adj
+
+    @staticmethod
+    def _steiner_paths(adj, terminals: List[str]) -> Tuple[List[Dict[str, Any]], List[str]]:
+        """
+        Приближённое дерево Штейнера: к дереву по очереди присоединяется
+        ближайшая ещё не связанная таблица (многоисточниковый Дейкстра от дерева).
+        """
+        tree: Set[str] = {terminals[0]}
+        remaining = [t for t in terminals[1:] if t != terminals[0]]
+        used: List[Dict[str, Any]] = []
+        while remaining:
+            dist = {n: 0.0 for n in tree}
+            prev: Dict[str, Tuple[str, Dict[str, Any]]] = {}
+            heap = [(0.0, n) for n in tree]
+            heapq.heapify(heap)
+            target = None
+            while heap:
+                d, node = heapq.heappop(heap)
+                if d > dist.get(node, float("inf")):
+                    continue
+                if node in remaining:
+                    target = node
+                    break
+                for nxt, w, edge in adj.get(node, []):
+                    nd = d + w
+                    if nd < dist.get(nxt, float("inf")):
+                        dist[nxt] = nd
+                        prev[nxt] = (node, edge)
+                        heapq.heappush(heap, (nd, nxt))
+            if target is None:
+                break
+            node = target
+            while node not in tree:
+                parent, edge = prev[node]
+                used.append(edge)
+                tree.add(node)
+                node = parent
+            remaining.remove(target)
+        return used, remaining
+
+    def find_join_path(self, tables: List[str], expand_depth: int = 2) -> Dict[str, Any]:
+        """
+        Возвращает кратчайший набор соединений между таблицами и поля соединения.
+        При необходимости догружает связи из SAP (не более expand_depth уровней).
+        """
+        terminals = list(dict.fromkeys(t.strip().upper() for t in tables if t and t.strip()))
+        if len(terminals) < 2:
+            return {"status": False, "message": "Нужно минимум две таблицы", "joins": []}
+
+        with self._lock:
+            self.connect()
+            adj = self._adjacency()
+        edges, missing = self._steiner_paths(adj, terminals)
+        frontier: List[str] = list(terminals)
+        for level in range(expand_depth):
+            if not missing:
+                break
+            expanded = self.expand(frontier, reverse=(level == 0))
+            with self._lock:
+                adj = self._adjacency()
+            edges, missing = self._steiner_paths(adj, terminals)
+            # Следующий уровень — только прямые внешние ключи соседей (обратных может быть тысячи)
+            frontier = sorted({n for t in expanded for n, _, _ in adj.get(t, [])} - set(expanded))
+
+        joins = []
+        for e in edges:
+            on = [
+                f"{e['table']}.{fk} = {e['checktable']}.{ck}"
+                for fk, ck in e["pairs"] if fk and ck
+            ]
+            join = {
+                "left": e["table"],
+                "right": e["checktable"],
+                "on": " AND ".join(on) if on else None,
+                "fields": e["pairs"],
+                "cardinality": e["card"],
+                "source": e["source"],
+            }
+            if not on:
+                # CHECKTABLE из DD03M: поле проверочной таблицы неизвестно, чаще всего оно одноимённое
+                field = e["pairs"][0][0] if e["pairs"] else e["field"]
+                join["on_hint"] = f"{e['table']}.{field} = {e['checktable']}.{field}"
+                join["note"] = ("Поля соединения неизвестны (только CHECKTABLE из DD03M): on_hint — предположение "
+                                "по одноимённому полю, проверь ключ проверочной таблицы через get_table_fields")
+            joins.append(join)
+        result = {"status": not missing, "tables": terminals, "joins": joins}
+        if missing:
+            result["message"] = f"Не найден путь до таблиц: {', '.join(missing)}"
+            result["unreachable"] = missing
+        return result
+
+
+_graph: Optional[JoinGraph] = None
+_graph_lock = threading.Lock()
+
+def get_join_graph() -> JoinGraph:
+    """Общий для процесса экземпляр графа связей."""
+    global _graph
+    with _graph_lock:
+        if _graph is None:
+            _graph = JoinGraph()
+            _graph.connect()
+        return _graph
@@ -0,0 +1,349 @@
+# llm_client.py
+# Общий для процесса клиент LLM: пул HTTP-соединений, удержание модели в памяти Ollama, размер контекста
+import importlib.util
+import json
+import os
+import queue
+import threading
+import time
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from deadlines import DeadlineExceeded
+
+if TYPE_CHECKING:  # openai и httpx импортируются при создании клиента
+    import httpx
+    from openai import OpenAI
+
+# Грубая оценка: кириллица + JSON-схема дают около 3 символов на токен
+CHARS_PER_TOKEN = 3.0
+# Запас контекста под ответ модели
+REPLY_RESERVE_TOKENS = 4096
+# num_ctx растёт ступенями: каждая смена num_ctx перезагружает модель и сбрасывает KV-кэш
+NUM_CTX_STEP = 8192
+# Запас при прогреве на вопрос и первые результаты: первый ход не должен требовать большего num_ctx
+FIRST_TURN_TOKENS = 2048
+
+_clients: Dict[Tuple[str, str], "OpenAI"] = {}
+_http_clients: Dict[Tuple[str, str], "httpx.Client"] = {}
+# Нативный API Ollama для клиента: id(OpenAI-клиента) -> (тот же пул соединений, корневой URL сервера,
+# заголовки с ключом). Сервер без /api/chat (404) отсюда удаляется, дальше запросы идут в /v1.
+_native: Dict[int, Tuple["httpx.Client", str, Dict[str, str]]] = {}
+_num_ctx: Dict[str, int] = {}
+_lock = threading.Lock()
+# Ограничение одновременных запросов к LLM (LLM_MAX_CONCURRENCY или set_concurrency; None — без ограничения)
+_request_slots: Optional[threading.BoundedSemaphore] = (
+    threading.BoundedSemaphore(int(os.environ["LLM_MAX_CONCURRENCY"])) if os.getenv("LLM_MAX_CONCURRENCY") else None
+)
+
+
+def set_concurrency(limit: Optional[int]):
+    """Задаёт число одновременных запросов к LLM для процесса (пакетный режим); None или 0 — без ограничения."""
+    global _request_slots
+    _request_slots = threading.BoundedSemaphore(limit) if limit else None
+
+
+def _http2_enabled() -> bool:
+    """HTTP/2 включается, только если установлен пакет h2 (httpx[http2])."""
+    return os.getenv("LLM_HTTP2", "1") != "0" and importlib.util.find_spec("h2") is not None
+
+
+def get_client(base_url: str, api_key: Optional[str] = None) -> "OpenAI":
+    """
+    Возвращает OpenAI-клиент, общий для всех диалогов процесса.
+    Соединения переиспользуются (keep-alive пул), SSL-проверка отключена, как и раньше.
+    """
+    import httpx
+    from openai import OpenAI
+
+    key = (base_url.rstrip("/"), api_key or "ollama")
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            http_client = httpx.Client(
+                verify=False,
+                http2=_http2_enabled(),
+                limits=httpx.Limits(
+                    max_connections=int(os.getenv("LLM_MAX_CONNECTIONS", "8")),
+                    max_keepalive_connections=int(os.getenv("LLM_MAX_CONNECTIONS", "8")),
+                    keepalive_expiry=float(os.getenv("LLM_KEEPALIVE_EXPIRY", "300")),
+                ),
+            )
+            client = OpenAI(base_url=key[0] + "/v1", api_key=key[1], http_client=http_client)
+            _clients[key] = client
+            _http_clients[key] = http_client
+            _native[id(client)] = (http_client, key[0], {"Authorization": f"Bearer {key[1]}"})
+        return client
+
+
+def estimate_tokens(messages: List[Dict[str, str]]) -> int:
+    """Оценка длины промпта в токенах по числу символов."""
+    return int(sum(len(m.get("content") or "") for m in messages) / CHARS_PER_TOKEN) + 1
+
+
+def size_num_ctx(model: str, messages: List[Dict[str, str]], headroom_tokens: int = 0) -> int:
+    """
+    Подбирает num_ctx по измеренной длине промпта.
+    Значение для модели только растёт, чтобы соседние запросы не вызывали перезагрузку модели.
+    OLLAMA_NUM_CTX задаёт фиксированное значение, OLLAMA_NUM_CTX_MAX — верхнюю границу.
+    """
+    fixed = os.getenv("OLLAMA_NUM_CTX")
+    if fixed:
+        return int(fixed)
+    ceiling = int(os.getenv("OLLAMA_NUM_CTX_MAX", "32768"))
+    needed = estimate_tokens(messages) + REPLY_RESERVE_TOKENS + headroom_tokens
+    stepped = -(-needed // NUM_CTX_STEP) * NUM_CTX_STEP
+    with _lock:
+        value = min(max(stepped, _num_ctx.get(model, NUM_CTX_STEP)), ceiling)
+        _num_ctx[model] = value
+    return value
+
+
+def ollama_extra_body(model: str, messages: List[Dict[str, str]], headroom_tokens: int = 0) -> Dict[str, Any]:
+    """
+    Дополнительные поля запроса для Ollama: keep_alive держит модель загруженной между диалогами,
+    а неизменный num_ctx позволяет переиспользовать KV-кэш общего префикса (SYSTEM_PROMPT).
+    С этими полями запрос идёт в нативный /api/chat: /v1/chat/completions размер контекста не меняет.
+    Сервер без /api/chat (404) автоматически переводится на /v1/chat/completions.
+    Для других OpenAI-совместимых серверов отключается через LLM_OLLAMA_OPTIONS=0 — тогда размер
+    контекста задаётся на стороне Ollama (OLLAMA_CONTEXT_LENGTH или PARAMETER num_ctx в Modelfile).
+    """
+    if os.getenv("LLM_OLLAMA_OPTIONS", "1") == "0":
+        return {}
+    return {
+        "keep_alive": os.getenv("OLLAMA_KEEP_ALIVE", "30m"),
+        "options": {"num_ctx": size_num_ctx(model, messages, headroom_tokens)},
+    }
+
+
+def warm_up(base_url: str, model: str, system_prompt: str, api_key: Optional[str] = None) -> bool:
+    """
+    Загружает модель в Ollama через тот же нативный /api/chat и с теми же keep_alive и num_ctx, что и рабочие
+    запросы (num_ctx оценивается с запасом на первый вопрос), и прогоняет системный промпт, чтобы его
+    KV-кэш был готов к первому ходу диалога. Для серверов без /api/chat просто возвращает False.
+    """
+    client = get_client(base_url, api_key)
+    native = _native.get(id(client))
+    if native is None:
+        return False
+    http_client, root, headers = native
+    messages = [{"role": "system", "content": system_prompt}]
+    extra = ollama_extra_body(model, messages, headroom_tokens=FIRST_TURN_TOKENS)
+    if not extra:
+        return False
+    body = {"model": model, "messages": messages, "stream": False, **extra}
+    body["options"] = {**extra["options"], "num_predict": 1}
+    try:
+        resp = http_client.post(root + "/api/chat", json=body, headers=headers, timeout=300)
+        if resp.status_code == 404 and not _is_ollama_error(resp):
+            _native.pop(id(client), None)
+        return resp.status_code == 200
+    except Exception:
+        return False
+
+
+def _acquire_slot(slots: threading.BoundedSemaphore, cancel: Optional[threading.Event]) -> bool:
+    """Ждёт слот запроса; False — запрос отменён, пока ждал."""
+    while not slots.acquire(timeout=0.2):
+        if cancel is not None and cancel.is_set():
+            return False
+    return True
+
+
+def iter_chat_deltas(
+    client: "OpenAI",
+    model: str,
+    messages: List[Dict[str, str]],
+    timeout: Any = 180,
+    extra_body: Optional[Dict[str, Any]] = None,
+    cancel: Optional[threading.Event] = None,
+    on_start: Optional[Callable[[], None]] = None,
+) -> Iterator[str]:
+    """
+    Потоковый запрос chat.completions, отдаёт фрагменты текста ответа.
+    Поток SSE дочитывается до конца: иначе httpx закрывает соединение и пул не переиспользуется.
+    При ограничении одновременных запросов слот занимается на всё время ответа.
+    on_start вызывается, когда слот получен и запрос уходит на сервер; отменённый (cancel) запрос
+    не отправляется.
+    """
+    slots = _request_slots
+    if slots is not None and not _acquire_slot(slots, cancel):
+        return
+    try:
+        if cancel is not None and cancel.is_set():
+            return
+        if on_start is not None:
+            on_start()
+        native = _native.get(id(client))
+        if native is not None and extra_body and "options" in extra_body:
+            try:
+                yield from _iter_native_deltas(*native, model, messages, timeout, extra_body)
+                return
+            except _NativeUnavailable:
+                # Не Ollama (или прокси без /api/chat): этот и следующие запросы — через /v1/chat/completions
+                _native.pop(id(client), None)
+        with client.chat.completions.with_streaming_response.create(
+            model=model,
+            messages=messages,
+            stream=True,
+            timeout=timeout,
+            extra_body=extra_body or None,
+        ) as response:
+            for line in response.iter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if not data or data == "[DONE]":
+                    continue
+                chunk = json.loads(data)
+                if chunk.get("error"):
+                    raise RuntimeError(str(chunk["error"]))
+                for choice in chunk.get("choices") or []:
+                    content = (choice.get("delta") or {}).get("content")
+                    if content:
+                        yield content
+    finally:
+        if slots is not None:
+            slots.release()
+
+
+class _NativeUnavailable(Exception):
+    """Сервер не поддерживает нативный /api/chat (HTTP 404) — ответ ещё не начат."""
+
+
+def _is_ollama_error(response: "httpx.Response") -> bool:
+    """404 от самой Ollama (например, модель не найдена): тело — {"error": "<текст>"}."""
+    try:
+        return isinstance(response.json().get("error"), str)
+    except Exception:
+        return False
+
+
+def _iter_native_deltas(
+    http_client: "httpx.Client",
+    root: str,
+    headers: Dict[str, str],
+    model: str,
+    messages: List[Dict[str, str]],
+    timeout: Any,
+    extra_body: Dict[str, Any],
+) -> Iterator[str]:
+    """Потоковый ответ нативного /api/chat Ollama (NDJSON), учитывающего options.num_ctx и keep_alive."""
+    body = {"model": model, "messages": messages, "stream": True, **extra_body}
+    with http_client.stream("POST", root + "/api/chat", json=body, headers=headers, timeout=timeout) as response:
+        if response.status_code == 404:
+            response.read()
+            if not _is_ollama_error(response):
+                raise _NativeUnavailable()
+        if response.status_code != 200:
+            response.read()
+            raise RuntimeError(f"Ollama /api/chat: HTTP {response.status_code}: {response.text[:500]}")
+        for line in response.iter_lines():
+            if not line.strip():
+                continue
+            chunk = json.loads(line)
+            if chunk.get("error"):
+                raise RuntimeError(str(chunk["error"]))
+            content = (chunk.get("message") or {}).get("content")
+            if content:
+                yield content
+
+
+def iter_chat_deltas_hedged(
+    client: "OpenAI",
+    model: str,
+    messages: List[Dict[str, str]],
+    timeout: Any = 180,
+    extra_body: Optional[Dict[str, Any]] = None,
+    deadline: Optional[float] = None,
+    hedge_after: Optional[float] = None,
+    stats: Optional[Dict[str, Any]] = None,
+) -> Iterator[str]:
+    """
+    Как iter_chat_deltas, но с общим сроком ответа и страховочным (hedged) запросом:
+    если первый токен не пришёл за hedge_after секунд (LLM_HEDGE_AFTER, 0 — выключено),
+    отправляется второй такой же запрос; используется тот, что первым начал отвечать.
+    По истечении deadline секунд бросает DeadlineExceeded.
+    Оба срока отсчитываются с момента, когда запрос получил слот (LLM_MAX_CONCURRENCY): ожидание
+    в очереди не считается. В stats["queue_ms"] пишется время этого ожидания.
+    """
+    if hedge_after is None:
+        hedge_after = float(os.getenv("LLM_HEDGE_AFTER", "0"))
+    queued = time.monotonic()
+
+    def record_queue():
+        if stats is not None and "queue_ms" not in stats:
+            stats["queue_ms"] = round((time.monotonic() - queued) * 1000)
+
+    if not hedge_after and not deadline:
+        yield from iter_chat_deltas(client, model, messages, timeout=timeout, extra_body=extra_body,
+                                    on_start=record_queue)
+        return
+
+    events: "queue.Queue[Tuple[int, str, Any]]" = queue.Queue()
+    cancels: List[threading.Event] = []
+
+    def attempt(idx: int, cancel: threading.Event):
+        try:
+            for delta in iter_chat_deltas(client, model, messages, timeout=timeout, extra_body=extra_body,
+                                          cancel=cancel, on_start=lambda: events.put((idx, "started", None))):
+                if cancel.is_set():
+                    return
+                events.put((idx, "delta", delta))
+            events.put((idx, "done", None))
+        except Exception as e:
+            events.put((idx, "error", e))
+
+    def launch():
+        cancel = threading.Event()
+        cancels.append(cancel)
+        threading.Thread(target=attempt, args=(len(cancels) - 1, cancel),
+                         name=f"llm-attempt-{len(cancels)}", daemon=True).start()
+
+    # Сроки начинают идти, когда первая попытка получила слот
+    started: Optional[float] = None
+    end: Optional[float] = None
+    winner: Optional[int] = None
+    failed: Dict[int, Exception] = {}
+    launch()
+    try:
+        while True:
+            waits = []
+            if end is not None:
+                waits.append(end - time.monotonic())
+            hedge_pending = winner is None and len(cancels) == 1 and hedge_after and started is not None
+            if hedge_pending:
+                waits.append(started + hedge_after - time.monotonic())
+            try:
+                idx, kind, payload = events.get(timeout=max(0.0, min(waits)) if waits else None)
+            except queue.Empty:
+                if end is not None and time.monotonic() >= end:
+                    raise DeadlineExceeded(f"LLM не ответил за {deadline:.0f} с")
+                if hedge_pending:
+                    launch()
+                continue
+            if kind == "started":
+                if started is None:
+                    started = time.monotonic()
+                    end = started + deadline if deadline else None
+                    record_queue()
+                continue
+            if winner is not None and idx != winner:
+                continue
+            if kind == "delta":
+                if winner is None:
+                    winner = idx
+                    for i, c in enumerate(cancels):
+                        if i != idx:
+                            c.set()
+                yield payload
+            elif kind == "done":
+                return
+            else:
+                failed[idx] = payload
+                # Ошибка одной из попыток не фатальна, пока другая ещё может ответить
+                if winner is None and len(failed) < len(cancels):
+                    continue
+                raise payload
+    finally:
+        for c in cancels:
+            c.set()
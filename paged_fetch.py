@@ -0,0 +1,192 @@
+# paged_fetch.py
+# Постраничная выгрузка больших результатов: запрос делится на страницы (OFFSET или по ключу),
+# каждая страница сразу пишется в файл, в памяти держится только текущая
+import os
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from probe_batcher import prepare_probe
+from result_store import persist_query_result
+from sql_validator import strip_comments, tokenize, top_level_words
+from utils import format_clipboard_table, parse_clipboard_table
+
+# Сколько первых строк выгрузки показывать модели
+PREVIEW_ROWS = 50
+
+
+class PageFetchError(RuntimeError):
+    """Страница не выгрузилась; exec_res — ответ run_sap_sql_query для неё."""
+
+    def __init__(self, message: str, exec_res: Dict[str, Any]):
+        super().__init__(message)
+        self.exec_res = exec_res
+
+
+def page_size() -> int:
+    """Размер страницы финального запроса (SAP_FINAL_PAGE_SIZE, 0 — постраничная выгрузка выключена)."""
+    return max(0, int(os.getenv("SAP_FINAL_PAGE_SIZE", "0")))
+
+
+def max_rows() -> Optional[int]:
+    """Предел строк постраничной выгрузки (SAP_FINAL_MAX_ROWS, 0 — без предела)."""
+    value = int(os.getenv("SAP_FINAL_MAX_ROWS", "0"))
+    return value if value > 0 else None
+
+
+def _literal(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+def can_page(sql: str) -> bool:
+    """
+    Можно ли выгрузить запрос страницами: к нему дописываются ORDER BY/LIMIT/OFFSET, поэтому
+    запросы, которые сами ограничивают строки (TOP, LIMIT, OFFSET, FETCH FIRST), и неразобранный SQL — нельзя.
+    """
+    try:
+        tokens = tokenize(strip_comments(sql).rstrip(";"))
+    except ValueError:
+        return False
+    return bool(tokens) and not ({"TOP", "LIMIT", "OFFSET", "FETCH"} & set(top_level_words(tokens)))
+
+
+def offset_page_sql(sql: str, ncols: int, limit: int, offset: int) -> str:
+    """
+    Страница по OFFSET: LIMIT/OFFSET дописываются к самому запросу. Его ORDER BY сохраняется и дополняется
+    всеми колонками (порядковыми номерами) как тайбрейкером — порядок строк одинаков между выполнениями,
+    иначе страницы могли бы пересекаться или терять строки. Каждая страница заново выполняет запрос
+    с сортировкой; для очень больших выгрузок дешевле постраничность по ключу (key_column).
+    """
+    text = strip_comments(sql).rstrip(";").strip()
+    order = ", ".join(str(i) for i in range(1, ncols + 1))
+    if "ORDER" in top_level_words(tokenize(text)):
+        return f"{text}, {order} LIMIT {limit} OFFSET {offset}"
+    return f"{text} ORDER BY {order} LIMIT {limit} OFFSET {offset}"
+
+
+def keyset_page_sql(sql: str, key_column: str, limit: int, after: Optional[str]) -> str:
+    """
+    Страница по ключу: строки после последнего значения уникальной колонки (строковое сравнение).
+    Фильтр по ключу отсекает уже выгруженное, но порядок строк — по ключу, а не по ORDER BY запроса.
+    """
+    text = strip_comments(sql).rstrip(";").strip()
+    where = f" WHERE Q.{key_column} > {_literal(after)}" if after is not None else ""
+    return f"SELECT * FROM (\n{text}\n) AS Q{where} ORDER BY Q.{key_column} LIMIT {limit}"
+
+
+def _column_count(sql: str, execute: Callable[[str], Dict[str, Any]]) -> Optional[int]:
+    """
+    Число колонок результата: по списку SELECT, а для SELECT * и WITH — пробой на одну строку
+    (None — строк нет).
+    """
+    prepared = prepare_probe(sql, 0)
+    if prepared is not None:
+        return len(prepared[1])
+    exec_res = execute(f"{strip_comments(sql).rstrip(';').strip()} LIMIT 1")
+    if exec_res.get("status"):
+        return len(parse_clipboard_table(exec_res.get("result", ""))[0])
+    if exec_res.get("message") == "Данные не найдены":
+        return None
+    raise PageFetchError(exec_res.get("message", "Ошибка выполнения"), exec_res)
+
+
+def iter_pages(
+    sql: str,
+    execute: Callable[[str], Dict[str, Any]],
+    size: int,
+    limit: Optional[int] = None,
+    key_column: Optional[str] = None,
+    progress: Optional[Callable[[int, int], None]] = None,
+) -> Iterator[Tuple[List[str], List[List[str]]]]:
+    """
+    Выполняет запрос страницами по size строк и отдаёт пачки (колонки, строки) по мере получения.
+    limit — предел строк всего; key_column — постраничность по ключу вместо OFFSET;
+    progress(страниц, строк) вызывается после каждой страницы. Ошибка страницы — PageFetchError.
+    """
+    sql = sql.strip().rstrip(";")
+    ncols = None
+    if key_column is None:
+        ncols = _column_count(sql, execute)
+        if ncols is None:
+            return
+    fetched, pages, after = 0, 0, None
+    while limit is None or fetched < limit:
+        want = size if limit is None else min(size, limit - fetched)
+        if key_column is None:
+            page_sql = offset_page_sql(sql, ncols, want, fetched)
+        else:
+            page_sql = keyset_page_sql(sql, key_column, want, after)
+        exec_res = execute(page_sql)
+        if not exec_res.get("status"):
+            if exec_res.get("message") == "Данные не найдены":
+                return
+            raise PageFetchError(exec_res.get("message", "Ошибка выполнения"), exec_res)
+        columns, rows = parse_clipboard_table(exec_res.get("result", ""))
+        if not rows:
+            return
+        if key_column is not None:
+            if key_column.upper() not in columns:
+                raise PageFetchError(f"Колонки {key_column} нет в результате", exec_res)
+            after = rows[-1][columns.index(key_column.upper())]
+        fetched += len(rows)
+        pages += 1
+        if progress is not None:
+            progress(pages, fetched)
+        yield columns, rows
+        if len(rows) < want:
+            return
+
+
+def fetch_to_file(
+    db,
+    sql: str,
+    execute: Callable[[str], Dict[str, Any]],
+    store,
+    size: int,
+    limit: Optional[int] = None,
+    key_column: Optional[str] = None,
+    progress: Optional[Callable[[int, int], None]] = None,
+    kind: str = "final",
+) -> Dict[str, Any]:
+    """
+    Постраничная выгрузка в TSV через ResultStore с регистрацией в dialog_result.
+    Возвращает результат в формате run_sap_sql_query (в result — первые PREVIEW_ROWS строк) и result_id.
+    Если выгрузка оборвалась посреди, уже полученные строки сохраняются и об этом сказано в message.
+    Запрос, который нельзя делить на страницы (can_page), выполняется целиком одним вызовом.
+    """
+    if key_column is None and not can_page(sql):
+        exec_res = execute(sql)
+        return {**exec_res, "result_id": persist_query_result(db, kind, sql, exec_res, store)}
+
+    state: Dict[str, Any] = {"pages": 0, "preview": [], "error": None}
+
+    def batches():
+        try:
+            for columns, rows in iter_pages(sql, execute, size, limit, key_column, progress):
+                state["pages"] += 1
+                if len(state["preview"]) < PREVIEW_ROWS:
+                    state["preview"].extend(rows[:PREVIEW_ROWS - len(state["preview"])])
+                yield columns, rows
+        except PageFetchError as e:
+            state["error"] = e
+
+    path, fmt, columns, total = store.save_batches(batches())
+    error: Optional[PageFetchError] = state["error"]
+    if not columns:
+        os.remove(path)
+        if error is not None:
+            return {**error.exec_res, "result_id": None}
+        return {"status": False, "message": "Данные не найдены", "result": "", "result_id": None}
+
+    result_id = db.log_result(kind, sql, path, fmt, total, columns)
+    message = f"Постраничная выгрузка: {total} строк, страниц {state['pages']}, файл {path}"
+    if error is not None:
+        message += f". Выгрузка прервана: {error} — сохранены только полученные строки"
+    elif limit is not None and total >= limit:
+        message += f". Достигнут предел {limit} строк — результат может быть неполным"
+    if total > len(state["preview"]):
+        message += f". Показаны первые {len(state['preview'])} строк, остальные — через query_local_result"
+    return {
+        "status": True,
+        "message": message,
+        "result": format_clipboard_table(columns, state["preview"]),
+        "result_id": result_id,
+    }
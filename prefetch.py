@@ -0,0 +1,182 @@
+# prefetch.py
+# Спекулятивная подгрузка метаданных SAP, пока LLM генерирует следующий шаг
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+
+from utils import clipboard_records
+
+# Домены, тексты которых бесполезны для построения условий
+SKIP_DOMAINS = {"MANDT", "SYMANDT"}
+# Ответ get_table_fields/get_domain_texts при ошибке GUI или отсутствии данных — не кэшируется
+EMPTY_RESULTS = {"", "{}"}
+
+
+def _usable(future: Future) -> bool:
+    """Загрузка не завершилась или вернула данные; ошибку и пустой ответ нужно загрузить заново."""
+    if not future.done():
+        return True
+    return future.exception() is None and (future.result() or "").strip() not in EMPTY_RESULTS
+
+
+class MetadataPrefetcher:
+    """
+    Фоновая загрузка полей подтверждённых таблиц (и, если задан max_domains_per_table, текстов доменов
+    их ключевых полей) в короткоживущий кэш. Пустые ответы и ошибки в кэше не остаются. Следит за долей попаданий, чтобы механизм можно было настроить или выключить.
+    Кэш общий для процесса; счётчики ведутся и по процессу, и по диалогу (dialog_counters) —
+    в пакетном режиме диалоги идут одновременно, поэтому разность снимков общих счётчиков не годится.
+    """
+
+    def __init__(self, ttl_seconds: float = 300.0, max_domains_per_table: int = 0, enabled: bool = True):
+        self.ttl_seconds = ttl_seconds
+        self.max_domains_per_table = max_domains_per_table
+        self.enabled = enabled
+        self._cache: Dict[Tuple[str, str], Tuple[float, Future]] = {}
+        self._used: set = set()
+        self._lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._stats = {"scheduled": 0, "hits": 0, "misses": 0, "expired": 0}
+
+    @staticmethod
+    def dialog_counters() -> Dict[str, Any]:
+        """Счётчики одного диалога: передаются в schedule_tables/get_* и в stats."""
+        return {"scheduled": 0, "hits": 0, "misses": 0, "expired": 0, "keys": set(), "used": set()}
+
+    def _count(self, name: str, dialog: Optional[Dict[str, Any]]):
+        """Увеличивает счётчик процесса и диалога (вызывается под self._lock)."""
+        self._stats[name] += 1
+        if dialog is not None:
+            dialog[name] += 1
+
+    def _submit(self, key: Tuple[str, str], fn: Callable[[], Any], dialog: Optional[Dict[str, Any]] = None):
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry and time.monotonic() - entry[0] < self.ttl_seconds and _usable(entry[1]):
+                return
+            if self._executor is None:
+                # Один поток: SAP GUI всё равно обслуживает запросы последовательно
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sap-prefetch")
+            self._cache[key] = (time.monotonic(), self._executor.submit(fn))
+            self._used.discard(key)
+            self._count("scheduled", dialog)
+            if dialog is not None:
+                dialog["keys"].add(key)
+
+    def schedule_tables(self, tables: Iterable[str], dialog: Optional[Dict[str, Any]] = None):
+        """Ставит в очередь загрузку полей таблиц, подтверждённых are_tables_present."""
+        if not self.enabled:
+            return
+        for tab in tables:
+            tab = tab.strip().upper()
+            if tab:
+                self._submit(("fields", tab), lambda t=tab: self._fetch_fields(t, dialog), dialog)
+
+    def _fetch_fields(self, table_name: str, dialog: Optional[Dict[str, Any]] = None) -> str:
+        from sap_tools import get_table_fields
+
+        result = get_table_fields(table_name)
+        domains = []
+        for rec in clipboard_records(result):
+            dom = rec.get("DOMNAME", "")
+            # Фиксированные значения бывают только у доменов без проверочной таблицы
+            if rec.get("KEYFLAG") == "X" and dom and dom not in SKIP_DOMAINS and not rec.get("CHECKTABLE"):
+                domains.append(dom)
+        for dom in list(dict.fromkeys(domains))[:self.max_domains_per_table]:
+            self._submit(("domain", dom), lambda d=dom: self._fetch_domain(d), dialog)
+        return result
+
+    @staticmethod
+    def _fetch_domain(domain_name: str) -> str:
+        from sap_tools import get_domain_texts
+        return get_domain_texts(domain_name)
+
+    def _take(self, key: Tuple[str, str], dialog: Optional[Dict[str, Any]] = None) -> Optional[str]:
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                self._count("misses", dialog)
+                return None
+            if time.monotonic() - entry[0] >= self.ttl_seconds:
+                del self._cache[key]
+                self._count("expired", dialog)
+                self._count("misses", dialog)
+                return None
+            future = entry[1]
+        try:
+            result = future.result()
+        except Exception:
+            result = None
+        if result is None or result.strip() in EMPTY_RESULTS:
+            # "{}" — ошибка GUI или нет данных: не отдаём как попадание, вызывающий загрузит заново
+            with self._lock:
+                if self._cache.get(key) is entry:
+                    del self._cache[key]
+                self._count("misses", dialog)
+            return None
+        with self._lock:
+            self._count("hits", dialog)
+            self._used.add(key)
+            if dialog is not None:
+                dialog["used"].add(key)
+        return result
+
+    def get_table_fields(self, table_name: str, dialog: Optional[Dict[str, Any]] = None) -> str:
+        """Поля таблицы из кэша (ожидая незавершённую загрузку) или напрямую из SAP."""
+        from sap_tools import get_table_fields
+
+        cached = self._take(("fields", table_name.strip().upper()), dialog) if self.enabled else None
+        return cached if cached is not None else get_table_fields(table_name)
+
+    def get_domain_texts(self, domain_name: str, dialog: Optional[Dict[str, Any]] = None) -> str:
+        """Тексты домена из кэша или напрямую из SAP."""
+        from sap_tools import get_domain_texts
+
+        cached = self._take(("domain", domain_name.strip().upper()), dialog) if self.enabled else None
+        return cached if cached is not None else get_domain_texts(domain_name)
+
+    def stats(self, dialog: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        Счётчики prefetch (процесса или, если передан, диалога): hit_rate — доля обращений, обслуженных
+        из кэша; wasted — загружено впустую (для диалога — им запланировано и им не использовано).
+        """
+        with self._lock:
+            counters = self._stats if dialog is None else dialog
+            lookups = counters["hits"] + counters["misses"]
+            if dialog is None:
+                wasted = len(set(self._cache) - self._used)
+            else:
+                wasted = len(dialog["keys"] - dialog["used"])
+            return {
+                **{k: counters[k] for k in ("scheduled", "hits", "misses", "expired")},
+                "hit_rate": round(counters["hits"] / lookups, 3) if lookups else None,
+                "wasted": wasted,
+            }
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+_prefetcher: Optional[MetadataPrefetcher] = None
+_prefetcher_lock = threading.Lock()
+
+def get_prefetcher() -> MetadataPrefetcher:
+    """
+    Общий для процесса prefetcher. Управляется переменными окружения:
+    SAP_PREFETCH=0 — выключить, SAP_PREFETCH_TTL — время жизни кэша в секундах,
+    SAP_PREFETCH_DOMAINS — сколько текстов доменов (DD07V) ключевых полей грузить на таблицу (по умолчанию 0:
+    фоновые запросы делят сессии SAP с основными, а тексты доменов нужны редко).
+    """
+    global _prefetcher
+    with _prefetcher_lock:
+        if _prefetcher is None:
+            _prefetcher = MetadataPrefetcher(
+                ttl_seconds=float(os.getenv("SAP_PREFETCH_TTL", "300")),
+                max_domains_per_table=int(os.getenv("SAP_PREFETCH_DOMAINS", "0")),
+                enabled=os.getenv("SAP_PREFETCH", "1") != "0",
+            )
+        return _prefetcher
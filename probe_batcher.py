@@ -0,0 +1,264 @@
+# probe_batcher.py
+# Объединение мелких пробных запросов одного шага в одно выполнение в SAP (UNION ALL с тегом пробы)
+import re
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from deadlines import is_deadline_error
+from sql_validator import strip_comments
+from utils import format_clipboard_table, parse_clipboard_table
+
+TAG_COLUMN = "PROBE_TAG"
+# Номер строки внутри пробы: UNION ALL не сохраняет порядок веток, по нему восстанавливается ORDER BY пробы.
+# Порядок подзапроса снаружи не гарантирован (HANA), поэтому нумерация идёт по тому же ORDER BY
+SEQ_COLUMN = "PROBE_SEQ"
+# Не больше стольких проб в одном пакете: длинный UNION хуже читается в ошибках SAP
+MAX_BATCH = 8
+
+_IDENT = r'(?:"[^"]+"|[A-Za-z_/][\w$#/]*)'
+_COLUMN_REF = re.compile(rf'^(?:{_IDENT}\.)?({_IDENT})$')
+_EXPLICIT_ALIAS = re.compile(rf'^(.*\S)\s+AS\s+({_IDENT})$', re.IGNORECASE | re.DOTALL)
+_IMPLICIT_ALIAS = re.compile(rf'^(.*[\w)"\'])\s+({_IDENT})$', re.DOTALL)
+# Слова, которые могут стоять в конце выражения и не являются псевдонимом
+_NOT_ALIAS = {"END", "NULL", "ASC", "DESC", "DISTINCT", "AND", "OR", "NOT", "THEN", "ELSE"}
+_ORDER_ITEM = re.compile(r'^(.*?)(\s+(?:ASC|DESC))?(\s+NULLS\s+(?:FIRST|LAST))?$', re.IGNORECASE | re.DOTALL)
+
+
+def _split_top_level(text: str, sep: str = ",") -> List[str]:
+    """Делит текст по разделителю вне скобок и строковых литералов."""
+    parts, depth, quote, buf = [], 0, None, []
+    for ch in text:
+        if quote:
+            buf.append(ch)
+            if ch == quote:
+                quote = None
+            continue
+        if ch in ("'", '"'):
+            quote = ch
+        elif ch == "(":
+            depth += 1
+        elif ch == ")":
+            depth -= 1
+        elif ch == sep and depth == 0:
+            parts.append("".join(buf).strip())
+            buf = []
+            continue
+        buf.append(ch)
+    parts.append("".join(buf).strip())
+    return parts
+
+
+def _find_top_level(text: str, keyword: str, start: int = 0) -> int:
+    """Позиция ключевого слова вне скобок и литералов (или -1)."""
+    depth, quote = 0, None
+    pattern = re.compile(rf'\b{keyword}\b', re.IGNORECASE)
+    i = start
+    while i < len(text):
+        ch = text[i]
+        if quote:
+            if ch == quote:
+                quote = None
+        elif ch in ("'", '"'):
+            quote = ch
+        elif ch == "(":
+            depth += 1
+        elif ch == ")":
+            depth -= 1
+        elif depth == 0 and pattern.match(text, i) and (i == 0 or not (text[i - 1].isalnum() or text[i - 1] == "_")):
+            return i
+        i += 1
+    return -1
+
+
+def _select_list(text: str) -> Optional[Tuple[int, int, List[str]]]:
+    """(начало списка колонок, позиция FROM, элементы списка) для SELECT ... FROM или None."""
+    if not re.match(r'^SELECT\b', text, re.IGNORECASE):
+        return None
+    from_pos = _find_top_level(text, "FROM")
+    if from_pos == -1:
+        return None
+    head = re.match(r'^SELECT\s+(DISTINCT\s+|TOP\s+\d+\s+)?', text, re.IGNORECASE)
+    return head.end(), from_pos, _split_top_level(text[head.end():from_pos])
+
+
+def prepare_probe(sql: str, index: int) -> Optional[Tuple[str, List[str]]]:
+    """
+    Готовит пробу к объединению: (SQL с псевдонимами у вычисляемых колонок, имена колонок результата
+    в том виде, в каком на них можно сослаться снаружи, — с кавычками, если они были).
+    None — если пробу нельзя объединять (WITH, SELECT *, не разобрался список колонок).
+    Комментарии удаляются: внутри подзапроса строчный комментарий поглотил бы закрывающую скобку.
+    """
+    text = strip_comments(sql).rstrip(";").strip()
+    parsed = _select_list(text)
+    if parsed is None:
+        return None
+    list_start, from_pos, items = parsed
+    if not items or any(not it or it == "*" or it.endswith(".*") for it in items):
+        return None
+
+    names: List[str] = []
+    rebuilt: List[str] = []
+    for pos, item in enumerate(items, start=1):
+        name = None
+        m = _EXPLICIT_ALIAS.match(item)
+        if m:
+            name = m.group(2)
+        else:
+            m = _IMPLICIT_ALIAS.match(item)
+            if m and m.group(2).upper() not in _NOT_ALIAS:
+                name = m.group(2)
+            else:
+                ref = _COLUMN_REF.match(item)
+                if ref:
+                    name = ref.group(1)
+        if name is None or name.strip('"').upper() in {n.strip('"').upper() for n in names}:
+            # Вычисляемой колонке (или повтору имени) даём технический псевдоним
+            name = f"PROBE_C{index}_{pos}"
+            item = f"{item} AS {name}"
+        names.append(name)
+        rebuilt.append(item)
+    prepared = text[:list_start] + ", ".join(rebuilt) + " " + text[from_pos:]
+    return prepared, names
+
+
+def _norm(expr: str) -> str:
+    return re.sub(r'\s+', '', expr).upper()
+
+
+def probe_order(prepared: Tuple[str, List[str]]) -> Optional[str]:
+    """
+    ORDER BY пробы, переписанный на колонки подзапроса Q ("ORDER BY Q.C DESC, ..."); "" — у пробы нет ORDER BY.
+    None — выражение сортировки не совпадает ни с номером, ни с колонкой, ни с выражением списка SELECT:
+    снаружи такой порядок не воспроизвести, и пробу нужно выполнять отдельно.
+    """
+    sql, names = prepared
+    pos, order_pos = 0, -1
+    while True:
+        pos = _find_top_level(sql, "ORDER", pos)
+        if pos == -1:
+            break
+        if re.match(r'ORDER\s+BY\b', sql[pos:], re.IGNORECASE):
+            order_pos = pos
+        pos += 1
+    if order_pos == -1:
+        return ""
+    start = re.match(r'ORDER\s+BY\s+', sql[order_pos:], re.IGNORECASE).end() + order_pos
+    end = len(sql)
+    for word in ("LIMIT", "OFFSET", "FETCH"):
+        found = _find_top_level(sql, word, start)
+        if found != -1:
+            end = min(end, found)
+
+    # Колонки результата: по имени (с кавычками или без) и по выражению из списка SELECT
+    columns: Dict[str, str] = {}
+    for name, item in zip(names, _select_list(sql)[2]):
+        m = _EXPLICIT_ALIAS.match(item) or _IMPLICIT_ALIAS.match(item)
+        expr = m.group(1) if m and m.group(2) == name else item
+        columns.setdefault(_norm(expr), name)
+    for name in names:
+        columns[_norm(name)] = name
+        columns.setdefault(_norm(name.strip('"')), name)
+
+    keys = []
+    for item in _split_top_level(sql[start:end].strip()):
+        m = _ORDER_ITEM.match(item)
+        expr, suffix = m.group(1).strip(), "".join(g for g in m.groups()[1:] if g)
+        if expr.isdigit():
+            if not 1 <= int(expr) <= len(names):
+                return None
+            name = names[int(expr) - 1]
+        else:
+            name = columns.get(_norm(expr))
+            if name is None:
+                return None
+        keys.append(f"Q.{name}{suffix}")
+    return "ORDER BY " + ", ".join(keys)
+
+
+def build_batch_sql(prepared: List[Tuple[str, List[str]]]) -> Tuple[str, int]:
+    """
+    UNION ALL подготовленных проб с тегом и номером строки. Все значения приводятся к NVARCHAR,
+    недостающие колонки дополняются NULL — так совместимы пробы любой формы.
+    Строки пробы нумеруются по её ORDER BY (probe_order), общий результат сортируется по тегу и номеру.
+    Возвращает (SQL, число колонок данных).
+    """
+    width = max(len(names) for _, names in prepared)
+    branches = []
+    for idx, (sql, names) in enumerate(prepared):
+        cols = [f"TO_NVARCHAR(Q.{n}) AS C{i + 1}" for i, n in enumerate(names)]
+        cols += [f"CAST(NULL AS NVARCHAR(1)) AS C{i + 1}" for i in range(len(names), width)]
+        order = probe_order((sql, names)) or ""
+        branches.append(
+            f"SELECT 'P{idx:02d}' AS {TAG_COLUMN}, ROW_NUMBER() OVER ({order}) AS {SEQ_COLUMN}, {', '.join(cols)}\n"
+            f"FROM (\n{sql}\n) AS Q"
+        )
+    return "\nUNION ALL\n".join(branches) + f"\nORDER BY {TAG_COLUMN}, {SEQ_COLUMN}", width
+
+
+def demultiplex(clipboard_data: str, prepared: List[Tuple[str, List[str]]]) -> Optional[List[Dict[str, Any]]]:
+    """Раскладывает общий результат обратно по пробам в формате run_sap_sql_query."""
+    columns, rows = parse_clipboard_table(clipboard_data)
+    if columns[:2] != [TAG_COLUMN, SEQ_COLUMN]:
+        return None
+    numbered: List[List[Tuple[int, List[str]]]] = [[] for _ in prepared]
+    for row in rows:
+        tag, seq = row[0], row[1]
+        if not tag.startswith("P") or not tag[1:].isdigit() or int(tag[1:]) >= len(prepared) or not seq.isdigit():
+            return None
+        idx = int(tag[1:])
+        numbered[idx].append((int(seq), row[2:2 + len(prepared[idx][1])]))
+    per_probe = [[r for _, r in sorted(rows_i, key=lambda x: x[0])] for rows_i in numbered]
+    return [
+        {
+            "status": True,
+            "message": f"Пакетное выполнение: {len(rows_i)} строк",
+            "result": format_clipboard_table([n.strip('"') for n in names], rows_i),
+        }
+        for (_, names), rows_i in zip(prepared, per_probe)
+    ]
+
+
+def run_probes(queries: List[str], execute: Callable[[str], Dict[str, Any]]) -> List[Tuple[Dict[str, Any], bool]]:
+    """
+    Выполняет пробы шага: совместимые — одним запросом к SAP (группами до MAX_BATCH),
+    остальные и все пробы неудавшегося пакета — по отдельности. Пакет, не уложившийся в бюджет
+    времени, не повторяется по пробам: каждая получает его ошибку deadline_exceeded.
+    Возвращает [(результат, выполнено_в_пакете)] в порядке queries.
+    """
+    from sap_tools import is_query_read_only
+
+    results: List[Optional[Tuple[Dict[str, Any], bool]]] = [None] * len(queries)
+    candidates: List[Tuple[int, Tuple[str, List[str]]]] = []
+    for i, sql in enumerate(queries):
+        prepared = prepare_probe(sql, i) if is_query_read_only(sql)[0] else None
+        if prepared is not None and probe_order(prepared) is not None:
+            candidates.append((i, prepared))
+
+    for start in range(0, len(candidates), MAX_BATCH):
+        group = candidates[start:start + MAX_BATCH]
+        if len(group) < 2:
+            continue
+        batch_sql, _ = build_batch_sql([p for _, p in group])
+        exec_res = execute(batch_sql)
+        split = None
+        if is_deadline_error(exec_res):
+            split = [exec_res] * len(group)
+        elif exec_res.get("status"):
+            split = demultiplex(exec_res.get("result", ""), [p for _, p in group])
+        elif exec_res.get("message") == "Данные не найдены":
+            # Ни одна проба не вернула строк
+            split = [
+                {
+                    "status": True,
+                    "message": "Пакетное выполнение: 0 строк",
+                    "result": format_clipboard_table([n.strip('"') for n in names], []),
+                }
+                for _, (_, names) in group
+            ]
+        if split is not None:
+            for (i, _), res in zip(group, split):
+                results[i] = (res, True)
+
+    for i, sql in enumerate(queries):
+        if results[i] is None:
+            results[i] = (execute(sql), False)
+    return results
@@ -0,0 +1,203 @@
+# result_store.py
+# Локальное хранилище результатов SQL: повторная агрегация без обращения к SAP
+import csv
+import os
+import sqlite3
+import time
+import uuid
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from utils import (convert_value, format_clipboard_table, infer_column_types, parse_clipboard_table,
+                   unique_column_names)
+
+# Таблица, под которой сохранённый результат доступен в локальном SQL
+RESULT_TABLE = "RESULT"
+# Сколько строк локального запроса возвращать модели
+MAX_LOCAL_ROWS = 500
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc as pa_ipc
+except ImportError:  # без pyarrow результаты пишутся в TSV
+    pa = None
+    pa_ipc = None
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+# Диалект query_local_result: при установленном duckdb им выполняются запросы к любому формату файла
+LOCAL_SQL_DIALECT = "DuckDB" if duckdb is not None else "SQLite"
+
+
+class ResultStore:
+    """
+    Сохраняет результаты run_sap_sql_query на диск (Arrow IPC, при отсутствии pyarrow — TSV)
+    и выполняет по ним локальные SELECT. Ссылки на файлы хранятся в dialog_result.
+    """
+
+    def __init__(self, base_dir: Optional[str] = None):
+        self.base_dir = base_dir or os.getenv("SAP_RESULT_DIR", "sap_results")
+
+    def _new_path(self, ext: str) -> str:
+        os.makedirs(self.base_dir, exist_ok=True)
+        name = f"{time.strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}.{ext}"
+        return os.path.join(self.base_dir, name)
+
+    # ===== ЗАПИСЬ =====
+    def save_rows(self, columns: List[str], rows: List[List[str]]) -> Tuple[str, str]:
+        """Записывает строки выгрузки, возвращает (путь, формат)."""
+        if pa is not None:
+            types = infer_column_types(rows, len(columns))
+            arrow_types = {"INTEGER": pa.int64(), "REAL": pa.float64(), "TEXT": pa.string()}
+            arrays = [
+                pa.array([convert_value(r[i], kind) for r in rows], type=arrow_types[kind])
+                for i, kind in enumerate(types)
+            ]
+            table = pa.Table.from_arrays(arrays, names=unique_column_names(columns))
+            path = self._new_path("arrow")
+            # Без сжатия: файл читается через memory map без копирования
+            with pa.OSFile(path, "wb") as sink, pa_ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+            return path, "arrow"
+
+        path = self._new_path("tsv")
+        with open(path, "w", encoding="utf-8", newline="") as f:
+            writer = csv.writer(f, delimiter="\t")
+            writer.writerow(columns)
+            writer.writerows(rows)
+        return path, "tsv"
+
+    def save_batches(self, batches: Iterable[Tuple[List[str], List[List[str]]]]) -> Tuple[str, str, List[str], int]:
+        """
+        Пишет пачки строк (колонки, строки) в TSV по мере поступления — в памяти только текущая пачка.
+        Возвращает (путь, формат, колонки, число строк).
+        """
+        path = self._new_path("tsv")
+        columns: List[str] = []
+        total = 0
+        with open(path, "w", encoding="utf-8", newline="") as f:
+            writer = csv.writer(f, delimiter="\t")
+            for batch_columns, rows in batches:
+                if not columns:
+                    columns = batch_columns
+                    writer.writerow(columns)
+                writer.writerows(rows)
+                f.flush()
+                total += len(rows)
+        return path, "tsv", columns, total
+
+    # ===== ЧТЕНИЕ =====
+    @staticmethod
+    def iter_rows(path: str, fmt: str) -> Iterator[List[str]]:
+        """Строки сохранённого результата (без заголовка) в виде строк."""
+        if fmt == "arrow":
+            for batch in _open_arrow(path).to_batches():
+                for row in zip(*(col.to_pylist() for col in batch.columns)):
+                    yield ["" if v is None else str(v) for v in row]
+            return
+        with open(path, encoding="utf-8", newline="") as f:
+            reader = csv.reader(f, delimiter="\t")
+            next(reader, None)
+            yield from reader
+
+    def query(self, path: str, fmt: str, columns: List[str], sql: str,
+              max_rows: int = MAX_LOCAL_ROWS) -> Dict[str, Any]:
+        """
+        Выполняет SELECT по сохранённому результату (таблица RESULT).
+        Возвращает словарь в формате run_sap_sql_query.
+        """
+        from sap_tools import is_query_read_only
+
+        is_allowed, block_reason = is_query_read_only(sql)
+        if not is_allowed:
+            return {"status": False, "message": f"Запрос заблокирован: {block_reason}", "result": "Ошибка выполнения"}
+        if not os.path.exists(path):
+            return {"status": False, "message": f"Файл результата не найден: {path}", "result": "Ошибка выполнения"}
+
+        try:
+            con = self._load_duckdb(path, fmt, columns) if duckdb is not None else self._load_sqlite(path, fmt, columns)
+            try:
+                cur = con.execute(sql)
+                out_cols = [d[0] for d in cur.description]
+                out_rows = cur.fetchmany(max_rows + 1)
+            finally:
+                con.close()
+        except Exception as e:
+            return {"status": False, "message": str(e), "result": "Ошибка выполнения"}
+
+        truncated = len(out_rows) > max_rows
+        text = format_clipboard_table(out_cols, [list(r) for r in out_rows[:max_rows]])
+        message = f"Локальный запрос: {min(len(out_rows), max_rows)} строк"
+        if truncated:
+            message += f" (показаны первые {max_rows})"
+        return {"status": True, "message": message, "result": text}
+
+    def _load_duckdb(self, path: str, fmt: str, columns: List[str]):
+        """
+        DuckDB в памяти без доступа к файлам и сети (enable_external_access=False): запрос модели
+        видит только RESULT и не может прочитать другие файлы через read_csv и подобные функции.
+        """
+        con = duckdb.connect(config={"enable_external_access": False})
+        try:
+            if fmt == "arrow":
+                con.register(RESULT_TABLE, _open_arrow(path))
+                return con
+            rows = list(self.iter_rows(path, fmt))
+            names = unique_column_names(columns)
+            types = infer_column_types(rows, len(names))
+            duck_types = {"INTEGER": "BIGINT", "REAL": "DOUBLE", "TEXT": "VARCHAR"}
+            col_defs = ", ".join(f'"{n}" {duck_types[t]}' for n, t in zip(names, types))
+            con.execute(f"CREATE TABLE {RESULT_TABLE} ({col_defs})")
+            if rows:
+                placeholders = ", ".join("?" for _ in names)
+                con.executemany(f"INSERT INTO {RESULT_TABLE} VALUES ({placeholders})",
+                                [[convert_value(v, t) for v, t in zip(r, types)] for r in rows])
+            return con
+        except Exception:
+            con.close()
+            raise
+
+    def _load_sqlite(self, path: str, fmt: str, columns: List[str]) -> sqlite3.Connection:
+        """Загружает результат в SQLite в памяти с выведенными типами колонок."""
+        rows = list(self.iter_rows(path, fmt))
+        names = unique_column_names(columns)
+        types = infer_column_types(rows, len(names))
+        con = sqlite3.connect(":memory:")
+        col_defs = ", ".join(f'"{n}" {t}' for n, t in zip(names, types))
+        con.execute(f"CREATE TABLE {RESULT_TABLE} ({col_defs})")
+        placeholders = ", ".join("?" for _ in names)
+        con.executemany(
+            f"INSERT INTO {RESULT_TABLE} VALUES ({placeholders})",
+            ([convert_value(v, t) for v, t in zip(r, types)] for r in rows),
+        )
+        return con
+
+
+def _open_arrow(path: str):
+    """Читает Arrow IPC через memory map: страницы файла подгружаются ОС по мере обращения."""
+    return pa_ipc.open_file(pa.memory_map(path, "r")).read_all()
+
+
+def persist_query_result(db, kind: str, sql: str, exec_res: Dict[str, Any],
+                         store: Optional[ResultStore] = None) -> Optional[int]:
+    """
+    Сохраняет успешный результат run_sap_sql_query и регистрирует его в dialog_result.
+    Финальные результаты сохраняются всегда, пробные — начиная с SAP_RESULT_STORE_MIN_ROWS строк.
+    Возвращает id результата или None. Сохранение необязательно: ошибка записи не прерывает диалог,
+    а только печатается, и результат остаётся без id.
+    """
+    if not exec_res.get("status"):
+        return None
+    columns, rows = parse_clipboard_table(exec_res.get("result", ""))
+    if not columns:
+        return None
+    if kind == "probe" and len(rows) < int(os.getenv("SAP_RESULT_STORE_MIN_ROWS", "100")):
+        return None
+    try:
+        path, fmt = (store or ResultStore()).save_rows(columns, rows)
+        return db.log_result(kind, sql, path, fmt, len(rows), columns)
+    except Exception as e:
+        print(f"⚠️ Результат не сохранён локально: {e}")
+        return None
@@ -1,15 +1,150 @@
-from pysapscript import Sapscript, exceptions
-import win32clipboard
+# pysapscript и win32clipboard импортируются при первом обращении к SAP: тонким клиентам они не нужны
 import time
 import json
 import re
 import logging
-import win32clipboard
-from pysapscript import Sapscript, exceptions
+import os
+import queue
+import threading
+from functools import wraps
+from deadlines import CallCancelled, current_cancel_event, waiting_for_resource
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logging.disable(logging.CRITICAL)
 
+# Сессии SAP GUI (индексы окна подключения 0), доступные для запросов: SAP_SESSION_INDEXES="0,1,2".
+# Каждая сессия обслуживает один вызов за раз; при одной сессии вызовы из разных потоков идут по очереди.
+SAP_SESSION_INDEXES = [int(i) for i in os.getenv("SAP_SESSION_INDEXES", "0").split(",") if i.strip()] or [0]
+_free_sessions: "queue.Queue[int]" = queue.Queue()
+for _index in SAP_SESSION_INDEXES:
+    _free_sessions.put(_index)
+# Какой вызов держит сессию: индекс -> его событие отмены (для recover_sap_session)
+_session_holders: dict = {}
+_holders_lock = threading.Lock()
+# Буфер обмена Windows один на все сессии: выгрузка и чтение результата — под общей блокировкой
+CLIPBOARD_LOCK = threading.Lock()
+_com_state = threading.local()
+_session = threading.local()
+
+def _ensure_com():
+    """SAP GUI Scripting — COM: каждый поток, обращающийся к нему, должен инициализировать COM."""
+    if getattr(_com_state, "ready", False):
+        return
+    try:
+        import pythoncom
+        pythoncom.CoInitialize()
+    except ImportError:
+        pass
+    _com_state.ready = True
+
+def current_session_index() -> int:
+    """Индекс сессии SAP GUI, занятой текущим потоком (вне serialized_gui_call — первая из настроенных)."""
+    index = getattr(_session, "index", None)
+    return SAP_SESSION_INDEXES[0] if index is None else index
+
+def _held_by_live_calls() -> bool:
+    """Сессии заняты работающими вызовами, а не только брошенными по таймауту (recover_sap_session не помог)."""
+    with _holders_lock:
+        holders = list(_session_holders.values())
+    return not holders or any(cancel is None or not cancel.is_set() for cancel in holders)
+
+def serialized_gui_call(func):
+    """
+    Выполняет функцию в свободной сессии SAP GUI из SAP_SESSION_INDEXES (вложенные вызовы — в той же сессии).
+    Ожидание сессии, занятой живым вызовом, не расходует бюджет (deadlines.waiting_for_resource),
+    занятой брошенным вызовом — расходует; если вызов отменён, пока ждал сессию, — не выполняет его.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        _ensure_com()
+        if getattr(_session, "index", None) is not None:
+            return func(*args, **kwargs)
+        cancel = current_cancel_event()
+        with waiting_for_resource() as exempt:
+            while True:
+                # Время за живыми вызовами других диалогов не расходует бюджет, за брошенными — расходует
+                exempt(_held_by_live_calls())
+                try:
+                    index = _free_sessions.get(timeout=0.5)
+                    break
+                except queue.Empty:
+                    if cancel is not None and cancel.is_set():
+                        raise CallCancelled(f"{func.__name__}: вызов отменён, все сессии SAP GUI заняты")
+        _session.index = index
+        with _holders_lock:
+            _session_holders[index] = cancel
+        try:
+            if cancel is not None and cancel.is_set():
+                raise CallCancelled(f"{func.__name__}: вызов отменён до начала выполнения")
+            return func(*args, **kwargs)
+        finally:
+            with _holders_lock:
+                _session_holders.pop(index, None)
+            _session.index = None
+            _free_sessions.put(index)
+    return wrapper
+
+_attached = threading.local()
+
+def attach_sap_window():
+    """
+    Возвращает (Sapscript, окно) текущей сессии для текущего потока. Подключение к SAP GUI переиспользуется
+    между вызовами; COM-прокси привязаны к потоку, поэтому кэш у каждого потока свой.
+    """
+    from pysapscript import Sapscript
+
+    windows = getattr(_attached, "windows", None)
+    if windows is None:
+        windows = _attached.windows = {}
+    index = current_session_index()
+    if index not in windows:
+        sap = Sapscript()
+        windows[index] = (sap, sap.attach_window(0, index))
+    return windows[index]
+
+def _drop_attachment():
+    """После ошибки GUI подключение пересоздаётся при следующем вызове."""
+    getattr(_attached, "windows", {}).pop(current_session_index(), None)
+
+def _read_clipboard() -> str:
+    import win32clipboard
+
+    win32clipboard.OpenClipboard()
+    try:
+        clipboard_data = win32clipboard.GetClipboardData()
+        logging.debug(f"Clipboard data:\n{clipboard_data}")
+    finally:
+        win32clipboard.CloseClipboard()
+    return clipboard_data
+
+def recover_sap_session() -> dict:
+    """
+    Пытается вернуть сессии SAP в рабочее состояние после зависшего вызова:
+    закрывает модальные окна (wnd[1..3]) в сессиях, чьи вызовы отменены, и сообщает, заняты ли они ещё.
+    Сессию не занимает — её держит зависший вызов.
+    """
+    from pysapscript import Sapscript
+
+    _ensure_com()
+    with _holders_lock:
+        indexes = [i for i, cancel in _session_holders.items() if cancel is not None and cancel.is_set()]
+    info = {"sessions": indexes, "closed_windows": 0, "busy": None}
+    try:
+        sap = Sapscript()
+        for index in indexes:
+            session = sap.attach_window(0, index).session_handle
+            info["busy"] = bool(info["busy"]) or bool(session.Busy)
+            for idx in (3, 2, 1):
+                try:
+                    session.findById(f"wnd[{idx}]").close()
+                    info["closed_windows"] += 1
+                except Exception:
+                    pass
+    except Exception as e:
+        logging.error("SAP session recovery failed.", exc_info=True)
+        info["error"] = str(e)
+    return info
+
 def is_query_read_only(sql_query: str) -> tuple[bool, str]:
     """
     Проверяет, является ли SQL-запрос только читающим (SELECT).
@@ -54,6 +189,7 @@ def is_query_read_only(sql_query: str) -> tuple[bool, str]:
     
     return True, ""
 
+@serialized_gui_call
 def run_sap_sql_query(sql_query: str) -> dict:
     """
     Выполняет SQL-запрос в SAP и возвращает результат выполнения, статус и сообщение.
@@ -71,8 +207,9 @@ def run_sap_sql_query(sql_query: str) -> dict:
             "result": "Запрос заблокирован системой безопасности"
         }
     
-    sap = Sapscript()
-    win = sap.attach_window(0, 0)
+    from pysapscript import exceptions
+
+    sap, win = attach_sap_window()
     
     try:
         win.maximize()
@@ -98,24 +235,21 @@ def run_sap_sql_query(sql_query: str) -> dict:
             logging.info("Query executed successfully, proceeding to export results...")
 
             logging.info("Exporting to clipboard...")
-            output_shell_id = "wnd[0]/usr/tabsSQL/tabpOUTPUT/ssubOUTPUT_REF1:SAPLSHDBCCMS:0110/cntlSQL_OUTPUT_CONT/shellcont/shell"
-            output_shell = win.session_handle.findById(output_shell_id)
-            output_shell.pressToolbarContextButton("&MB_EXPORT")
-            output_shell.selectContextMenuItem("&PC")
+            # Буфер обмена общий для всех сессий SAP GUI
+            with CLIPBOARD_LOCK:
+                output_shell_id = "wnd[0]/usr/tabsSQL/tabpOUTPUT/ssubOUTPUT_REF1:SAPLSHDBCCMS:0110/cntlSQL_OUTPUT_CONT/shellcont/shell"
+                output_shell = win.session_handle.findById(output_shell_id)
+                output_shell.pressToolbarContextButton("&MB_EXPORT")
+                output_shell.selectContextMenuItem("&PC")
             
-            format_option_id = "wnd[1]/usr/subSUBSCREEN_STEPLOOP:SAPLSPO5:0150/sub:SAPLSPO5:0150/radSPOPLI-SELFLAG[4,0]"
-            format_option = win.session_handle.findById(format_option_id)
-            format_option.select()
-            format_option.setFocus()
-            win.press("wnd[1]/tbar[0]/btn[0]")
+                format_option_id = "wnd[1]/usr/subSUBSCREEN_STEPLOOP:SAPLSPO5:0150/sub:SAPLSPO5:0150/radSPOPLI-SELFLAG[4,0]"
+                format_option = win.session_handle.findById(format_option_id)
+                format_option.select()
+                format_option.setFocus()
+                win.press("wnd[1]/tbar[0]/btn[0]")
             
-            time.sleep(1)  # Wait for the clipboard to get data
-            win32clipboard.OpenClipboard()
-            try:
-                clipboard_data = win32clipboard.GetClipboardData()
-                logging.debug(f"Clipboard data:\n{clipboard_data}")
-            finally:
-                win32clipboard.CloseClipboard()
+                time.sleep(1)  # Wait for the clipboard to get data
+                clipboard_data = _read_clipboard()
             
             if not clipboard_data:
                 return {"status": False, "message": "Данные не найдены", "result": "Данные не найдены"}
@@ -127,24 +261,28 @@ def run_sap_sql_query(sql_query: str) -> dict:
     
     except exceptions.ActionException as e:
         logging.error("SAP GUI action failed.")
+        _drop_attachment()
         sap.handle_exception_with_screenshot(e)
         return {"status": False, "message": str(e), "result": "Ошибка выполнения"}
     
     except Exception as e:
         logging.error("Unexpected error occurred.", exc_info=True)
+        _drop_attachment()
         sap.handle_exception_with_screenshot(e, "general_error")
         return {"status": False, "message": str(e), "result": "Ошибка выполнения"}
 
 
 
 
+@serialized_gui_call
 def get_table_fields(table_name: str, lang: str = "ru") -> str:
     """
     Извлекает поля указанной таблицы SAP с ключевыми характеристиками на русском языке
     и возвращает результат в виде JSON-строки.
     """
-    sap = Sapscript()
-    win = sap.attach_window(0, 0)
+    from pysapscript import exceptions
+
+    sap, win = attach_sap_window()
 
     try:
         win.maximize()
@@ -165,26 +303,23 @@ def get_table_fields(table_name: str, lang: str = "ru") -> str:
         win.press("wnd[0]/tbar[1]/btn[8]")
 
         logging.debug("Exporting data to clipboard.")
-        output_shell_id = "wnd[0]/usr/tabsSQL/tabpOUTPUT/ssubOUTPUT_REF1:SAPLSHDBCCMS:0110/cntlSQL_OUTPUT_CONT/shellcont/shell"
-        output_shell = win.session_handle.findById(output_shell_id)
-        output_shell.pressToolbarContextButton("&MB_EXPORT")
-        output_shell.selectContextMenuItem("&PC")
+        # Буфер обмена общий для всех сессий SAP GUI
+        with CLIPBOARD_LOCK:
+            output_shell_id = "wnd[0]/usr/tabsSQL/tabpOUTPUT/ssubOUTPUT_REF1:SAPLSHDBCCMS:0110/cntlSQL_OUTPUT_CONT/shellcont/shell"
+            output_shell = win.session_handle.findById(output_shell_id)
+            output_shell.pressToolbarContextButton("&MB_EXPORT")
+            output_shell.selectContextMenuItem("&PC")
 
-        logging.debug("Confirming export format.")
-        format_option_id = "wnd[1]/usr/subSUBSCREEN_STEPLOOP:SAPLSPO5:0150/sub:SAPLSPO5:0150/radSPOPLI-SELFLAG[4,0]"
-        format_option = win.session_handle.findById(format_option_id)
-        format_option.select()
-        format_option.setFocus()
-        win.press("wnd[1]/tbar[0]/btn[0]")
+            logging.debug("Confirming export format.")
+            format_option_id = "wnd[1]/usr/subSUBSCREEN_STEPLOOP:SAPLSPO5:0150/sub:SAPLSPO5:0150/radSPOPLI-SELFLAG[4,0]"
+            format_option = win.session_handle.findById(format_option_id)
+            format_option.select()
+            format_option.setFocus()
+            win.press("wnd[1]/tbar[0]/btn[0]")
 
-        time.sleep(1)  # Wait for the data to be copied to the clipboard
+            time.sleep(1)  # Wait for the data to be copied to the clipboard
 
-        win32clipboard.OpenClipboard()
-        try:
-            clipboard_data = win32clipboard.GetClipboardData()
-            logging.debug(f"Clipboard data:\n{clipboard_data}")
-        finally:
-            win32clipboard.CloseClipboard()
+            clipboard_data = _read_clipboard()
 
         if "FIELDNAME" not in clipboard_data:
             logging.warning("No data found for the provided table.")
@@ -195,10 +330,12 @@ def get_table_fields(table_name: str, lang: str = "ru") -> str:
 
     except exceptions.ActionException as e:
         logging.error("SAP GUI action failed.")
+        _drop_attachment()
         sap.handle_exception_with_screenshot(e)
         return "{}"
     except Exception as e:
         logging.error("Unexpected error occurred.", exc_info=True)
+        _drop_attachment()
         sap.handle_exception_with_screenshot(e, "general_error")
         return "{}"
     
@@ -267,6 +404,8 @@ def are_tables_present(table_names: list) -> dict:
     Проверяет наличие текстов таблиц в DD02T для набора имен.
     Возвращает {TABNAME: bool}, где True, если есть запись в DD02T
     для DDLANGUAGE IN ('R','E'). Если нужен именно русский — см. флаг only_ru.
+    Если запрос не выполнился, возвращается ошибка run_sap_sql_query ({"status": False, ...}):
+    наличие таблиц неизвестно, и считать их отсутствующими нельзя.
     """
     if not table_names:
         return {}
@@ -291,7 +430,10 @@ def are_tables_present(table_names: list) -> dict:
     # Выполняем через существующую обвязку и парсим буфер как таблицу с '|' детерминированно
     exec_res = run_sap_sql_query(sql)
     if not exec_res.get("status"):
-        return {t: False for t in tabs}
+        # Пустой ответ — ни одной из таблиц нет в DD02T; любая другая ошибка — наличие неизвестно
+        if exec_res.get("message") == "Данные не найдены":
+            return {t: False for t in tabs}
+        return exec_res
 
     clipboard_data = exec_res.get("result", "")
     # Пример формата:
@@ -322,13 +464,15 @@ def are_tables_present(table_names: list) -> dict:
     return results
 
 
+@serialized_gui_call
 def get_domain_texts (domain_name: str, lang: str = "R") -> str:
     """
     Извлекает текстовые значения поля указанного домена (по умолчанию на русском языке)
     и возвращает результат в виде строки.
     """
-    sap = Sapscript()
-    win = sap.attach_window(0, 0)
+    from pysapscript import exceptions
+
+    sap, win = attach_sap_window()
 
     try:
         win.maximize()
@@ -349,26 +493,23 @@ def get_domain_texts (domain_name: str, lang: str = "R") -> str:
         win.press("wnd[0]/tbar[1]/btn[8]")
 
         logging.debug("Exporting data to clipboard.")
-        output_shell_id = "wnd[0]/usr/tabsSQL/tabpOUTPUT/ssubOUTPUT_REF1:SAPLSHDBCCMS:0110/cntlSQL_OUTPUT_CONT/shellcont/shell"
-        output_shell = win.session_handle.findById(output_shell_id)
-        output_shell.pressToolbarContextButton("&MB_EXPORT")
-        output_shell.selectContextMenuItem("&PC")
+        # Буфер обмена общий для всех сессий SAP GUI
+        with CLIPBOARD_LOCK:
+            output_shell_id = "wnd[0]/usr/tabsSQL/tabpOUTPUT/ssubOUTPUT_REF1:SAPLSHDBCCMS:0110/cntlSQL_OUTPUT_CONT/shellcont/shell"
+            output_shell = win.session_handle.findById(output_shell_id)
+            output_shell.pressToolbarContextButton("&MB_EXPORT")
+            output_shell.selectContextMenuItem("&PC")
 
-        logging.debug("Confirming export format.")
-        format_option_id = "wnd[1]/usr/subSUBSCREEN_STEPLOOP:SAPLSPO5:0150/sub:SAPLSPO5:0150/radSPOPLI-SELFLAG[4,0]"
-        format_option = win.session_handle.findById(format_option_id)
-        format_option.select()
-        format_option.setFocus()
-        win.press("wnd[1]/tbar[0]/btn[0]")
+            logging.debug("Confirming export format.")
+            format_option_id = "wnd[1]/usr/subSUBSCREEN_STEPLOOP:SAPLSPO5:0150/sub:SAPLSPO5:0150/radSPOPLI-SELFLAG[4,0]"
+            format_option = win.session_handle.findById(format_option_id)
+            format_option.select()
+            format_option.setFocus()
+            win.press("wnd[1]/tbar[0]/btn[0]")
 
-        time.sleep(1)  # Wait for the data to be copied to the clipboard
+            time.sleep(1)  # Wait for the data to be copied to the clipboard
 
-        win32clipboard.OpenClipboard()
-        try:
-            clipboard_data = win32clipboard.GetClipboardData()
-            logging.debug(f"Clipboard data:\n{clipboard_data}")
-        finally:
-            win32clipboard.CloseClipboard()
+            clipboard_data = _read_clipboard()
 
         if "VALPOS" not in clipboard_data:
             logging.warning("No data found for the provided domain.")
@@ -379,9 +520,11 @@ def get_domain_texts (domain_name: str, lang: str = "R") -> str:
 
     except exceptions.ActionException as e:
         logging.error("SAP GUI action failed.")
+        _drop_attachment()
         sap.handle_exception_with_screenshot(e)
         return "{}"
     except Exception as e:
         logging.error("Unexpected error occurred.", exc_info=True)
+        _drop_attachment()
         sap.handle_exception_with_screenshot(e, "general_error")
         return "{}"
@@ -0,0 +1,330 @@
+# scheduled_queries.py
+# Регулярные отчёты по SQL из dialog_log.sql_used: результат хранится локально,
+# при следующих запусках из SAP забираются только новые/изменённые строки (по колонке изменений и watermark)
+import argparse
+import json
+import re
+import sqlite3
+import time
+from typing import Any, Dict, List, Optional
+
+from sql_validator import strip_comments, tokenize, top_level_words
+from utils import parse_clipboard_table, unique_column_names
+
+_NAME_RE = re.compile(r'^[A-Za-z_/][\w/]*$')
+# Конструкции, с которыми фильтр дельты по внешнему запросу даёт не те строки, что полный запуск
+_NO_DELTA = {"TOP": "TOP", "LIMIT": "LIMIT", "OFFSET": "OFFSET", "FETCH": "FETCH FIRST", "GROUP": "GROUP BY"}
+
+
+class ScheduledQueries:
+    """Расписание запросов и их материализованные результаты (таблицы mq_<id>) в локальной SQLite."""
+
+    def __init__(self, db_path: str = "sap_scheduled.sqlite3"):
+        self.db_path = db_path
+        self.conn: Optional[sqlite3.Connection] = None
+
+    def connect(self):
+        if self.conn:
+            return
+        self.conn = sqlite3.connect(self.db_path)
+        self._ensure_schema()
+
+    def close(self):
+        if self.conn:
+            try:
+                self.conn.close()
+            finally:
+                self.conn = None
+
+    def _ensure_schema(self):
+        assert self.conn is not None
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS scheduled_query (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT NOT NULL UNIQUE,
+                dialog_id INTEGER,
+                sql TEXT NOT NULL,
+                change_column TEXT NOT NULL,
+                key_columns TEXT NOT NULL,
+                interval_minutes INTEGER NOT NULL,
+                watermark TEXT,
+                columns TEXT,
+                row_count INTEGER NOT NULL DEFAULT 0,
+                last_run TEXT,
+                next_run REAL NOT NULL,
+                last_status TEXT
+            );
+        """)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS scheduled_run (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                query_id INTEGER NOT NULL,
+                started TEXT NOT NULL,
+                duration_s REAL NOT NULL,
+                mode TEXT NOT NULL CHECK(mode IN ('full','delta')),
+                fetched_rows INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                message TEXT,
+                FOREIGN KEY (query_id) REFERENCES scheduled_query(id) ON DELETE CASCADE
+            );
+        """)
+        self.conn.commit()
+
+    @staticmethod
+    def _now() -> str:
+        return time.strftime("%Y-%m-%d %H:%M:%S")
+
+    # ===== УПРАВЛЕНИЕ =====
+    def add(self, name: str, sql: str, change_column: str, key_columns: List[str],
+            interval_minutes: int, dialog_id: Optional[int] = None) -> int:
+        """
+        Регистрирует запрос. Колонка изменений (CREDAT/AEDAT/UPDDAT...) должна быть в результате SQL.
+        Запросы с TOP/LIMIT/OFFSET/FETCH FIRST/GROUP BY не принимаются: дельта по ним не равна изменениям
+        полного результата (ограничение и агрегаты считаются по отфильтрованным строкам).
+        """
+        assert self.conn is not None
+        for col in [change_column, *key_columns]:
+            if not _NAME_RE.match(col):
+                raise ValueError(f"Недопустимое имя колонки: {col}")
+        sql = strip_comments(sql).rstrip(";").strip()
+        found = [label for word, label in _NO_DELTA.items() if word in top_level_words(tokenize(sql))]
+        if found:
+            raise ValueError(f"Инкрементальное обновление невозможно для запроса с {', '.join(found)}")
+        cur = self.conn.execute("""
+            INSERT INTO scheduled_query (name, dialog_id, sql, change_column, key_columns, interval_minutes, next_run)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, (name, dialog_id, sql, change_column.upper(),
+              json.dumps([k.upper() for k in key_columns]), interval_minutes, time.time()))
+        self.conn.commit()
+        return cur.lastrowid
+
+    def remove(self, name: str) -> bool:
+        assert self.conn is not None
+        q = self.get(name)
+        if q is None:
+            return False
+        self.conn.execute(f'DROP TABLE IF EXISTS "{self._table(q["id"])}"')
+        self.conn.execute("DELETE FROM scheduled_run WHERE query_id = ?", (q["id"],))
+        self.conn.execute("DELETE FROM scheduled_query WHERE id = ?", (q["id"],))
+        self.conn.commit()
+        return True
+
+    def get(self, name: str) -> Optional[Dict[str, Any]]:
+        rows = self.list(where="name = ?", params=(name,))
+        return rows[0] if rows else None
+
+    def list(self, where: str = "1 = 1", params: tuple = ()) -> List[Dict[str, Any]]:
+        assert self.conn is not None
+        cur = self.conn.execute(f"""
+            SELECT id, name, dialog_id, sql, change_column, key_columns, interval_minutes,
+                   watermark, columns, row_count, last_run, next_run, last_status
+              FROM scheduled_query WHERE {where} ORDER BY id
+        """, params)
+        keys = [d[0] for d in cur.description]
+        items = []
+        for row in cur.fetchall():
+            item = dict(zip(keys, row))
+            item["key_columns"] = json.loads(item["key_columns"])
+            item["columns"] = json.loads(item["columns"]) if item["columns"] else None
+            items.append(item)
+        return items
+
+    def due(self) -> List[Dict[str, Any]]:
+        return self.list(where="next_run <= ?", params=(time.time(),))
+
+    @staticmethod
+    def _table(query_id: int) -> str:
+        return f"mq_{query_id}"
+
+    # ===== ВЫПОЛНЕНИЕ =====
+    @staticmethod
+    def delta_sql(sql: str, change_column: str, watermark: str) -> str:
+        """
+        Исходный SQL как производная таблица с фильтром по колонке изменений.
+        Граница включительно (>=): строки с тем же значением могли появиться после прошлого запуска.
+        """
+        wm = watermark.replace("'", "''")
+        return f"SELECT * FROM (\n{strip_comments(sql)}\n) AS Q WHERE Q.{change_column} >= '{wm}'"
+
+    def run(self, q: Dict[str, Any], execute=None) -> Dict[str, Any]:
+        """
+        Один запуск: полный при отсутствии watermark, иначе дельта с слиянием в локальную копию.
+        Слияние — в одной транзакции: при любой ошибке локальная копия остаётся прежней,
+        а ошибка записывается в scheduled_run.
+        """
+        assert self.conn is not None
+        if execute is None:
+            from deadlines import call_with_deadline
+            from sap_tools import recover_sap_session, run_sap_sql_query
+
+            def execute(sql):
+                return call_with_deadline("final_sql_execution", run_sap_sql_query, sql,
+                                          on_timeout=recover_sap_session)
+
+        started, t0 = self._now(), time.perf_counter()
+        mode = "delta" if q["watermark"] is not None else "full"
+        sql = self.delta_sql(q["sql"], q["change_column"], q["watermark"]) if mode == "delta" else q["sql"]
+        status, message, fetched = "ok", "", 0
+        try:
+            exec_res = execute(sql)
+            message = exec_res.get("message", "")
+            if exec_res.get("status"):
+                columns, rows = parse_clipboard_table(exec_res.get("result", ""))
+                fetched = len(rows)
+                if not self.conn.in_transaction:
+                    self.conn.execute("BEGIN")
+                self._merge(q, mode, unique_column_names(columns), rows)
+            elif mode == "delta" and message == "Данные не найдены":
+                # Пустая дельта — изменений нет
+                message = "Изменений нет"
+            else:
+                status = "error"
+        except Exception as e:
+            if self.conn.in_transaction:
+                self.conn.rollback()
+            status, message = "error", str(e) or type(e).__name__
+
+        total = self.conn.execute(f'SELECT COUNT(*) FROM "{self._table(q["id"])}"').fetchone()[0] \
+            if self._has_table(q["id"]) else 0
+        watermark = self._watermark(q) if status == "ok" else q["watermark"]
+        self.conn.execute("""
+            UPDATE scheduled_query
+               SET watermark = ?, row_count = ?, last_run = ?, next_run = ?, last_status = ?
+             WHERE id = ?
+        """, (watermark, total, started, time.time() + q["interval_minutes"] * 60, status, q["id"]))
+        duration = round(time.perf_counter() - t0, 2)
+        self.conn.execute("""
+            INSERT INTO scheduled_run (query_id, started, duration_s, mode, fetched_rows, status, message)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, (q["id"], started, duration, mode, fetched, status, message))
+        self.conn.commit()
+        return {"name": q["name"], "mode": mode, "fetched_rows": fetched, "row_count": total,
+                "watermark": watermark, "status": status, "message": message, "duration_s": duration}
+
+    def _has_table(self, query_id: int) -> bool:
+        assert self.conn is not None
+        return self.conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                                 (self._table(query_id),)).fetchone() is not None
+
+    def _merge(self, q: Dict[str, Any], mode: str, columns: List[str], rows: List[List[str]]):
+        assert self.conn is not None
+        change, keys = q["change_column"], q["key_columns"]
+        missing = [c for c in [change, *keys] if c not in columns]
+        if missing:
+            raise ValueError(f"В результате нет колонок: {', '.join(missing)}")
+        table = self._table(q["id"])
+        if mode == "delta" and q["columns"] and q["columns"] != columns:
+            raise ValueError("Состав колонок изменился — удалите и заново добавьте запрос")
+
+        col_defs = ", ".join(f'"{c}" TEXT' for c in columns)
+        placeholders = ", ".join("?" for _ in columns)
+        if mode == "full":
+            self.conn.execute(f'DROP TABLE IF EXISTS "{table}"')
+            self.conn.execute(f'CREATE TABLE "{table}" ({col_defs})')
+            self.conn.execute(f'CREATE INDEX "ix_{table}_change" ON "{table}" ("{change}")')
+            self.conn.execute("UPDATE scheduled_query SET columns = ? WHERE id = ?",
+                              (json.dumps(columns), q["id"]))
+        elif keys:
+            # Обновлённые строки заменяют прежние версии по ключу
+            key_pos = [columns.index(k) for k in keys]
+            cond = " AND ".join(f'"{k}" = ?' for k in keys)
+            self.conn.executemany(f'DELETE FROM "{table}" WHERE {cond}',
+                                  [[r[i] for i in key_pos] for r in rows])
+        else:
+            # Без ключа — перечитанный хвост от watermark заменяется целиком
+            self.conn.execute(f'DELETE FROM "{table}" WHERE "{change}" >= ?', (q["watermark"],))
+        self.conn.executemany(f'INSERT INTO "{table}" VALUES ({placeholders})', rows)
+
+    def _watermark(self, q: Dict[str, Any]) -> Optional[str]:
+        assert self.conn is not None
+        if not self._has_table(q["id"]):
+            return q["watermark"]
+        row = self.conn.execute(f'SELECT MAX("{q["change_column"]}") FROM "{self._table(q["id"])}"').fetchone()
+        return row[0] if row and row[0] is not None else q["watermark"]
+
+    def run_due(self) -> List[Dict[str, Any]]:
+        return [self.run(q) for q in self.due()]
+
+    def rows(self, name: str, limit: int = 50) -> Dict[str, Any]:
+        """Строки локальной копии (без обращения к SAP)."""
+        assert self.conn is not None
+        q = self.get(name)
+        if q is None or not self._has_table(q["id"]):
+            return {"columns": [], "rows": []}
+        cur = self.conn.execute(f'SELECT * FROM "{self._table(q["id"])}" ORDER BY "{q["change_column"]}" DESC LIMIT ?',
+                                (limit,))
+        return {"columns": [d[0] for d in cur.description], "rows": cur.fetchall()}
+
+
+def main():
+    from db_logger import DBLogger
+    from utils import format_clipboard_table
+
+    parser = argparse.ArgumentParser(description="Регулярные запросы к SAP с инкрементальным обновлением")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_add = sub.add_parser("add", help="добавить запрос (SQL из dialog_log или явно)")
+    p_add.add_argument("--name", required=True)
+    src = p_add.add_mutually_exclusive_group(required=True)
+    src.add_argument("--dialog-id", type=int)
+    src.add_argument("--sql")
+    p_add.add_argument("--change-column", required=True, help="CREDAT / AEDAT / UPDDAT ...")
+    p_add.add_argument("--keys", default="", help="ключевые колонки через запятую для слияния изменений")
+    p_add.add_argument("--every", type=int, default=60, help="интервал, минуты")
+    sub.add_parser("list")
+    p_run = sub.add_parser("run", help="выполнить сейчас")
+    p_run.add_argument("--name")
+    p_loop = sub.add_parser("loop", help="выполнять по расписанию")
+    p_loop.add_argument("--poll", type=int, default=60, help="период проверки, секунды")
+    p_show = sub.add_parser("show", help="строки локальной копии")
+    p_show.add_argument("--name", required=True)
+    p_show.add_argument("--limit", type=int, default=50)
+    p_rm = sub.add_parser("remove")
+    p_rm.add_argument("--name", required=True)
+    args = parser.parse_args()
+
+    store = ScheduledQueries()
+    store.connect()
+    try:
+        if args.cmd == "add":
+            sql = args.sql
+            if args.dialog_id is not None:
+                logger = DBLogger()
+                logger.connect()
+                try:
+                    sql = logger.get_dialog_sql(args.dialog_id)
+                finally:
+                    logger.close()
+                if not sql or sql == "DIRECT_PENDING":
+                    parser.error(f"В dialog_log нет SQL для диалога {args.dialog_id}")
+            keys = [k.strip() for k in args.keys.split(",") if k.strip()]
+            try:
+                qid = store.add(args.name, sql, args.change_column, keys, args.every, args.dialog_id)
+            except ValueError as e:
+                parser.error(str(e))
+            print(f"Запрос {args.name} добавлен (id={qid})")
+        elif args.cmd == "list":
+            for q in store.list():
+                print(f"{q['name']}: каждые {q['interval_minutes']} мин, {q['change_column']} >= {q['watermark']}, "
+                      f"строк {q['row_count']}, последний запуск {q['last_run']} ({q['last_status']})")
+        elif args.cmd == "run":
+            queries = [store.get(args.name)] if args.name else store.list()
+            for q in queries:
+                if q is None:
+                    parser.error(f"Нет запроса {args.name}")
+                print(json.dumps(store.run(q), ensure_ascii=False))
+        elif args.cmd == "loop":
+            while True:
+                for res in store.run_due():
+                    print(json.dumps(res, ensure_ascii=False))
+                time.sleep(args.poll)
+        elif args.cmd == "show":
+            data = store.rows(args.name, args.limit)
+            print(format_clipboard_table(data["columns"], [list(r) for r in data["rows"]]))
+        elif args.cmd == "remove":
+            print("Удалён" if store.remove(args.name) else "Не найден")
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
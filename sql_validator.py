@@ -0,0 +1,501 @@
+# sql_validator.py
+# Локальная проверка SQL до выполнения в SAP: имена таблиц и полей по кэшу DDIC (DD02T/DD03M),
+# длина литералов NUMC/DATS, обязательные ORDER BY и LIMIT у проб
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from utils import clipboard_records
+
+_TOKEN_RE = re.compile(r"""
+    (?P<ws>\s+)
+  | (?P<comment>--[^\n]*|/\*.*?\*/)
+  | (?P<string>'(?:[^']|'')*')
+  | (?P<qident>"[^"]+")
+  | (?P<number>\d+(?:\.\d+)?)
+  | (?P<ident>/\w+/\w+|[A-Za-z_][\w$#]*)
+  | (?P<op><>|!=|<=|>=|\|\||[(),.;=<>*+\-/])
+""", re.VERBOSE | re.DOTALL)
+
+# Слова, которые не бывают именем поля или псевдонимом
+KEYWORDS = {
+    "SELECT", "FROM", "WHERE", "GROUP", "ORDER", "BY", "HAVING", "LIMIT", "OFFSET", "TOP", "DISTINCT", "ALL",
+    "UNION", "EXCEPT", "INTERSECT", "MINUS", "WITH", "AS", "ON", "USING", "JOIN", "INNER", "LEFT", "RIGHT",
+    "FULL", "OUTER", "CROSS", "AND", "OR", "NOT", "IN", "IS", "NULL", "LIKE", "ESCAPE", "BETWEEN", "EXISTS",
+    "CASE", "WHEN", "THEN", "ELSE", "END", "ASC", "DESC", "NULLS", "FIRST", "LAST", "OVER", "PARTITION",
+    "ROWS", "RANGE", "PRECEDING", "FOLLOWING", "UNBOUNDED", "CURRENT", "ROW", "FETCH", "NEXT", "ONLY",
+    "DATE", "TIME", "TIMESTAMP", "INTERVAL", "TRUE", "FALSE", "ANY", "SOME", "YEAR", "MONTH", "DAY",
+    "HOUR", "MINUTE", "SECOND", "CURRENT_DATE", "CURRENT_TIME", "CURRENT_TIMESTAMP", "CURRENT_USER",
+    "CURRENT_UTCDATE", "CURRENT_UTCTIMESTAMP", "SESSION_USER", "FOR", "LATERAL",
+}
+# Ключевые слова, завершающие список таблиц после FROM
+_FROM_END = {"WHERE", "GROUP", "ORDER", "HAVING", "LIMIT", "UNION", "EXCEPT", "INTERSECT", "MINUS", "ON",
+             "USING", "OFFSET", "FETCH", "FOR"}
+# Функции, внутри которых FROM не вводит таблицу
+_FROM_FUNCTIONS = {"EXTRACT", "TRIM", "SUBSTRING"}
+_COMPARE_OPS = {"=", "<>", "!=", "<", ">", "<=", ">="}
+
+
+class _Token:
+    __slots__ = ("kind", "text", "value", "start", "end")
+
+    def __init__(self, kind: str, text: str, start: int, end: int):
+        self.kind, self.text, self.start, self.end = kind, text, start, end
+        if kind == "qident":
+            self.kind, self.value = "ident", text[1:-1].upper()
+        elif kind == "ident":
+            self.value = text.upper()
+        else:
+            self.value = text
+
+    def is_word(self, *words: str) -> bool:
+        return self.kind == "ident" and self.value in words
+
+
+def strip_comments(sql: str) -> str:
+    """SQL без комментариев (-- и /* */); строковые литералы и идентификаторы в кавычках не затрагиваются."""
+    out, pos = [], 0
+    while pos < len(sql):
+        m = _TOKEN_RE.match(sql, pos)
+        if not m:
+            out.append(sql[pos])
+            pos += 1
+            continue
+        out.append(" " if m.lastgroup == "comment" else m.group())
+        pos = m.end()
+    return "".join(out).strip()
+
+
+def top_level_words(tokens: List[_Token]) -> Dict[str, int]:
+    """
+    Индексы ключевых слов вне скобок (последнее вхождение): ORDER и GROUP — только в паре с BY,
+    а также LIMIT, OFFSET, FETCH, TOP, UNION, WITH.
+    """
+    found: Dict[str, int] = {}
+    depth = 0
+    for i, t in enumerate(tokens):
+        if t.value == "(":
+            depth += 1
+        elif t.value == ")":
+            depth -= 1
+        elif depth == 0 and t.kind == "ident":
+            if t.value in ("ORDER", "GROUP"):
+                if i + 1 < len(tokens) and tokens[i + 1].is_word("BY"):
+                    found[t.value] = i
+            elif t.value in ("LIMIT", "OFFSET", "FETCH", "TOP", "UNION", "WITH"):
+                found[t.value] = i
+    return found
+
+
+def tokenize(sql: str) -> List[_Token]:
+    """Лексемы SQL без пробелов и комментариев; нераспознанный символ — ValueError."""
+    tokens: List[_Token] = []
+    pos = 0
+    while pos < len(sql):
+        m = _TOKEN_RE.match(sql, pos)
+        if not m:
+            raise ValueError(f"Не удалось разобрать SQL около позиции {pos}: {sql[pos:pos + 20]!r}")
+        kind = m.lastgroup
+        if kind not in ("ws", "comment"):
+            tokens.append(_Token(kind, m.group(), m.start(), m.end()))
+        pos = m.end()
+    return tokens
+
+
+class DdicCache:
+    """
+    Постоянный кэш метаданных DDIC в локальной SQLite: наличие таблиц (are_tables_present, DD02T)
+    и поля с типами (get_table_fields, DD03M). Наполняется результатами инструментов агента.
+    """
+
+    def __init__(self, db_path: str = "sap_ddic_cache.sqlite3"):
+        self.db_path = db_path
+        self.conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.RLock()
+
+    def connect(self):
+        if self.conn:
+            return
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._ensure_schema()
+
+    def close(self):
+        if self.conn:
+            try:
+                self.conn.close()
+            finally:
+                self.conn = None
+
+    def _ensure_schema(self):
+        assert self.conn is not None
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS ddic_table (
+                tabname TEXT PRIMARY KEY,
+                present INTEGER NOT NULL,
+                checked_at TEXT NOT NULL
+            );
+        """)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS ddic_field (
+                tabname TEXT NOT NULL,
+                fieldname TEXT NOT NULL,
+                datatype TEXT,
+                outputlen INTEGER,
+                domname TEXT,
+                PRIMARY KEY (tabname, fieldname)
+            );
+        """)
+        self.conn.commit()
+
+    @staticmethod
+    def _now() -> str:
+        return time.strftime("%Y-%m-%d %H:%M:%S")
+
+    def ingest_presence(self, presence: Dict[str, bool]):
+        """Результат are_tables_present: {TABNAME: есть ли в DD02T}."""
+        with self._lock:
+            self.connect()
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO ddic_table (tabname, present, checked_at) VALUES (?, ?, ?)",
+                [(tab.upper(), int(bool(ok)), self._now()) for tab, ok in presence.items()]
+            )
+            self.conn.commit()
+
+    def ingest_table_fields(self, table_name: str, clipboard_data: str) -> int:
+        """Поля таблицы из результата get_table_fields; список полей заменяется целиком."""
+        tab = table_name.strip().upper()
+        fields = []
+        for rec in clipboard_records(clipboard_data):
+            name = rec.get("FIELDNAME", "").upper()
+            if not name or name.startswith("."):
+                continue
+            outputlen = rec.get("OUTPUTLEN", "").lstrip("0")
+            fields.append((tab, name, rec.get("DATATYPE") or None,
+                           int(outputlen) if outputlen.isdigit() else None, rec.get("DOMNAME") or None))
+        if not fields:
+            return 0
+        with self._lock:
+            self.connect()
+            self.conn.execute("DELETE FROM ddic_field WHERE tabname = ?", (tab,))
+            self.conn.executemany("""
+                INSERT OR REPLACE INTO ddic_field (tabname, fieldname, datatype, outputlen, domname)
+                VALUES (?, ?, ?, ?, ?)
+            """, fields)
+            self.conn.execute("INSERT OR REPLACE INTO ddic_table (tabname, present, checked_at) VALUES (?, 1, ?)",
+                              (tab, self._now()))
+            self.conn.commit()
+        return len(fields)
+
+    def table_present(self, table_name: str) -> Optional[bool]:
+        """True/False по кэшу, None — таблица ещё не проверялась."""
+        with self._lock:
+            self.connect()
+            row = self.conn.execute("SELECT present FROM ddic_table WHERE tabname = ?",
+                                    (table_name.upper(),)).fetchone()
+        return None if row is None else bool(row[0])
+
+    def fields(self, table_name: str) -> Optional[Dict[str, Dict[str, Any]]]:
+        """{FIELDNAME: {"datatype", "outputlen"}} или None, если поля таблицы не загружались."""
+        with self._lock:
+            self.connect()
+            rows = self.conn.execute(
+                "SELECT fieldname, datatype, outputlen FROM ddic_field WHERE tabname = ?",
+                (table_name.upper(),)
+            ).fetchall()
+        if not rows:
+            return None
+        return {name: {"datatype": dt, "outputlen": ln} for name, dt, ln in rows}
+
+
+_cache: Optional[DdicCache] = None
+_cache_lock = threading.Lock()
+
+def get_ddic_cache() -> DdicCache:
+    """Общий для процесса кэш DDIC."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = DdicCache()
+            _cache.connect()
+        return _cache
+
+
+def _parse_sources(tokens: List[_Token]) -> Tuple[Dict[str, Optional[str]], List[str], set]:
+    """
+    Источники данных запроса: ({псевдоним или имя: таблица DDIC | None для CTE и подзапросов},
+    [таблицы DDIC], {индексы лексем, занятых именами таблиц и псевдонимами}).
+    """
+    sources: Dict[str, Optional[str]] = {}
+    tables: List[str] = []
+    used: set = set()
+    ctes = set()
+    n = len(tokens)
+
+    # Имена CTE: WITH name AS ( ... ), name AS ( ... )
+    depth = 0
+    for i, t in enumerate(tokens):
+        if t.value == "(":
+            depth += 1
+        elif t.value == ")":
+            depth -= 1
+        elif (depth == 0 and t.kind == "ident" and i > 0 and (tokens[i - 1].is_word("WITH") or tokens[i - 1].value == ",")
+              and i + 2 < n and tokens[i + 1].is_word("AS") and tokens[i + 2].value == "("):
+            ctes.add(t.value)
+            sources[t.value] = None
+            used.add(i)
+
+    def alias_at(j: int) -> Tuple[Optional[str], int]:
+        if j < n and tokens[j].is_word("AS"):
+            j += 1
+        if j < n and tokens[j].kind == "ident" and tokens[j].value not in KEYWORDS:
+            used.add(j)
+            return tokens[j].value, j + 1
+        return None, j
+
+    def parse_ref(j: int):
+        if j >= n:
+            return
+        if tokens[j].value == "(":
+            # Подзапрос: его псевдоним — после парной скобки
+            level, k = 0, j
+            while k < n:
+                level += tokens[k].value == "("
+                level -= tokens[k].value == ")"
+                if level == 0:
+                    break
+                k += 1
+            alias, _ = alias_at(k + 1)
+            if alias:
+                sources[alias] = None
+            return
+        if tokens[j].kind != "ident" or tokens[j].value in KEYWORDS:
+            return
+        name, k = tokens[j].value, j + 1
+        used.add(j)
+        if k + 1 < n and tokens[k].value == "." and tokens[k + 1].kind == "ident":
+            # Схема.таблица
+            name, k = tokens[k + 1].value, k + 2
+            used.add(k - 1)
+        if k < n and tokens[k].value == "(":
+            # Табличная функция или параметризованное представление — не проверяем
+            sources[name] = None
+            return
+        alias, _ = alias_at(k)
+        table = None if name in ctes else name
+        if table:
+            tables.append(table)
+        sources[name] = table
+        if alias:
+            sources[alias] = table
+
+    depth, parens, from_depths = 0, [], set()
+    for i, t in enumerate(tokens):
+        if t.value == "(":
+            parens.append(tokens[i - 1].value if i > 0 and tokens[i - 1].kind == "ident" else "")
+            depth += 1
+        elif t.value == ")":
+            from_depths.discard(depth)
+            depth -= 1
+            if parens:
+                parens.pop()
+        elif t.is_word("FROM"):
+            if parens and parens[-1] in _FROM_FUNCTIONS:
+                continue
+            from_depths.add(depth)
+            parse_ref(i + 1)
+        elif t.is_word("JOIN"):
+            parse_ref(i + 1)
+        elif t.value == "," and depth in from_depths:
+            parse_ref(i + 1)
+        elif t.kind == "ident" and t.value in _FROM_END:
+            from_depths.discard(depth)
+    return sources, list(dict.fromkeys(tables)), used
+
+
+def _literal(token: _Token) -> Optional[str]:
+    if token.kind != "string":
+        return None
+    return token.text[1:-1].replace("''", "'")
+
+
+def _check_literal(table: str, field: str, info: Dict[str, Any], value: str) -> Optional[str]:
+    """Значение, которое заведомо не совпадёт ни с одним значением поля: неверная длина NUMC, формат DATS."""
+    dtype, length = (info.get("datatype") or "").upper(), info.get("outputlen")
+    if dtype == "NUMC" and length:
+        if not value.isdigit():
+            return f"{table}.{field} имеет тип NUMC({length}): значение '{value}' должно состоять из цифр"
+        if len(value) != length:
+            return (f"{table}.{field} имеет тип NUMC({length}): значение '{value}' нужно указать "
+                    f"с ведущими нулями — '{value.zfill(length)[-length:]}'")
+    if dtype == "DATS" and value and not (len(value) == 8 and value.isdigit()):
+        return f"{table}.{field} имеет тип DATS: дату '{value}' нужно указать в формате 'YYYYMMDD'"
+    return None
+
+
+def _check_names_and_literals(tokens: List[_Token], cache: DdicCache) -> Tuple[List[str], List[str]]:
+    """
+    (ошибки, предупреждения). Неизвестное поле — только предупреждение: get_table_fields читает DD03M
+    с фильтром по языку, и поля без русского текста элемента данных в кэш не попадают.
+    """
+    errors: List[str] = []
+    warnings: List[str] = []
+    sources, tables, used = _parse_sources(tokens)
+    n = len(tokens)
+
+    for tab in tables:
+        if cache.table_present(tab) is False:
+            errors.append(f"Таблица {tab} не найдена в словаре (DD02T) — проверь имя через are_tables_present")
+    known_fields = {tab: cache.fields(tab) for tab in tables}
+
+    # Неквалифицированные имена проверяются только в запросах к одной таблице без подзапросов и CTE
+    single = tables[0] if len(tables) == 1 and all(v == tables[0] for v in sources.values()) else None
+    aliases = set(sources)
+    for i, t in enumerate(tokens):
+        if t.kind != "ident" or i == 0:
+            continue
+        prev = tokens[i - 1]
+        # Псевдоним колонки: после AS или сразу после выражения (COUNT(*) CNT)
+        if prev.is_word("AS") or prev.kind in ("number", "string") or prev.value == ")" \
+                or (prev.kind == "ident" and prev.value not in KEYWORDS and i - 1 not in used):
+            aliases.add(t.value)
+
+    def resolve(i: int) -> Optional[Tuple[str, str, int]]:
+        """(таблица, поле, индекс следующей лексемы) для ссылки на поле, начинающейся с лексемы i."""
+        t = tokens[i]
+        if t.kind != "ident" or i in used:
+            return None
+        if i + 2 < n and tokens[i + 1].value == "." and tokens[i + 2].kind == "ident":
+            if i + 4 < n and tokens[i + 3].value == ".":
+                return None
+            table = sources.get(t.value)
+            return (table, tokens[i + 2].value, i + 3) if table else None
+        if (single and t.value not in KEYWORDS and t.value not in aliases
+                and not (i > 0 and tokens[i - 1].value == ".")
+                and not (i + 1 < n and tokens[i + 1].value == "(")):
+            return single, t.value, i + 1
+        return None
+
+    reported = set()
+    for i in range(n):
+        ref = resolve(i)
+        if ref is None:
+            continue
+        table, field, nxt = ref
+        fields = known_fields.get(table)
+        if fields is None:
+            continue
+        if field not in fields:
+            if (table, field) not in reported:
+                reported.add((table, field))
+                warnings.append(f"Поля {field} нет среди полей таблицы {table}, полученных через get_table_fields — "
+                                "проверь имя, если SAP вернёт ошибку")
+            continue
+        info = fields[field]
+        values: List[_Token] = []
+        if nxt + 1 < n and tokens[nxt].value in _COMPARE_OPS:
+            values = [tokens[nxt + 1]]
+        elif nxt < n and tokens[nxt].is_word("IN", "NOT"):
+            j = nxt + (2 if tokens[nxt].is_word("NOT") else 1)
+            if j < n and tokens[j].value == "(":
+                j += 1
+                while j < n and tokens[j].value != ")":
+                    values.append(tokens[j])
+                    j += 1
+        elif nxt + 3 < n and tokens[nxt].is_word("BETWEEN"):
+            values = [tokens[nxt + 1], tokens[nxt + 3]]
+        elif i >= 2 and tokens[i - 1].value in _COMPARE_OPS:
+            values = [tokens[i - 2]]
+        for v in values:
+            literal = _literal(v)
+            problem = _check_literal(table, field, info, literal) if literal is not None else None
+            if problem and problem not in errors:
+                errors.append(problem)
+    return errors, warnings
+
+
+def probe_max_rows() -> int:
+    """Предел строк для проб (SAP_PROBE_MAX_ROWS)."""
+    return max(1, int(os.getenv("SAP_PROBE_MAX_ROWS", "500")))
+
+
+def enforce_probe_limits(sql: str, tokens: List[_Token], max_rows: int) -> str:
+    """
+    Проба получает детерминированный порядок и ограничение строк: добавляется ORDER BY 1, если сортировки нет,
+    LIMIT — если нет ни LIMIT, ни FETCH FIRST, а слишком большой предел уменьшается. Запросы с TOP не трогаются.
+    sql — без комментариев, tokens — его лексемы: вставки делаются по позициям лексем.
+    """
+    words = top_level_words(tokens)
+    if "TOP" in words:
+        return sql
+    edits: Dict[int, str] = {}
+    replace: List[Tuple[int, int, str]] = []
+
+    # Слишком большой предел: LIMIT n / FETCH FIRST n ROWS ONLY
+    for word, offset in (("LIMIT", 1), ("FETCH", 2)):
+        if word in words and words[word] + offset < len(tokens):
+            num = tokens[words[word] + offset]
+            if num.kind == "number" and int(float(num.value)) > max_rows:
+                replace.append((num.start, num.end, str(max_rows)))
+
+    tail = [words[w] for w in ("LIMIT", "OFFSET", "FETCH") if w in words]
+    if "ORDER" not in words:
+        pos = tokens[min(tail)].start if tail else len(sql)
+        edits[pos] = edits.get(pos, "") + "ORDER BY 1 "
+    if "LIMIT" not in words and "FETCH" not in words:
+        pos = tokens[words["OFFSET"]].start if "OFFSET" in words else len(sql)
+        edits[pos] = edits.get(pos, "") + f"LIMIT {max_rows} "
+
+    changes = replace + [(pos, pos, text) for pos, text in edits.items()]
+    text = sql
+    for start, stop, new in sorted(changes, key=lambda c: c[0], reverse=True):
+        if start == len(text):
+            new = " " + new.rstrip()
+        text = text[:start] + new + text[stop:]
+    return text
+
+
+def validate_sql(sql: str, probe: bool = False, cache: Optional[DdicCache] = None,
+                 max_rows: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Разбирает SQL один раз и проверяет его без обращения к SAP.
+    Возвращает {"ok", "errors", "warnings", "sql"}: sql — без комментариев, для проб дополнен ORDER BY / LIMIT.
+    SAP_SQL_VALIDATION=0 — проверка выключена.
+    """
+    text = strip_comments(sql).rstrip(";").strip()
+    if os.getenv("SAP_SQL_VALIDATION", "1") == "0":
+        return {"ok": True, "errors": [], "warnings": [], "sql": text}
+    try:
+        tokens = tokenize(text)
+    except ValueError as e:
+        return {"ok": False, "errors": [str(e)], "warnings": [], "sql": text}
+    if any(t.value == ";" for t in tokens):
+        return {"ok": False, "errors": ["Допускается ровно один оператор SQL"], "warnings": [], "sql": text}
+    depth = 0
+    for t in tokens:
+        depth += t.value == "("
+        depth -= t.value == ")"
+        if depth < 0:
+            break
+    if depth != 0:
+        return {"ok": False, "errors": ["Несбалансированные скобки"], "warnings": [], "sql": text}
+
+    errors, warnings = _check_names_and_literals(tokens, cache or get_ddic_cache())
+    if errors:
+        return {"ok": False, "errors": errors, "warnings": warnings, "sql": text}
+    if probe:
+        text = enforce_probe_limits(text, tokens, max_rows or probe_max_rows())
+    return {"ok": True, "errors": [], "warnings": warnings, "sql": text}
+
+
+def validation_error(errors: List[str]) -> Dict[str, Any]:
+    """Отказ локальной проверки в формате результата run_sap_sql_query."""
+    return {
+        "status": False,
+        "error": "validation_failed",
+        "errors": errors,
+        "message": "Запрос не выполнялся в SAP — локальная проверка: " + "; ".join(errors),
+        "result": "Ошибка выполнения",
+    }
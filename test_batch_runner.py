@@ -0,0 +1,48 @@
+# test_batch_runner.py
+# Пакетный прогон: чтение вопросов и продолжение прерванного прогона по файлу ответов
+import json
+
+import pytest
+
+from batch_runner import done_ids, read_questions
+
+
+def write_lines(path, lines):
+    path.write_text("".join(line + "\n" for line in lines), encoding="utf-8")
+    return str(path)
+
+
+def test_read_questions(tmp_path):
+    path = write_lines(tmp_path / "q.jsonl", [
+        json.dumps({"id": 7, "query": "Сколько заказов?"}, ensure_ascii=False),
+        "",
+        json.dumps({"question": "Покажи IDOC"}, ensure_ascii=False),
+    ])
+    assert read_questions(path) == [{"id": "7", "query": "Сколько заказов?"}, {"id": "3", "query": "Покажи IDOC"}]
+
+
+def test_question_without_query_is_rejected(tmp_path):
+    path = write_lines(tmp_path / "q.jsonl", [json.dumps({"id": 1})])
+    with pytest.raises(ValueError, match="q.jsonl:1"):
+        read_questions(path)
+
+
+def test_done_ids_resume_and_retry_errors(tmp_path):
+    path = write_lines(tmp_path / "a.jsonl", [
+        json.dumps({"id": "1", "status": "ok"}),
+        json.dumps({"id": "2", "status": "error"}),
+        json.dumps({"id": "3", "status": "error"}),
+        json.dumps({"id": "3", "status": "ok"}),
+    ])
+    assert done_ids(path) == {"1", "2", "3"}
+    assert done_ids(path, retry_errors=True) == {"1", "3"}
+
+
+def test_truncated_last_line_is_skipped(tmp_path):
+    path = tmp_path / "a.jsonl"
+    path.write_text(json.dumps({"id": "1", "status": "ok"}) + '\n{"id": "2", "sta', encoding="utf-8")
+    assert done_ids(str(path)) == {"1"}
+
+
+def test_missing_answers_file(tmp_path):
+    assert done_ids(str(tmp_path / "none.jsonl")) == set()
@@ -0,0 +1,45 @@
+# test_candidate_sql.py
+# Выбор финального SQL из вариантов: голосование по содержимому, повторное выполнение при ORDER BY
+from candidate_sql import limit_sql, select_candidate
+from utils import format_clipboard_table
+
+
+def executor(results):
+    """Ответ по внутреннему SQL варианта: results[sql] = (колонки, строки)."""
+    calls = []
+
+    def execute(sql):
+        calls.append(sql)
+        inner = sql.split("\n")[1]
+        columns, rows = results[inner]
+        if not rows:
+            return {"status": False, "message": "Данные не найдены", "result": ""}
+        return {"status": True, "message": "", "result": format_clipboard_table(columns, rows)}
+
+    execute.calls = calls
+    return execute
+
+
+def test_limit_sql_orders_by_all_columns_and_drops_comments():
+    sql = limit_sql("SELECT VBELN, NETWR FROM VBAK -- all", 200)
+    assert sql == "SELECT * FROM (\nSELECT VBELN, NETWR FROM VBAK\n) AS Q ORDER BY 1, 2 LIMIT 200"
+
+
+def test_truncated_results_agree_only_on_same_rows():
+    a, b, c = "SELECT VBELN FROM VBAK", "SELECT VBELN FROM VBAK WHERE 1 = 1", "SELECT KUNNR FROM KNA1"
+    execute = executor({
+        a: (["VBELN"], [["1"], ["2"]]),
+        b: (["VBELN"], [["1"], ["2"]]),
+        c: (["KUNNR"], [["7"], ["8"]]),
+    })
+    choice = select_candidate([c, a, b], execute, limit=2)
+    assert choice["sql"] == a
+    assert [r["votes"] for r in choice["report"]] == [1, 2, 2]
+    assert not choice["complete"]
+
+
+def test_complete_result_is_reused_unless_sql_has_order_by():
+    plain, ordered = "SELECT VBELN FROM VBAK", "SELECT VBELN FROM VBAK ORDER BY VBELN DESC"
+    execute = executor({plain: (["VBELN"], [["1"]]), ordered: (["VBELN"], [["1"]])})
+    assert select_candidate([plain], execute, limit=5)["complete"]
+    assert not select_candidate([ordered], execute, limit=5)["complete"]
@@ -0,0 +1,66 @@
+# test_deadlines.py
+# Бюджеты вызовов: одновременные вызовы не ждут друг друга в очереди потоков
+import threading
+import time
+
+from deadlines import DialogBudget, call_with_deadline, is_deadline_error, waiting_for_resource
+
+
+def test_concurrent_calls_do_not_queue_behind_each_other():
+    call_with_deadline("probe", lambda: None, budget=1)
+    results = []
+
+    def call():
+        results.append(call_with_deadline("probe", lambda: time.sleep(0.3) or "ok", budget=1.0))
+
+    threads = [threading.Thread(target=call) for _ in range(6)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == ["ok"] * 6
+
+
+def test_timeout_sets_cancel_event():
+    from deadlines import current_cancel_event
+    seen = threading.Event()
+
+    def slow():
+        current_cancel_event().wait(2)
+        seen.set()
+
+    assert is_deadline_error(call_with_deadline("probe", slow, budget=0.1))
+    assert seen.wait(1)
+
+
+def _queued_behind(release_after: float, live: bool):
+    lock = threading.Lock()
+    lock.acquire()
+    threading.Timer(release_after, lock.release).start()
+
+    def queued():
+        with waiting_for_resource() as exempt:
+            exempt(live)
+            lock.acquire()
+        lock.release()
+        return "ok"
+
+    return queued
+
+
+def test_wait_behind_live_call_is_not_charged():
+    dialog = DialogBudget(60)
+    assert call_with_deadline("probe", _queued_behind(0.4, live=True), budget=0.2, dialog=dialog) == "ok"
+    assert dialog.elapsed() < 0.2
+
+
+def test_wait_behind_abandoned_call_is_charged():
+    dialog = DialogBudget(60)
+    assert is_deadline_error(call_with_deadline("probe", _queued_behind(0.6, live=False), budget=0.2, dialog=dialog))
+    assert dialog.elapsed() >= 0.2
+
+
+def test_exempt_wait_is_capped_by_dialog_budget():
+    dialog = DialogBudget(0.3)
+    res = call_with_deadline("probe", _queued_behind(1.0, live=True), budget=5, dialog=dialog)
+    assert is_deadline_error(res) and "заняты" in res["message"]
@@ -0,0 +1,94 @@
+# test_join_graph.py
+# Граф связей: усечённая выгрузка DD05S не помечает таблицы расширенными, составной ключ на границе
+# страниц собирается целиком, связи без полей — с подсказкой, запросы к SAP не блокируют граф
+import threading
+
+import pytest
+
+import join_graph
+import sap_tools
+from join_graph import JoinGraph
+from utils import format_clipboard_table
+
+
+@pytest.fixture
+def dd05s(sqlite_sap, monkeypatch):
+    """SQLite с DD05S/DD08L вместо SAP: у T001 много обратных связей."""
+    con = sqlite_sap.con
+    con.execute("CREATE TABLE DD05S (TABNAME, FIELDNAME, AS4LOCAL, AS4VERS, CHECKTABLE, FORTABLE, FORKEY, CHECKFIELD, PRIMPOS)")
+    con.execute("CREATE TABLE DD08L (TABNAME, FIELDNAME, AS4LOCAL, AS4VERS, CARD)")
+    rows = [(f"Z{i:03d}", "BUKRS", "A", "0000", "T001", f"Z{i:03d}", "BUKRS", "BUKRS", "0001") for i in range(25)]
+    rows.append(("BKPF", "BUKRS", "A", "0000", "T001", "BKPF", "BUKRS", "BUKRS", "0001"))
+    rows.append(("BSEG", "BELNR", "A", "0000", "BKPF", "BSEG", "BELNR", "BELNR", "0001"))
+    # ZT: девять простых связей и составной ключ до KNVV, который режется границей страницы
+    rows += [("ZT", f"F{i}", "A", "0000", f"ZC{i}", "ZT", f"F{i}", f"F{i}", "0001") for i in range(9)]
+    rows += [("ZT", "KUNNR", "A", "0000", "KNVV", "ZT", fk, ck, f"{pos:04d}")
+             for pos, (fk, ck) in enumerate([("KUNNR", "KUNNR"), ("VKORG", "VKORG"), ("VTWEG", "VTWEG")], 1)]
+    con.executemany("INSERT INTO DD05S VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+    monkeypatch.setattr(sap_tools, "run_sap_sql_query", sqlite_sap)
+    monkeypatch.setattr(join_graph, "MAX_FK_ROWS", 10)
+    return sqlite_sap
+
+
+@pytest.fixture
+def graph(tmp_path):
+    g = JoinGraph(str(tmp_path / "graph.sqlite3"))
+    g.connect()
+    yield g
+    g.close()
+
+
+def expanded(graph):
+    return {r[0] for r in graph.conn.execute("SELECT tabname FROM fk_expanded")}
+
+
+def test_truncated_table_is_paged_and_marked(graph, dd05s):
+    assert set(graph.expand(["T001", "BSEG"])) == {"T001", "BSEG"}
+    assert expanded(graph) == {"T001", "BSEG"}
+    count = graph.conn.execute("SELECT COUNT(*) FROM fk_edge WHERE checktable = 'T001'").fetchone()[0]
+    assert count == 26
+
+
+def test_still_truncated_table_is_not_marked(graph, dd05s, monkeypatch):
+    monkeypatch.setattr(join_graph, "MAX_FK_PAGES", 2)
+    graph.expand(["T001", "BSEG"])
+    assert expanded(graph) == {"BSEG"}
+    calls = len(dd05s.calls)
+    graph.expand(["T001"])
+    assert len(dd05s.calls) > calls
+
+
+def test_composite_key_across_pages_is_merged(graph, dd05s):
+    graph.expand(["ZT"], reverse=False)
+    assert len(dd05s.calls) == 2
+    res = graph.find_join_path(["ZT", "KNVV"], expand_depth=0)
+    assert res["joins"][0]["on"] == "ZT.KUNNR = KNVV.KUNNR AND ZT.VKORG = KNVV.VKORG AND ZT.VTWEG = KNVV.VTWEG"
+
+
+def test_checktable_edge_gets_hint(graph, dd05s):
+    graph.ingest_table_fields("VBAK", format_clipboard_table(["FIELDNAME", "CHECKTABLE"], [["KUNNR", "KNA1"]]))
+    res = graph.find_join_path(["VBAK", "KNA1"], expand_depth=0)
+    join = res["joins"][0]
+    assert join["on"] is None
+    assert join["on_hint"] == "VBAK.KUNNR = KNA1.KUNNR"
+    assert "note" in join
+
+
+def test_sap_query_does_not_lock_graph(graph, dd05s, monkeypatch):
+    started, release = threading.Event(), threading.Event()
+
+    def slow(sql):
+        started.set()
+        release.wait(2)
+        return dd05s(sql)
+
+    monkeypatch.setattr(sap_tools, "run_sap_sql_query", slow)
+    worker = threading.Thread(target=graph.find_join_path, args=(["BSEG", "BKPF"],))
+    worker.start()
+    assert started.wait(1)
+    done = threading.Event()
+    threading.Thread(target=lambda: (graph.ingest_table_fields(
+        "VBAK", format_clipboard_table(["FIELDNAME", "CHECKTABLE"], [["KUNNR", "KNA1"]])), done.set())).start()
+    assert done.wait(1)
+    release.set()
+    worker.join()
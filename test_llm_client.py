@@ -0,0 +1,170 @@
+# test_llm_client.py
+# Клиент LLM: очередь за слотом не расходует срок ответа, долгий ответ прерывается по сроку, отменённая
+# попытка не отправляется, запросы к Ollama идут в нативный /api/chat с num_ctx и ключом API
+import json
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import llm_client
+from deadlines import DeadlineExceeded
+
+
+class _FakeResponse:
+    def __init__(self, delay):
+        self.delay = delay
+
+    def iter_lines(self):
+        time.sleep(self.delay)
+        yield 'data: {"choices": [{"delta": {"content": "ok"}}]}'
+        yield "data: [DONE]"
+
+
+class _FakeClient:
+    """Имитирует client.chat.completions.with_streaming_response.create с задержкой ответа."""
+
+    def __init__(self, delay):
+        self.sent = 0
+        self.chat = self
+        self.completions = self
+        self.with_streaming_response = self
+        self._delay = delay
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def create(self, **kwargs):
+        with self._lock:
+            self.sent += 1
+        yield _FakeResponse(self._delay)
+
+
+@pytest.fixture
+def one_slot():
+    llm_client.set_concurrency(1)
+    yield
+    llm_client.set_concurrency(None)
+
+
+def test_queue_time_does_not_count_against_deadline(one_slot):
+    client = _FakeClient(delay=0.3)
+    results, stats = [], [{} for _ in range(3)]
+
+    def ask(i):
+        text = "".join(llm_client.iter_chat_deltas_hedged(client, "m", [], deadline=0.6, hedge_after=0,
+                                                          stats=stats[i]))
+        results.append(text)
+
+    threads = [threading.Thread(target=ask, args=(i,)) for i in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == ["ok"] * 3
+    assert max(s["queue_ms"] for s in stats) >= 500
+
+
+def test_slow_answer_raises_deadline():
+    with pytest.raises(DeadlineExceeded):
+        "".join(llm_client.iter_chat_deltas_hedged(_FakeClient(delay=0.5), "m", [], deadline=0.2, hedge_after=0))
+
+
+def test_abandoned_attempt_is_not_sent(one_slot):
+    busy = _FakeClient(delay=0.5)
+    blocker = threading.Thread(target=lambda: "".join(llm_client.iter_chat_deltas(busy, "m", [])))
+    blocker.start()
+    time.sleep(0.05)
+
+    # Попытку отменили, пока она ждала слот: после освобождения слота запрос не уходит на сервер
+    client, cancel, got = _FakeClient(delay=0), threading.Event(), []
+    waiter = threading.Thread(target=lambda: got.extend(llm_client.iter_chat_deltas(client, "m", [], cancel=cancel)))
+    waiter.start()
+    time.sleep(0.1)
+    cancel.set()
+    waiter.join(timeout=1)
+    blocker.join()
+    assert not waiter.is_alive()
+    assert got == [] and client.sent == 0
+
+
+class _OllamaHandler(BaseHTTPRequestHandler):
+    """Нативный /api/chat: отвечает NDJSON и запоминает тело запроса и порт клиента."""
+    protocol_version = "HTTP/1.1"
+    seen: list = []
+    auth: list = []
+    native = True
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.seen.append((self.path, self.client_address[1], body))
+        self.auth.append(self.headers.get("Authorization"))
+        if self.path == "/v1/chat/completions":
+            return self._reply("text/event-stream", 'data: {"choices": [{"delta": {"content": "ok"}}]}\n\n'
+                                                    "data: [DONE]\n\n")
+        if not self.native:
+            return self._reply("text/plain", "404 page not found", 404)
+        if body.get("stream"):
+            lines = [{"message": {"content": "при"}, "done": False},
+                     {"message": {"content": "вет"}, "done": False},
+                     {"message": {"content": ""}, "done": True}]
+        else:
+            lines = [{"message": {"content": "."}, "done": True}]
+        self._reply("application/x-ndjson", "".join(json.dumps(x, ensure_ascii=False) + "\n" for x in lines))
+
+    def _reply(self, content_type, text, status=200):
+        payload = text.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def ollama_server():
+    _OllamaHandler.seen, _OllamaHandler.auth, _OllamaHandler.native = [], [], True
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _OllamaHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+
+
+def test_ollama_requests_use_native_chat_with_num_ctx(ollama_server, monkeypatch):
+    monkeypatch.setenv("OLLAMA_NUM_CTX", "16384")
+    assert llm_client.warm_up(ollama_server, "m", "system")
+    client = llm_client.get_client(ollama_server)
+    messages = [{"role": "user", "content": "q"}]
+    for _ in range(2):
+        extra = llm_client.ollama_extra_body("m", messages)
+        assert "".join(llm_client.iter_chat_deltas(client, "m", messages, extra_body=extra)) == "привет"
+
+    paths = [p for p, _, _ in _OllamaHandler.seen]
+    assert paths == ["/api/chat"] * 3
+    assert {b["options"]["num_ctx"] for _, _, b in _OllamaHandler.seen} == {16384}
+    # Прогрев и оба запроса — по одному keep-alive соединению
+    assert len({port for _, port, _ in _OllamaHandler.seen}) == 1
+
+
+def test_native_chat_sends_api_key(ollama_server):
+    client = llm_client.get_client(ollama_server, "secret")
+    messages = [{"role": "user", "content": "q"}]
+    "".join(llm_client.iter_chat_deltas(client, "m", messages, extra_body=llm_client.ollama_extra_body("m", messages)))
+    assert _OllamaHandler.seen[0][0] == "/api/chat"
+    assert _OllamaHandler.auth == ["Bearer secret"]
+
+
+def test_server_without_native_chat_falls_back_to_v1(ollama_server):
+    _OllamaHandler.native = False
+    client = llm_client.get_client(ollama_server, "other-key")
+    messages = [{"role": "user", "content": "q"}]
+    for _ in range(2):
+        extra = llm_client.ollama_extra_body("m", messages)
+        assert "".join(llm_client.iter_chat_deltas(client, "m", messages, extra_body=extra)) == "ok"
+    assert not llm_client.warm_up(ollama_server, "m", "system", "other-key")
+    # После первого 404 /api/chat больше не запрашивается
+    assert [p for p, _, _ in _OllamaHandler.seen] == ["/api/chat", "/v1/chat/completions", "/v1/chat/completions"]
@@ -0,0 +1,62 @@
+# test_paged_fetch.py
+# Постраничная выгрузка: сохранение ORDER BY запроса, WITH, запросы с собственным LIMIT
+import pytest
+
+from paged_fetch import can_page, fetch_to_file, offset_page_sql
+from result_store import ResultStore
+
+
+class _Db:
+    def __init__(self):
+        self.logged = []
+
+    def log_result(self, kind, sql, path, fmt, rows, columns):
+        self.logged.append((kind, sql, rows))
+        return len(self.logged)
+
+
+@pytest.fixture
+def sap(sqlite_sap):
+    """VBAK из 23 заказов в SQLite вместо SAP."""
+    sqlite_sap.con.execute("CREATE TABLE VBAK (VBELN TEXT, NETWR INTEGER)")
+    sqlite_sap.con.executemany("INSERT INTO VBAK VALUES (?, ?)", [(f"{i:010d}", i % 7) for i in range(1, 24)])
+    return sqlite_sap
+
+
+def fetch(sap, tmp_path, sql):
+    db = _Db()
+    res = fetch_to_file(db, sql, sap, ResultStore(str(tmp_path)), size=5)
+    rows = list(ResultStore.iter_rows(*_stored(tmp_path)))
+    return res, rows, db
+
+
+def _stored(tmp_path):
+    path = next(p for p in tmp_path.iterdir())
+    return str(path), path.suffix[1:]
+
+
+def test_query_order_is_kept_with_tiebreaker(sap, tmp_path):
+    res, rows, _ = fetch(sap, tmp_path, "SELECT VBELN, NETWR FROM VBAK ORDER BY NETWR DESC -- top first")
+    assert res["status"]
+    assert [int(r[1]) for r in rows] == sorted((i % 7 for i in range(1, 24)), reverse=True)
+    assert len(rows) == 23
+    assert all("ORDER BY NETWR DESC, 1, 2 LIMIT" in c for c in sap.calls)
+
+
+def test_with_query_is_paged(sap, tmp_path):
+    res, rows, _ = fetch(sap, tmp_path, "WITH B AS (SELECT VBELN FROM VBAK WHERE NETWR > 3) SELECT * FROM B")
+    assert res["status"]
+    assert len(rows) == 9
+
+
+def test_query_with_own_limit_runs_once(sap, tmp_path):
+    sql = "SELECT VBELN FROM VBAK ORDER BY VBELN DESC LIMIT 3"
+    assert not can_page(sql)
+    res, rows, db = fetch(sap, tmp_path, sql)
+    assert sap.calls == [sql]
+    assert [r[0] for r in rows] == ["0000000023", "0000000022", "0000000021"]
+    assert res["result_id"] == 1 and db.logged[0][0] == "final"
+
+
+def test_offset_page_without_order():
+    assert offset_page_sql("SELECT A, B FROM T;", 2, 10, 20) == "SELECT A, B FROM T ORDER BY 1, 2 LIMIT 10 OFFSET 20"
@@ -0,0 +1,47 @@
+# test_prefetch.py
+# Счётчики prefetch ведутся по диалогу, а не накапливаются за процесс; пустой ответ SAP не кэшируется
+import pytest
+
+import sap_tools
+from prefetch import MetadataPrefetcher
+from utils import format_clipboard_table
+
+
+@pytest.fixture
+def fake_sap(monkeypatch):
+    fields = format_clipboard_table(["FIELDNAME", "KEYFLAG", "DOMNAME", "CHECKTABLE"], [["VBELN", "X", "", ""]])
+    monkeypatch.setattr(sap_tools, "get_table_fields", lambda table: fields)
+    monkeypatch.setattr(sap_tools, "get_domain_texts", lambda domain: "")
+
+
+def test_dialog_stats_are_separate(fake_sap):
+    prefetcher = MetadataPrefetcher()
+    first, second = prefetcher.dialog_counters(), prefetcher.dialog_counters()
+    try:
+        prefetcher.schedule_tables(["VBAK", "VBAP"], first)
+        prefetcher.get_table_fields("VBAK", first)
+        prefetcher.get_table_fields("KNA1", second)
+    finally:
+        prefetcher.shutdown()
+
+    assert prefetcher.stats(first) == {"scheduled": 2, "hits": 1, "misses": 0, "expired": 0,
+                                       "hit_rate": 1.0, "wasted": 1}
+    assert prefetcher.stats(second) == {"scheduled": 0, "hits": 0, "misses": 1, "expired": 0,
+                                        "hit_rate": 0.0, "wasted": 0}
+    assert prefetcher.stats()["misses"] == 1 and prefetcher.stats()["hits"] == 1
+
+
+def test_empty_answer_is_not_a_hit(monkeypatch):
+    fields = format_clipboard_table(["FIELDNAME", "KEYFLAG", "DOMNAME", "CHECKTABLE"], [["VBELN", "X", "VBELN", ""]])
+    answers = ["{}", fields]
+    monkeypatch.setattr(sap_tools, "get_table_fields", lambda table: answers.pop(0))
+    prefetcher = MetadataPrefetcher()
+    dialog = prefetcher.dialog_counters()
+    try:
+        prefetcher.schedule_tables(["VBAK"], dialog)
+        assert prefetcher.get_table_fields("VBAK", dialog) == fields
+    finally:
+        prefetcher.shutdown()
+    # Тексты доменов по умолчанию не подгружаются; пустая фоновая загрузка — впустую
+    assert prefetcher.stats(dialog) == {"scheduled": 1, "hits": 0, "misses": 1, "expired": 0,
+                                        "hit_rate": 0.0, "wasted": 1}
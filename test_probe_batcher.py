@@ -0,0 +1,74 @@
+# test_probe_batcher.py
+# Пакетное выполнение проб: порядок строк внутри пробы, комментарии в тексте пробы, превышение бюджета пакетом
+from deadlines import deadline_error
+from probe_batcher import build_batch_sql, demultiplex, prepare_probe, probe_order, run_probes
+from utils import format_clipboard_table, parse_clipboard_table
+
+
+def test_trailing_comment_does_not_break_wrapping():
+    prepared = prepare_probe("SELECT DOCNUM FROM EDIDC WHERE STATUS = '51' -- failed inbound", 0)
+    sql, _ = build_batch_sql([prepared, prepare_probe("SELECT COUNT(*) FROM EDIDS", 1)])
+    assert "--" not in sql
+    assert sql.endswith("ORDER BY PROBE_TAG, PROBE_SEQ")
+
+
+def test_demultiplex_restores_probe_order():
+    prepared = [prepare_probe("SELECT DOCNUM FROM EDIDC ORDER BY DOCNUM DESC", 0),
+                prepare_probe("SELECT COUNT(*) FROM EDIDS", 1)]
+    text = format_clipboard_table(
+        ["PROBE_TAG", "PROBE_SEQ", "C1"],
+        [["P01", "1", "7"], ["P00", "2", "0001"], ["P00", "1", "0009"]],
+    )
+    first, second = demultiplex(text, prepared)
+    assert parse_clipboard_table(first["result"]) == (["DOCNUM"], [["0009"], ["0001"]])
+    assert parse_clipboard_table(second["result"])[1] == [["7"]]
+
+
+def test_failed_batch_falls_back_to_single_probes():
+    calls = []
+
+    def execute(sql):
+        calls.append(sql)
+        if "UNION ALL" in sql:
+            return {"status": False, "message": "SQL error", "result": "Ошибка выполнения"}
+        return {"status": True, "message": "", "result": format_clipboard_table(["X"], [["1"]])}
+
+    results = run_probes(["SELECT A FROM T1", "SELECT B FROM T2"], execute)
+    assert [batched for _, batched in results] == [False, False]
+    assert len(calls) == 3
+
+
+def test_rows_are_numbered_by_probe_order():
+    prepared = prepare_probe("SELECT DOCNUM, CREDAT FROM EDIDC ORDER BY CREDAT DESC, 1 LIMIT 500", 0)
+    sql, _ = build_batch_sql([prepared, prepare_probe("SELECT COUNT(*) FROM EDIDS", 1)])
+    assert "ROW_NUMBER() OVER (ORDER BY Q.CREDAT DESC, Q.DOCNUM) AS PROBE_SEQ" in sql
+    assert "ROW_NUMBER() OVER () AS PROBE_SEQ" in sql
+    assert probe_order(prepare_probe("SELECT MESTYP, COUNT(*) AS N FROM EDIDC GROUP BY MESTYP "
+                                     "ORDER BY COUNT(*) DESC", 0)) == "ORDER BY Q.N DESC"
+
+
+def test_order_by_unselected_column_runs_alone():
+    calls = []
+
+    def execute(sql):
+        calls.append(sql)
+        if "UNION ALL" in sql:
+            rows = [["P00", "1", "1"], ["P01", "1", "2"]]
+            return {"status": True, "message": "", "result": format_clipboard_table(["PROBE_TAG", "PROBE_SEQ", "C1"], rows)}
+        return {"status": True, "message": "", "result": format_clipboard_table(["X"], [["1"]])}
+
+    results = run_probes(["SELECT DOCNUM FROM EDIDC ORDER BY CREDAT", "SELECT B FROM T2", "SELECT C FROM T3"], execute)
+    assert [batched for _, batched in results] == [False, True, True]
+    assert len(calls) == 2
+
+
+def test_batch_deadline_is_not_retried_per_probe():
+    calls = []
+
+    def execute(sql):
+        calls.append(sql)
+        return deadline_error("runsapsql_query", 30, 30.5, "Превышен бюджет")
+
+    results = run_probes(["SELECT A FROM T1", "SELECT B FROM T2"], execute)
+    assert len(calls) == 1
+    assert [(res["error"], batched) for res, batched in results] == [("deadline_exceeded", True)] * 2
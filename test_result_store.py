@@ -0,0 +1,64 @@
+# test_result_store.py
+# Локальные запросы к сохранённым результатам и разбор чисел из выгрузки SAP
+import pytest
+
+from result_store import LOCAL_SQL_DIALECT, ResultStore, persist_query_result
+from utils import convert_value, format_clipboard_table, infer_column_types, parse_sap_number
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("12", 12.0), ("12.50", 12.5), ("12.50-", -12.5), ("-3", -3.0), (" 7 ", 7.0),
+    ("INF", None), ("nan", None), ("1E5", None), ("-1-", None), ("1.", None), ("", None),
+])
+def test_parse_sap_number(text, expected):
+    assert parse_sap_number(text) == expected
+
+
+def test_special_float_words_stay_text():
+    assert infer_column_types([["INF"], ["1"]], 1) == ["TEXT"]
+
+
+def test_large_integers_keep_precision():
+    assert infer_column_types([["9007199254740993"], ["5-"]], 1) == ["INTEGER"]
+    assert convert_value("9007199254740993", "INTEGER") == 9007199254740993
+    assert convert_value("5-", "INTEGER") == -5
+    assert infer_column_types([["12345678901234567890"], ["1"]], 1) == ["TEXT"]
+
+
+def test_integer_beyond_int64_is_stored(tmp_path):
+    store = ResultStore(str(tmp_path))
+    path, fmt = store.save_rows(["ID"], [["12345678901234567890"], ["9007199254740993"]])
+    res = store.query(path, fmt, ["ID"], "SELECT ID FROM RESULT ORDER BY ID")
+    assert res["status"] and "12345678901234567890" in res["result"] and "9007199254740993" in res["result"]
+
+
+def test_persist_failure_leaves_result_without_id(tmp_path):
+    class FailingStore:
+        def save_rows(self, columns, rows):
+            raise OSError("disk full")
+
+    exec_res = {"status": True, "result": format_clipboard_table(["A"], [["1"]])}
+    assert persist_query_result(None, "final", "SELECT A FROM T", exec_res, FailingStore()) is None
+
+
+@pytest.fixture
+def stored(tmp_path):
+    store = ResultStore(str(tmp_path))
+    path, fmt = store.save_rows(["VBELN", "NETWR"], [["0000000001", "10.5"], ["0000000002", "3.25-"]])
+    return store, path, fmt
+
+
+def test_local_query(stored):
+    store, path, fmt = stored
+    res = store.query(path, fmt, ["VBELN", "NETWR"], "SELECT SUM(NETWR) AS S FROM RESULT")
+    assert res["status"] and "7.25" in res["result"]
+
+
+def test_local_query_cannot_read_files(stored, tmp_path):
+    if LOCAL_SQL_DIALECT != "DuckDB":
+        pytest.skip("duckdb не установлен")
+    store, path, fmt = stored
+    secret = tmp_path / "secret.csv"
+    secret.write_text("a\n42\n")
+    res = store.query(path, fmt, ["VBELN", "NETWR"], f"SELECT * FROM read_csv_auto('{secret}')")
+    assert not res["status"]
@@ -0,0 +1,70 @@
+# test_scheduled_queries.py
+# Регулярные запросы: повторяющиеся имена колонок, ошибки слияния, запросы без корректной дельты
+import pytest
+
+from scheduled_queries import ScheduledQueries
+from utils import format_clipboard_table
+
+
+@pytest.fixture
+def store(tmp_path):
+    s = ScheduledQueries(str(tmp_path / "sched.sqlite3"))
+    s.connect()
+    yield s
+    s.close()
+
+
+def answer(columns, rows):
+    return lambda sql: {"status": True, "message": "", "result": format_clipboard_table(columns, rows)}
+
+
+def last_run(store, qid):
+    return store.conn.execute("SELECT status, message FROM scheduled_run WHERE query_id = ? ORDER BY id DESC",
+                              (qid,)).fetchone()
+
+
+def test_duplicate_column_names_are_made_unique(store):
+    qid = store.add("items", "SELECT K.VBELN, P.VBELN, P.AEDAT FROM VBAK K JOIN VBAP P ON P.VBELN = K.VBELN",
+                    "AEDAT", ["VBELN"], 60)
+    res = store.run(store.get("items"), answer(["VBELN", "VBELN", "AEDAT"], [["1", "1", "20240101"]]))
+    assert res["status"] == "ok" and res["row_count"] == 1
+    assert store.get("items")["columns"] == ["VBELN", "VBELN_1", "AEDAT"]
+    assert last_run(store, qid)[0] == "ok"
+
+
+def test_failed_merge_keeps_previous_copy_and_is_recorded(store):
+    qid = store.add("orders", "SELECT VBELN, AEDAT FROM VBAK", "AEDAT", ["VBELN"], 60)
+    store.run(store.get("orders"), answer(["VBELN", "AEDAT"], [["1", "20240101"], ["2", "20240102"]]))
+    q = store.get("orders")
+    q["watermark"] = None  # повторный полный запуск, результат без колонки изменений
+    res = store.run(q, answer(["VBELN"], [["3"]]))
+    assert res["status"] == "error"
+    assert store.rows("orders")["rows"] == [("2", "20240102"), ("1", "20240101")]
+    assert last_run(store, qid) == ("error", "В результате нет колонок: AEDAT")
+
+
+def test_execute_exception_is_recorded(store):
+    qid = store.add("boom", "SELECT VBELN, AEDAT FROM VBAK", "AEDAT", [], 60)
+
+    def execute(sql):
+        raise RuntimeError("SAP GUI недоступен")
+
+    assert store.run(store.get("boom"), execute)["status"] == "error"
+    assert last_run(store, qid) == ("error", "SAP GUI недоступен")
+
+
+@pytest.mark.parametrize("sql", [
+    "SELECT TOP 10 VBELN, AEDAT FROM VBAK",
+    "SELECT VBELN, AEDAT FROM VBAK ORDER BY AEDAT LIMIT 10",
+    "SELECT VBELN, AEDAT FROM VBAK FETCH FIRST 10 ROWS ONLY",
+    "SELECT VKORG, MAX(AEDAT) AS AEDAT FROM VBAK GROUP BY VKORG",
+])
+def test_sql_without_correct_delta_is_rejected(store, sql):
+    with pytest.raises(ValueError):
+        store.add("bad", sql, "AEDAT", [], 60)
+
+
+def test_delta_sql_strips_trailing_comment(store):
+    store.add("c", "SELECT VBELN, AEDAT FROM VBAK -- all orders", "AEDAT", [], 60)
+    sql = store.delta_sql(store.get("c")["sql"], "AEDAT", "20240101")
+    assert "--" not in sql and sql.endswith("WHERE Q.AEDAT >= '20240101'")
@@ -0,0 +1,133 @@
+# test_sql_validator.py
+# Проверки локального валидатора SQL: комментарии, FETCH FIRST, CAST, неявные псевдонимы, CTE;
+# наличие таблиц из DD02T
+import pytest
+
+import sap_tools
+from sql_validator import DdicCache, strip_comments, validate_sql
+from utils import format_clipboard_table
+
+EDIDC_FIELDS = format_clipboard_table(
+    ["FIELDNAME", "DATATYPE", "OUTPUTLEN"],
+    [["DOCNUM", "NUMC", "000016"], ["STATUS", "CHAR", "000002"],
+     ["CREDAT", "DATS", "000010"], ["MESTYP", "CHAR", "000030"]],
+)
+
+
+@pytest.fixture
+def cache(tmp_path):
+    c = DdicCache(str(tmp_path / "ddic.sqlite3"))
+    c.connect()
+    c.ingest_table_fields("EDIDC", EDIDC_FIELDS)
+    c.ingest_presence({"EDIDS": True, "NOSUCH": False})
+    yield c
+    c.close()
+
+
+def check(sql, cache, probe=True):
+    return validate_sql(sql, probe=probe, cache=cache, max_rows=500)
+
+
+def test_trailing_line_comment_does_not_swallow_limit(cache):
+    res = check("SELECT DOCNUM, STATUS FROM EDIDC WHERE STATUS = '51' -- failed inbound", cache)
+    assert res["ok"]
+    assert "--" not in res["sql"]
+    assert res["sql"].endswith("WHERE STATUS = '51' ORDER BY 1 LIMIT 500")
+
+
+def test_comment_markers_inside_literals_are_kept():
+    assert strip_comments("SELECT '--x' AS A /* c */ FROM T -- tail") == "SELECT '--x' AS A   FROM T"
+
+
+def test_fetch_first_is_a_limit(cache):
+    res = check("SELECT DOCNUM FROM EDIDC FETCH FIRST 10 ROWS ONLY", cache)
+    assert res["ok"]
+    assert res["sql"] == "SELECT DOCNUM FROM EDIDC ORDER BY 1 FETCH FIRST 10 ROWS ONLY"
+
+
+def test_fetch_first_is_capped(cache):
+    res = check("SELECT DOCNUM FROM EDIDC ORDER BY DOCNUM FETCH FIRST 10000 ROWS ONLY", cache)
+    assert res["sql"] == "SELECT DOCNUM FROM EDIDC ORDER BY DOCNUM FETCH FIRST 500 ROWS ONLY"
+
+
+def test_limit_is_capped_and_order_inserted_before_it(cache):
+    res = check("SELECT DOCNUM FROM EDIDC LIMIT 100000", cache)
+    assert res["sql"] == "SELECT DOCNUM FROM EDIDC ORDER BY 1 LIMIT 500"
+
+
+def test_offset_without_limit(cache):
+    res = check("SELECT DOCNUM FROM EDIDC ORDER BY DOCNUM OFFSET 20", cache)
+    assert res["sql"] == "SELECT DOCNUM FROM EDIDC ORDER BY DOCNUM LIMIT 500 OFFSET 20"
+
+
+def test_top_is_left_alone(cache):
+    res = check("SELECT TOP 5 DOCNUM FROM EDIDC", cache)
+    assert res["sql"] == "SELECT TOP 5 DOCNUM FROM EDIDC"
+
+
+def test_final_sql_is_not_limited(cache):
+    res = check("SELECT DOCNUM FROM EDIDC -- all", cache, probe=False)
+    assert res["sql"] == "SELECT DOCNUM FROM EDIDC"
+
+
+def test_cast_target_is_not_a_field(cache):
+    res = check("SELECT CAST(DOCNUM AS NVARCHAR(16)) AS D, CAST(STATUS AS INTEGER) FROM EDIDC", cache)
+    assert res["ok"]
+    assert res["warnings"] == []
+
+
+def test_implicit_alias(cache):
+    res = check("SELECT COUNT(*) CNT, MAX(CREDAT) LAST_DAY FROM EDIDC E WHERE E.STATUS = '51' ORDER BY CNT", cache)
+    assert res["ok"]
+    assert res["warnings"] == []
+
+
+def test_cte_columns_are_not_checked_against_ddic(cache):
+    sql = ("WITH F AS (SELECT DOCNUM, STATUS FROM EDIDC WHERE STATUS = '51') "
+           "SELECT F.DOCNUM, F.ANYTHING FROM F")
+    res = check(sql, cache)
+    assert res["ok"]
+    assert res["warnings"] == []
+    assert res["sql"].endswith("FROM F ORDER BY 1 LIMIT 500")
+
+
+def test_window_order_by_is_not_top_level(cache):
+    res = check("SELECT DOCNUM, ROW_NUMBER() OVER (ORDER BY CREDAT) RN FROM EDIDC", cache)
+    assert res["sql"].endswith("RN FROM EDIDC ORDER BY 1 LIMIT 500")
+
+
+def test_unknown_field_is_a_warning(cache):
+    # DD03M с фильтром по языку отдаёт не все поля — неизвестное имя не блокирует запрос
+    res = check("SELECT DOCNUM, RCVPRN FROM EDIDC", cache)
+    assert res["ok"]
+    assert len(res["warnings"]) == 1 and "RCVPRN" in res["warnings"][0]
+
+
+def test_numc_literal_length_is_an_error(cache):
+    res = check("SELECT STATUS FROM EDIDC WHERE DOCNUM = '123'", cache)
+    assert not res["ok"]
+    assert "0000000000000123" in res["errors"][0]
+
+
+def test_dats_literal_format_is_an_error(cache):
+    res = check("SELECT DOCNUM FROM EDIDC WHERE CREDAT >= '2024-01-01'", cache)
+    assert not res["ok"]
+
+
+def test_missing_table_is_an_error(cache):
+    res = check("SELECT * FROM NOSUCH", cache)
+    assert not res["ok"]
+
+
+def test_multiple_statements_are_rejected(cache):
+    res = check("SELECT DOCNUM FROM EDIDC; SELECT 1 FROM EDIDS", cache)
+    assert not res["ok"]
+
+
+def test_failed_presence_query_is_not_absence(monkeypatch):
+    monkeypatch.setattr(sap_tools, "run_sap_sql_query",
+                        lambda sql: {"status": False, "message": "Таймаут", "result": "Ошибка выполнения"})
+    assert sap_tools.are_tables_present(["VBAK"])["status"] is False
+    monkeypatch.setattr(sap_tools, "run_sap_sql_query",
+                        lambda sql: {"status": False, "message": "Данные не найдены", "result": "Данные не найдены"})
+    assert sap_tools.are_tables_present(["vbak", "NOSUCH"]) == {"NOSUCH": False, "VBAK": False}
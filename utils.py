@@ -1,7 +1,7 @@
 # utils.py
 import json
 import re
-from typing import Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
 def extract_json_object(text: str) -> Optional[Dict]:
     try:
@@ -29,3 +29,134 @@ def build_incremental_payload(messages: List[Dict[str, str]], start_idx: int) ->
             continue
         pieces.append(f"## {m['role']}\n{m['content']}")
     return "\n---\n".join(pieces)  # [web:2]
+
+def parse_clipboard_table(text: str) -> Tuple[List[str], List[List[str]]]:
+    """
+    Разбирает выгрузку ALV в буфер обмена (неконвертированный формат с '|')
+    и возвращает (заголовки, строки). Первая строка с '|' считается заголовком.
+    """
+    columns: List[str] = []
+    rows: List[List[str]] = []
+    for line in (text or "").splitlines():
+        if "|" not in line or set(line.strip()) <= {"-", " ", "|"}:
+            continue
+        parts = [c.strip() for c in line.strip().strip("|").split("|")]
+        if not columns:
+            columns = [c.upper() for c in parts]
+            continue
+        if len(parts) < len(columns):
+            parts += [""] * (len(columns) - len(parts))
+        rows.append(parts[:len(columns)])
+    return columns, rows
+
+def clipboard_records(text: str) -> List[Dict[str, str]]:
+    """Выгрузка ALV в виде списка словарей {КОЛОНКА: значение}."""
+    columns, rows = parse_clipboard_table(text)
+    return [dict(zip(columns, r)) for r in rows]
+
+def format_clipboard_table(columns: List[str], rows: List[List[Any]]) -> str:
+    """Обратное к parse_clipboard_table: таблица в формате выгрузки ALV с '|'."""
+    widths = [len(str(c)) for c in columns]
+    for r in rows:
+        for i, v in enumerate(r[:len(widths)]):
+            widths[i] = max(widths[i], len("" if v is None else str(v)))
+    line = "-" * (sum(widths) + len(widths) + 1)
+
+    def fmt(values: List[Any]) -> str:
+        cells = ["" if v is None else str(v) for v in values]
+        return "|" + "|".join(c.ljust(w) for c, w in zip(cells, widths)) + "|"
+
+    return "\n".join([line, fmt(columns), line] + [fmt(r) for r in rows] + [line])
+
+def unique_column_names(columns: List[str]) -> List[str]:
+    """Имена колонок без повторов (в выгрузке соединений одно поле может встретиться дважды: K.VBELN, P.VBELN)."""
+    seen: Dict[str, int] = {}
+    names = []
+    for c in columns:
+        c = c or "COL"
+        if c in seen:
+            seen[c] += 1
+            names.append(f"{c}_{seen[c]}")
+        else:
+            seen[c] = 0
+            names.append(c)
+    return names
+
+_SAP_NUMBER_RE = re.compile(r'^(-?)(\d+(?:\.\d+)?)(-?)$')
+# Диапазон INTEGER-колонки (int64 в Arrow и SQLite); целые за его пределами сохраняются текстом
+INT64_MIN, INT64_MAX = -2 ** 63, 2 ** 63 - 1
+
+def parse_sap_number(value: str) -> Optional[float]:
+    """
+    Число из выгрузки SAP (минус может стоять в конце: '12.50-'). None, если это не число.
+    Принимаются только цифры с необязательной дробной частью: 'INF', 'NAN', '1E5' остаются текстом.
+    """
+    m = _SAP_NUMBER_RE.match(value.strip())
+    if not m or (m.group(1) and m.group(3)):
+        return None
+    number = float(m.group(2))
+    return -number if m.group(1) or m.group(3) else number
+
+def parse_sap_int(value: str) -> Optional[int]:
+    """Целое из выгрузки SAP без потери точности (через int, а не float). None, если это не целое."""
+    m = _SAP_NUMBER_RE.match(value.strip())
+    if not m or (m.group(1) and m.group(3)) or not m.group(2).isdigit():
+        return None
+    number = int(m.group(2))
+    return -number if m.group(1) or m.group(3) else number
+
+def infer_column_types(rows: List[List[str]], ncols: int) -> List[str]:
+    """
+    Типы колонок выгрузки: INTEGER, REAL или TEXT.
+    Значения с ведущими нулями (NUMC: номера документов, позиции) и целые вне int64 остаются текстом.
+    """
+    types = []
+    for i in range(ncols):
+        kind = "INTEGER"
+        seen = False
+        for r in rows:
+            v = r[i].strip() if i < len(r) and r[i] is not None else ""
+            if not v:
+                continue
+            seen = True
+            digits = v.lstrip("-").rstrip("-")
+            if len(digits) > 1 and digits.startswith("0") and not digits.startswith("0."):
+                kind = "TEXT"
+                break
+            if parse_sap_number(v) is None:
+                kind = "TEXT"
+                break
+            if kind == "INTEGER" and not digits.isdigit():
+                kind = "REAL"
+            if kind == "INTEGER" and not INT64_MIN <= parse_sap_int(v) <= INT64_MAX:
+                kind = "TEXT"
+                break
+        types.append(kind if seen else "TEXT")
+    return types
+
+def convert_value(value: str, kind: str) -> Any:
+    """Приводит строковое значение выгрузки к типу из infer_column_types."""
+    if kind == "TEXT" or value is None or not value.strip():
+        return value if kind == "TEXT" else None
+    return parse_sap_int(value) if kind == "INTEGER" else parse_sap_number(value)
+
+AGENT_SCRIPT = "SapSqlAgent_Reason(OLllama).py"
+
+def load_agent_module():
+    """
+    Загружает модуль агента по пути к файлу: имя скрипта содержит скобки и не импортируется обычным import.
+    Повторные вызовы возвращают уже загруженный модуль.
+    """
+    import importlib.util
+    import os
+    import sys
+
+    name = "sap_sql_agent_reason"
+    if name in sys.modules:
+        return sys.modules[name]
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), AGENT_SCRIPT)
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module